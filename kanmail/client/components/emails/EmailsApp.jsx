@@ -25,6 +25,9 @@ import threadStore from 'stores/thread.js';
 import mainEmailStore from 'stores/emails/main.js';
 import { getColumnMetaStore } from 'stores/columns.js';
 import { subscribe } from 'stores/base.jsx';
+import { get } from 'util/requests.js';
+
+const EVENTS_RETRY_MS = 30000;
 
 
 @subscribe(settingsStore)
@@ -75,10 +78,44 @@ export default class EmailsApp extends React.Component {
             sync_interval,
         );
         updateStore.checkUpdate();
+
+        // Long-poll for changes pushed by the server (IMAP IDLE)
+        this.watchEmailEvents();
     }
 
     componentWillUnmount() {
         clearInterval(this.newAliasEmailCheck);
+        this.stopWatchingEmailEvents = true;
+    }
+
+    watchEmailEvents = (since, epoch) => {
+        if (this.stopWatchingEmailEvents) {
+            return;
+        }
+
+        // The epoch changes when the server restarts, resetting the event IDs
+        const query = _.isUndefined(since) ? {} : {since, epoch};
+
+        get('/api/emails/events', query)
+            .then(data => {
+                _.each(data.events, event => {
+                    const columnMetaStore = getColumnMetaStore(event.folder_name);
+                    if (columnMetaStore.props.isSyncing) {
+                        return;
+                    }
+
+                    mainEmailStore.syncFolderEmails(event.folder_name, {
+                        accountName: event.account_name,
+                        skipUnreadSync: filterStore.props.mainColumn !== event.folder_name,
+                    });
+                });
+
+                this.watchEmailEvents(data.latest_id, data.epoch);
+            })
+            .catch(() => setTimeout(
+                () => this.watchEmailEvents(since, epoch),
+                EVENTS_RETRY_MS,
+            ));
     }
 
     getNewEmails = () => {
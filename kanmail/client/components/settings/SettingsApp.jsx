@@ -305,6 +305,22 @@ export default class SettingsApp extends AccountAndSignatureSettingsMixin {
                     />
                 </div>
 
+                <div className="checkbox">
+                    <label htmlFor="offline_startup">
+                        Offline startup
+                        <small>Show cached emails before connecting to the server</small>
+                    </label>
+                    <input
+                        type="checkbox"
+                        id="offline_startup"
+                        checked={this.state.systemSettings.offline_startup}
+                        onChange={_.partial(
+                            this.handleCheckboxUpdate,
+                            'systemSettings', 'offline_startup',
+                        )}
+                    />
+                </div>
+
                 <div className="checkbox">
                     <label htmlFor="show_help_button">
                         Show help button
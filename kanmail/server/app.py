@@ -31,11 +31,24 @@ from kanmail.settings.hidden import get_hidden_value
 from kanmail.version import get_version
 
 
+SQLITE_PRAGMAS = (
+    ('foreign_keys', 'ON'),
+    # WAL means readers never block on (the single) writer, and with that
+    # NORMAL synchronous is safe (a crash may only lose the latest commits).
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('cache_size', -16 * 1024),  # negative = KiB
+    ('temp_store', 'MEMORY'),
+)
+
+
 @event.listens_for(Engine, 'connect')
-def enable_sqlite_foreign_keys(dbapi_connection, connection_record) -> None:
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
     if isinstance(dbapi_connection, SQLite3Connection):
         cursor = dbapi_connection.cursor()
-        cursor.execute('PRAGMA foreign_keys=ON;')
+        for key, value in SQLITE_PRAGMAS:
+            cursor.execute(f'PRAGMA {key}={value};')
         cursor.close()
 
 
@@ -149,5 +162,7 @@ def boot(prepare_server: bool = True) -> None:
     # Database models
     from kanmail.server.mail.contacts import Contact  # noqa: F401
     from kanmail.server.mail.allowed_images import AllowedImage  # noqa: F401
+    from kanmail.server.mail.folder_cache import upgrade_folder_cache
 
     db.create_all()
+    upgrade_folder_cache()
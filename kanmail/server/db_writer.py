@@ -0,0 +1,116 @@
+'''
+Single writer for the SQLite cache databases. SQLite only allows one writer at
+a time, so rather than have many request/sync threads contending for the write
+lock (and each paying for their own commit/fsync) all writes are queued here
+and executed by one thread, committing every queued write per bind in a single
+transaction. If any write fails the transaction is rolled back and each write is
+executed again in its own transaction, so a failed write is never committed.
+'''
+
+from collections import defaultdict
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import current_thread, Lock, Thread
+
+from kanmail.log import logger
+from kanmail.server.app import db
+
+# Maximum number of queued writes to group into a single transaction
+MAX_WRITE_BATCH_SIZE = 100
+
+
+class DatabaseWriter(Thread):
+    def __init__(self):
+        super().__init__(daemon=True, name='DatabaseWriter')
+
+        self.queue = Queue()
+
+    def submit(self, bind, func, args):
+        future = Future()
+        self.queue.put((bind, func, args, future))
+        return future
+
+    def run(self):
+        while True:
+            writes = [self.queue.get()]
+
+            # Grab anything else that queued while we were busy
+            while len(writes) < MAX_WRITE_BATCH_SIZE:
+                try:
+                    writes.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            bind_to_writes = defaultdict(list)
+            for write in writes:
+                bind_to_writes[write[0]].append(write)
+
+            for bind, bind_writes in bind_to_writes.items():
+                self.execute_writes(bind, bind_writes)
+
+    def execute_writes(self, bind, writes):
+        try:
+            with db.get_engine(bind=bind).begin() as connection:
+                results = [
+                    (future, func(connection, *args))
+                    for _, func, args, future in writes
+                ]
+        except Exception as e:
+            # The whole transaction was rolled back, so rather than commit any
+            # partial write run each again in its own transaction, failing only
+            # the write(s) that fail alone.
+            if len(writes) > 1:
+                logger.warning((
+                    f'Failed to write {len(writes)} writes to {bind}, '
+                    f'retrying individually: {e}'
+                ))
+
+                for write in writes:
+                    self.execute_writes(bind, [write])
+                return
+
+            _, func, _, future = writes[0]
+            logger.warning(f'Database write {func.__name__} failed: {e}')
+            future.set_exception(e)
+            return
+
+        logger.debug(f'Committed {len(writes)} writes to {bind}')
+
+        # Only resolve the futures once the transaction has been committed
+        for future, result in results:
+            future.set_result(result)
+
+
+WRITER = None
+WRITER_LOCK = Lock()
+
+
+def get_writer():
+    global WRITER
+
+    with WRITER_LOCK:
+        if WRITER is None:
+            WRITER = DatabaseWriter()
+            WRITER.start()
+
+    return WRITER
+
+
+def execute_write(bind, func, *args, wait=True):
+    '''
+    Queue `func(connection, *args)` to be executed by the writer thread against
+    the given bind. By default waits for (and returns the result of) the write
+    once committed, with `wait=False` the future is returned instead.
+    '''
+
+    writer = get_writer()
+
+    # Writes can't queue themselves, this would deadlock
+    if current_thread() is writer:
+        raise RuntimeError('Cannot queue a database write from the writer thread!')
+
+    future = writer.submit(bind, func, args)
+
+    if wait:
+        return future.result()
+    return future
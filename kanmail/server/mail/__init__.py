@@ -1,29 +1,63 @@
+import json
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from collections import defaultdict
+from heapq import merge
+from itertools import islice
 from threading import Lock
 
 from kanmail.log import logger
-from kanmail.server.util import execute_threaded
-from kanmail.settings import get_settings
+from kanmail.server.util import execute_threaded, SingleFlight
+from kanmail.settings import get_settings, get_system_setting
 
 from .account import Account
 from .allowed_images import is_email_allowed_images
-from .util import markdownify
+from .folder_cache import make_account_key
+from .idle import get_idle_events
+from .part_stream import EmailPartStream
+from .threads import (
+    clean_message_id,
+    get_thread_ids,
+    get_thread_message_counts,
+    get_thread_message_locations,
+)
+from .util import get_date_timestamp, markdownify
 
 ACCOUNTS = {}
 GET_ACCOUNTS_LOCK = Lock()
 
+# Seconds to keep folder list results, returned to any identical calls
+FOLDER_LIST_RESULT_TTL = 5
+
+# Concurrent identical calls (ie from multiple windows/retries) share the one
+# in-flight IMAP operation & result. Listing emails pages through the folder so
+# results are only shared while in-flight (as are syncs, see `Account`).
+FOLDER_LIST_FLIGHTS = SingleFlight(ttl=FOLDER_LIST_RESULT_TTL)
+LIST_EMAILS_FLIGHTS = SingleFlight()
+
+
+def get_account_task_limit(account):
+    # Tasks beyond the account's connections would only wait on the pool
+    return account.connection_pool.max_connections
+
 
 def connect_all():
     def make_account(key, settings):
         return key, Account(key, settings)
 
     with GET_ACCOUNTS_LOCK:
-        ACCOUNTS.update(execute_threaded(make_account, [
+        new_accounts = dict(execute_threaded(make_account, [
             (settings['name'], settings)
             for settings in get_settings()['accounts']
             if settings['name'] not in ACCOUNTS
         ]))
 
+        for account in new_accounts.values():
+            account.connection_pool.start_manager()
+            account.start_idle_watcher()
+
+        ACCOUNTS.update(new_accounts)
+
 
 def get_accounts():
     connect_all()
@@ -37,10 +71,19 @@ def get_account(key):
 
 def reset_accounts():
     for key in list(ACCOUNTS.keys()):
-        ACCOUNTS.pop(key, None)
+        account = ACCOUNTS.pop(key, None)
+        if account:
+            account.stop_idle_watcher()
+            account.connection_pool.stop_manager()
+
+    FOLDER_LIST_FLIGHTS.clear()
 
 
 def get_all_folders():
+    return FOLDER_LIST_FLIGHTS.do('all', _get_all_folders)
+
+
+def _get_all_folders():
     def get_folders(account):
         folders = []
 
@@ -54,7 +97,7 @@ def get_all_folders():
     account_folder_names = execute_threaded(get_folders, [
         (account,)
         for account in get_accounts()
-    ])
+    ], key=lambda account: account, limit=get_account_task_limit)
 
     meta = {}
     folder_names = []
@@ -69,6 +112,41 @@ def get_all_folders():
     return sorted(list(set(folder_names))), meta
 
 
+def get_connection_pool_stats():
+    return {
+        account.name: account.connection_pool.get_stats()
+        for account in get_accounts()
+    }
+
+
+def get_query_folder_cache_stats():
+    return {
+        account.name: account.query_folders.get_stats()
+        for account in get_accounts()
+    }
+
+
+def get_folder_events(since=None, epoch=None, timeout=None):
+    '''
+    Long-poll for folder change events pushed by the account IDLE watchers.
+    '''
+
+    kwargs = {}
+    if timeout is not None:
+        kwargs['timeout'] = timeout
+
+    return get_idle_events(since=since, epoch=epoch, **kwargs)
+
+
+def make_folder_meta(folder):
+    return {
+        'count': len(folder),
+        'exists': folder.exists,
+        # Whether the emails are from the cache & not yet synced with the server
+        'stale': folder.stale,
+    }
+
+
 def get_folder_emails(
     account_key, folder_name,
     query=None, reset=False, batch_size=None,
@@ -77,6 +155,26 @@ def get_folder_emails(
     Get (more) emails from a folder within an account.
     '''
 
+    # Each call without reset returns the next page, so only the (idempotent)
+    # first page can be shared.
+    if not reset:
+        return _get_folder_emails(
+            account_key, folder_name,
+            query=query, batch_size=batch_size,
+        )
+
+    return LIST_EMAILS_FLIGHTS.do(
+        (account_key, folder_name, query, batch_size),
+        _get_folder_emails,
+        account_key, folder_name,
+        query=query, reset=reset, batch_size=batch_size,
+    )
+
+
+def _get_folder_emails(
+    account_key, folder_name,
+    query=None, reset=False, batch_size=None,
+):
     account = get_account(account_key)
     folder = account.get_folder(folder_name, query=query)
 
@@ -85,17 +183,205 @@ def get_folder_emails(
         batch_size=batch_size,
     )
 
+    meta = make_folder_meta(folder)
+
+    return emails, meta
+
+
+class ColumnCursorError(ValueError):
+    pass
+
+
+def _encode_column_cursor(account_to_last_uid):
+    cursor = json.dumps(account_to_last_uid, separators=(',', ':'))
+    return urlsafe_b64encode(cursor.encode()).decode()
+
+
+def _decode_column_cursor(cursor):
+    if not cursor:
+        return {}
+
+    try:
+        account_to_last_uid = json.loads(urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        account_to_last_uid = None
+
+    if not isinstance(account_to_last_uid, dict) or not all(
+        isinstance(uid, int) for uid in account_to_last_uid.values()
+    ):
+        raise ColumnCursorError(f'Invalid cursor: {cursor}')
+
+    return account_to_last_uid
+
+
+def _iter_column_sort_keys(account_name, emails):
+    # Emails are highest UID first and merging needs each account's emails in
+    # merge key order, so use the lowest timestamp so far - the UID and date
+    # order (almost) always match, this just keeps the merge consistent.
+    min_timestamp = None
+
+    for email in emails:
+        timestamp = get_date_timestamp(email.get('date'))
+        if timestamp is not None and (min_timestamp is None or timestamp < min_timestamp):
+            min_timestamp = timestamp
+
+        sort_timestamp = float('inf') if min_timestamp is None else min_timestamp
+        yield (sort_timestamp, email['uid'], account_name), email
+
+
+def get_column_emails(folder_name, query=None, cursor=None, batch_size=None):
+    '''
+    Get the next page of emails for a folder (column) across all accounts,
+    merged newest first. The cursor holds the last UID returned for each
+    account, so pages are read from each folder's (sorted) UID list without
+    tracking seen emails or re-sorting.
+
+    Each account's emails stay in UID order, the accounts are merged by date
+    using the lowest date seen so far for each account (see
+    `_iter_column_sort_keys`). So an email with a date newer than a lower
+    UID's (ie appended/moved in later) is returned with that account's
+    emails around it, rather than at its true date position.
+
+    Returns the emails, the cursor for the next page (`None` when there are no
+    more emails) and per-account meta.
+    '''
+
+    if not batch_size:
+        batch_size = get_system_setting('batch_size')
+
+    account_to_last_uid = _decode_column_cursor(cursor)
+
+    def get_account_emails(account):
+        folder = account.get_folder(folder_name, query=query)
+
+        emails = folder.get_emails_before(
+            account_to_last_uid.get(account.name),
+            batch_size=batch_size,
+        )
+
+        meta = make_folder_meta(folder)
+
+        return account.name, emails, meta
+
+    account_emails = execute_threaded(get_account_emails, [
+        (account,)
+        for account in get_accounts()
+    ], key=lambda account: account, limit=get_account_task_limit)
+
+    merged_emails = merge(
+        *(
+            _iter_column_sort_keys(account_name, emails)
+            for account_name, emails, _ in account_emails
+        ),
+        key=lambda item: item[0],
+        reverse=True,
+    )
+
+    emails = []
+    next_account_to_last_uid = dict(account_to_last_uid)
+
+    for _, email in islice(merged_emails, batch_size):
+        emails.append(email)
+        next_account_to_last_uid[email['account_name']] = email['uid']
+
+    next_cursor = None
+    if emails:
+        next_cursor = _encode_column_cursor(next_account_to_last_uid)
+
     meta = {
-        'count': len(folder),
-        'exists': folder.exists,
+        account_name: account_meta
+        for account_name, _, account_meta in account_emails
     }
 
-    return emails, meta
+    return emails, next_cursor, meta
+
+
+def get_thread_emails(thread_id):
+    '''
+    Get the emails we have (cached headers for) in a thread, across all accounts
+    and folders, oldest first.
+    '''
+
+    account_key_to_account = {
+        make_account_key(account.settings): account
+        for account in get_accounts()
+    }
+
+    folder_to_uids = defaultdict(list)
+
+    for account_key, folder_name, uid in get_thread_message_locations(thread_id):
+        account = account_key_to_account.get(account_key)
+        if account:
+            folder_to_uids[(account, folder_name)].append(uid)
+
+    def get_emails(account, folder_name, uids):
+        folder = account.get_folder(account.get_folder_alias(folder_name))
+        return list(folder.get_email_headers(uids).values())
+
+    emails = []
+
+    for folder_emails in execute_threaded(get_emails, [
+        (account, folder_name, uids)
+        for (account, folder_name), uids in folder_to_uids.items()
+    ],
+        key=lambda account, folder_name, uids: account,
+        limit=get_account_task_limit,
+    ):
+        emails.extend(folder_emails)
+
+    return sorted(
+        emails,
+        key=lambda email: (get_date_timestamp(email.get('date')) or 0, email['uid']),
+    )
+
+
+def get_column_threads(folder_name, query=None, cursor=None, batch_size=None):
+    '''
+    Get the next page of emails for a folder (column) across all accounts, see
+    `get_column_emails`, grouped into threads (newest first). Each thread has
+    the total number of messages in it, the rest can be loaded with
+    `get_thread_emails`.
+
+    Returns the threads, the cursor for the next page and per-account meta.
+    '''
+
+    emails, next_cursor, meta = get_column_emails(
+        folder_name,
+        query=query,
+        cursor=cursor,
+        batch_size=batch_size,
+    )
+
+    email_message_ids = [clean_message_id(email['message_id']) for email in emails]
+    message_id_to_thread_id = get_thread_ids(email_message_ids)
+
+    thread_id_to_emails = {}  # ordered by newest email
+
+    for email, message_id in zip(emails, email_message_ids):
+        thread_id = message_id_to_thread_id.get(message_id)
+        # Messages without a message ID (or not yet indexed) are their own thread
+        if not thread_id:
+            thread_id = message_id or f'{email["account_name"]}/{email["uid"]}'
+
+        thread_id_to_emails.setdefault(thread_id, []).append(email)
+
+    thread_id_to_count = get_thread_message_counts(thread_id_to_emails.keys())
+
+    threads = [
+        {
+            'thread_id': thread_id,
+            'emails': thread_emails,
+            'message_count': max(thread_id_to_count.get(thread_id, 0), len(thread_emails)),
+        }
+        for thread_id, thread_emails in thread_id_to_emails.items()
+    ]
+
+    return threads, next_cursor, meta
 
 
 def sync_folder_emails(
     account_key, folder_name,
-    query=None, expected_uid_count=None, check_unread_uids=None,
+    query=None, expected_uid_count=None, check_unread_uids=None, status=None,
 ):
     '''
     Get new emails and any deleted UIDs for a folder within an account.
@@ -104,51 +390,122 @@ def sync_folder_emails(
     account = get_account(account_key)
     folder = account.get_folder(folder_name, query=query)
 
+    # Keyed by the real folder name so changes to the folder forget any in-flight
+    # sync (see `Account.invalidate_folder_status`).
+    return account.sync_flights.do(
+        (
+            folder.name, query, expected_uid_count,
+            tuple(check_unread_uids or ()),
+        ),
+        _sync_folder_emails,
+        folder,
+        expected_uid_count=expected_uid_count,
+        check_unread_uids=check_unread_uids,
+        status=status,
+    )
+
+
+def _sync_folder_emails(
+    folder, expected_uid_count=None, check_unread_uids=None, status=None,
+):
     emails, deleted_uids, read_uids = folder.sync_emails(
         expected_uid_count=expected_uid_count,
         check_unread_uids=check_unread_uids,
+        status=status,
     )
 
-    meta = {
-        'count': len(folder),
-        'exists': folder.exists,
-    }
+    meta = make_folder_meta(folder)
 
     return emails, deleted_uids, read_uids, meta
 
 
-def _get_folder_email_parts(account_key, folder_name, uid_parts):
+def sync_all_folder_emails(folder_syncs):
     '''
-    Get email parts (body parts) for a given folder and a given map of
-    UID -> part ID. This happens in parallel for different part ID given, as
-    IMAP cannot return different parts of different messages in each request.
+    Sync multiple folders across accounts in one go, fetching the status of each
+    account's folders using a single connection. Each folder sync is a dict of
+    account & folder plus optional query, uid_count & unread_uids.
+
+    Returns a list of results, in the same order as the folder syncs, each with
+    either the new emails, deleted/read UIDs & meta or an error.
     '''
 
-    # Make map of part ID -> UIDs
-    part_to_uid = defaultdict(list)
+    account_key_to_indexes = defaultdict(list)
+    for i, folder_sync in enumerate(folder_syncs):
+        account_key_to_indexes[folder_sync['account']].append(i)
 
-    for uid, part in uid_parts:
-        part_to_uid[part].append(uid)
+    def sync_account_folders(account_key, indexes):
+        try:
+            account = get_account(account_key)
+            folders = [
+                account.get_folder(
+                    folder_syncs[i]['folder'],
+                    query=folder_syncs[i].get('query'),
+                )
+                for i in indexes
+            ]
+            folder_name_to_status = account.get_folder_statuses({
+                folder.name for folder in folders
+                if folder.exists
+            })
+        except Exception as e:
+            logger.warning(f'Failed to sync folders for {account_key}: {e}')
+            return [(i, {'error': str(e)}) for i in indexes]
+
+        results = []
+
+        for i, folder in zip(indexes, folders):
+            folder_sync = folder_syncs[i]
+
+            try:
+                new_emails, deleted_uids, read_uids, meta = sync_folder_emails(
+                    account_key, folder_sync['folder'],
+                    query=folder_sync.get('query'),
+                    expected_uid_count=folder_sync.get('uid_count'),
+                    check_unread_uids=folder_sync.get('unread_uids'),
+                    status=folder_name_to_status.get(folder.name),
+                )
+            except Exception as e:
+                logger.warning(f'Failed to sync {folder}: {e}')
+                results.append((i, {'error': str(e)}))
+                continue
+
+            results.append((i, {
+                'new_emails': new_emails,
+                'deleted_uids': deleted_uids,
+                'read_uids': read_uids,
+                'meta': meta,
+            }))
+
+        return results
+
+    account_results = execute_threaded(sync_account_folders, [
+        (account_key, indexes)
+        for account_key, indexes in account_key_to_indexes.items()
+    ])
 
-    account = get_account(account_key)
-    folder = account.get_folder(folder_name)
+    results = [None] * len(folder_syncs)
+    for account_result in account_results:
+        for i, result in account_result:
+            results[i] = {
+                'account': folder_syncs[i]['account'],
+                'folder': folder_syncs[i]['folder'],
+                **result,
+            }
 
-    def get_email_parts(uids, part):
-        email_parts = folder.get_email_parts(uids, part)
-        return (part, email_parts)
+    return results
 
-    items = execute_threaded(get_email_parts, [
-        (uids, part)
-        for part, uids in part_to_uid.items()
-    ])
 
-    emails = defaultdict(dict)
+def _get_folder_email_parts(account_key, folder_name, uid_parts):
+    '''
+    Get email parts (body parts) for a given folder and a given list of
+    (UID, part ID) tuples. These are fetched using a single connection, see
+    `Folder.get_multiple_email_parts`.
+    '''
 
-    for part, email_parts in items:
-        for uid, data in email_parts.items():
-            emails[uid][part] = data
+    account = get_account(account_key)
+    folder = account.get_folder(folder_name)
 
-    return emails
+    return folder.get_multiple_email_parts(uid_parts)
 
 
 def get_folder_email_texts(account_key, folder_name, uids):
@@ -238,9 +595,10 @@ def get_folder_email_texts(account_key, folder_name, uids):
     return uid_part_data_with_cids
 
 
-def get_folder_email_part(account_key, folder_name, uid, part_number):
+def get_folder_email_part_stream(account_key, folder_name, uid, part_number):
     '''
-    Get a specific part for a UID/part number in a given folder.
+    Get a stream of a specific part for a UID/part number in a given folder,
+    large parts are fetched from the server in chunks as the stream is read.
     '''
 
     account = get_account(account_key)
@@ -248,19 +606,11 @@ def get_folder_email_part(account_key, folder_name, uid, part_number):
 
     parts = folder.get_email_headers([uid])[uid]['parts']
     if part_number not in parts:
-        return None, None
-
-    uid_part_data = _get_folder_email_parts(
-        account_key, folder_name,
-        [(uid, part_number)],
-    )
+        return None
 
-    part_struct = parts[part_number]
-
-    return (
-        f'{part_struct["type"]}/{part_struct["subtype"]}'.lower(),
-        uid_part_data[uid][part_number],
-    )
+    stream = EmailPartStream(folder, uid, part_number, parts[part_number])
+    stream.open()
+    return stream
 
 
 def append_folder_email(account_key, folder_name, message):
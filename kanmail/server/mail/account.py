@@ -1,16 +1,30 @@
+from threading import Lock
+from time import time
+
+from imapclient.exceptions import IMAPClientError
+
 from kanmail.log import logger
-from kanmail.server.util import lock_class_method
+from kanmail.server.util import SingleFlight
 from kanmail.settings.constants import ALIAS_FOLDER_NAMES
 
-from .connection import ImapConnectionPool, SmtpConnection
+from .connection import ImapConnectionError, ImapConnectionPool, SmtpConnection
 from .folder import Folder
+from .idle import IdleWatcher
 from .message import make_email_message
+from .query_folder_cache import QueryFolderCache
 
 NOSELECT_FLAG = b'\\Noselect'
 
+# How long to keep folder statuses (see `Account.get_folder_statuses`) for
+FOLDER_STATUS_MAX_AGE = 10
+
 
 class Account(object):
     capabilities = None
+    idle_watcher = None
+
+    # Set if the server claims LIST-STATUS support but it fails
+    list_status_failed = False
 
     def __init__(self, name, settings):
         self.name = name
@@ -33,7 +47,38 @@ class Account(object):
     def reset(self):
         # Map of folder name -> Folder object
         self.folders = {}
-        self.query_folders = {}
+        # Bounded/expiring cache of folder name + query -> Folder object
+        self.query_folders = QueryFolderCache()
+
+        # Folders are created (connect, search, etc) in parallel, except for the
+        # same folder where callers share the one being created.
+        self.folder_flights = SingleFlight()
+        # Identical concurrent syncs of a folder share the one in-flight sync,
+        # keyed by (folder name, query, uid count, unread UIDs).
+        self.sync_flights = SingleFlight()
+
+        # Map of folder name -> (fetched time, generation, status), when the
+        # statuses of all folders were last fetched (using LIST-STATUS) and map of
+        # folder name -> generation invalidated at. The generation increments on
+        # every invalidation, so we know which statuses were fetched before. The
+        # lock is only held to read/update these, never while fetching, and
+        # concurrent fetches are shared.
+        self.folder_statuses = {}
+        self.folder_statuses_listed = 0
+        self.folder_statuses_generation = 0
+        self.folder_statuses_invalidated = {}
+        self.folder_statuses_lock = Lock()
+        self.folder_status_flights = SingleFlight()
+
+    def start_idle_watcher(self):
+        if self.idle_watcher is None:
+            self.idle_watcher = IdleWatcher(self)
+            self.idle_watcher.start()
+
+    def stop_idle_watcher(self):
+        if self.idle_watcher is not None:
+            self.idle_watcher.stop()
+            self.idle_watcher = None
 
     def get_imap_connection(self, *args, **kwargs):
         return self.connection_pool.get_connection(*args, **kwargs)
@@ -49,6 +94,161 @@ class Account(object):
 
         return self.capabilities
 
+    def get_folder_status_keys(self):
+        status_keys = [b'UIDVALIDITY', b'UIDNEXT', b'MESSAGES']
+        if b'CONDSTORE' in self.get_capabilities():
+            status_keys.append(b'HIGHESTMODSEQ')
+
+        return status_keys
+
+    def has_list_status(self):
+        return (
+            not self.list_status_failed
+            and b'LIST-STATUS' in self.get_capabilities()
+        )
+
+    def get_folder_statuses(self, folder_names, max_age=FOLDER_STATUS_MAX_AGE):
+        '''
+        Get the status (UIDVALIDITY, UIDNEXT, MESSAGES and HIGHESTMODSEQ where
+        supported) of multiple folders, reusing statuses fetched in the last
+        `max_age` seconds.
+
+        Where the server supports LIST-STATUS (RFC 5819) the status of every
+        folder is fetched in one command, otherwise each folder is fetched using
+        a single connection. Returns a dict of folder name -> status, without any
+        folders that don't exist or we failed to get the status for.
+        '''
+
+        now = time()
+
+        if self.has_list_status() and now - self.folder_statuses_listed > max_age:
+            self.folder_status_flights.do('all', self.fetch_all_folder_statuses)
+
+        def is_fresh(folder_name):
+            fetched, generation, _ = self.folder_statuses.get(folder_name, (0, 0, None))
+            return (
+                now - fetched <= max_age
+                # Not fetched before the folder was last invalidated
+                and generation >= self.folder_statuses_invalidated.get(folder_name, 0)
+            )
+
+        # Checked again as LIST-STATUS may have failed (and been disabled)
+        has_list_status = self.has_list_status()
+
+        with self.folder_statuses_lock:
+            if has_list_status:
+                # Folders missing from LIST-STATUS don't exist, unless created
+                # (and invalidated) since.
+                stale_folder_names = [
+                    folder_name for folder_name in folder_names
+                    if (
+                        folder_name in self.folder_statuses
+                        or folder_name in self.folder_statuses_invalidated
+                    )
+                    and not is_fresh(folder_name)
+                ]
+            else:
+                stale_folder_names = [
+                    folder_name for folder_name in folder_names
+                    if not is_fresh(folder_name)
+                ]
+
+        if stale_folder_names:
+            stale_folder_names = tuple(sorted(stale_folder_names))
+            self.folder_status_flights.do(
+                stale_folder_names,
+                self.fetch_folder_statuses,
+                stale_folder_names,
+            )
+
+        with self.folder_statuses_lock:
+            return {
+                folder_name: self.folder_statuses[folder_name][2]
+                for folder_name in folder_names
+                if is_fresh(folder_name)
+            }
+
+    def fetch_all_folder_statuses(self):
+        fetched = time()
+        generation = self.folder_statuses_generation
+
+        try:
+            with self.get_imap_connection() as connection:
+                folder_name_to_status = connection.list_folder_statuses(
+                    self.get_folder_status_keys(),
+                )
+        except (ImapConnectionError, IMAPClientError) as e:
+            logger.warning(f'LIST-STATUS failed for {self.name}, disabling: {e}')
+            self.list_status_failed = True
+            return
+
+        with self.folder_statuses_lock:
+            self.folder_statuses = {
+                folder_name: (fetched, generation, status)
+                for folder_name, status in folder_name_to_status.items()
+            }
+            self.folder_statuses_listed = fetched
+            self.forget_folder_invalidations(generation)
+
+    def fetch_folder_statuses(self, folder_names):
+        if not folder_names:
+            return
+
+        fetched = time()
+        generation = self.folder_statuses_generation
+        status_keys = self.get_folder_status_keys()
+        folder_name_to_status = {}
+
+        with self.get_imap_connection() as connection:
+            for folder_name in folder_names:
+                try:
+                    status = connection.folder_status(folder_name, status_keys)
+                # Missing/renamed folders fail with NO - only fail that folder
+                except (ImapConnectionError, IMAPClientError) as e:
+                    logger.warning(f'Failed to get status for {self.name}/{folder_name}: {e}')
+                    continue
+
+                folder_name_to_status[folder_name] = status
+
+        with self.folder_statuses_lock:
+            for folder_name, status in folder_name_to_status.items():
+                self.folder_statuses[folder_name] = (fetched, generation, status)
+            self.forget_folder_invalidations(generation, folder_name_to_status)
+
+    def forget_folder_invalidations(self, generation, folder_names=None):
+        # Invalidations before a fetch started are replaced by its statuses
+        for folder_name, invalidated in list(self.folder_statuses_invalidated.items()):
+            if invalidated <= generation and (
+                folder_names is None or folder_name in folder_names
+            ):
+                self.folder_statuses_invalidated.pop(folder_name)
+
+    def invalidate_folder_status(self, folder_name):
+        '''
+        Invalidate the cached status of a folder we've changed (or been told has
+        changed via IDLE), so the next sync fetches it again. Any in-flight syncs
+        of the folder are forgotten too, as their results may no longer be current.
+        '''
+
+        with self.folder_statuses_lock:
+            self.folder_statuses_generation += 1
+            self.folder_statuses_invalidated[folder_name] = self.folder_statuses_generation
+
+        self.sync_flights.forget(lambda key: key[0] == folder_name)
+
+    def folder_exists(self, folder_name):
+        # LIST-STATUS tells us about all the (selectable) folders
+        if self.has_list_status():
+            folder_name_to_status = self.get_folder_statuses([folder_name])
+
+            # Unless it failed (and was disabled) meanwhile, in which case the
+            # status is missing because STATUS failed, not the folder.
+            if self.has_list_status() or folder_name in folder_name_to_status:
+                return folder_name in folder_name_to_status
+
+        with self.get_imap_connection() as connection:
+            return connection.folder_exists(folder_name)
+
     def get_folders(self):
         '''
         List all available folders for this account.
@@ -84,7 +284,6 @@ class Account(object):
 
         return folder_names
 
-    @lock_class_method  # locked to prevent parallel folder initializations
     def get_folder(self, folder_alias, query=None):
         '''
         Get a Folder object for this account.
@@ -99,17 +298,54 @@ class Account(object):
             folder_name = f'{prefix}{folder_name}'
 
         # Is this a temporary query-based folder?
-        cache = self.query_folders if query else self.folders
-        cache_key = ''.join((folder_name, query)) if query else folder_name
-
-        if cache_key not in cache:
-            cache[cache_key] = Folder(
-                folder_name, folder_alias,
-                account=self,
-                query=query,
+        if query:
+            cache_key = ''.join((folder_name, query))
+
+            return self.query_folders.get(cache_key, lambda: self.folder_flights.do(
+                (folder_name, query),
+                Folder, folder_name, folder_alias, account=self, query=query,
+            ))
+
+        folder = self.folders.get(folder_name)
+        if folder is None:
+            folder = self.folder_flights.do(
+                (folder_name, None),
+                self._make_folder, folder_name, folder_alias,
             )
 
-        return cache[cache_key]
+        return folder
+
+    def _make_folder(self, folder_name, folder_alias):
+        # Another caller may have created the folder since we checked
+        if folder_name not in self.folders:
+            self.folders[folder_name] = Folder(folder_name, folder_alias, account=self)
+
+        return self.folders[folder_name]
+
+    def get_folder_alias(self, folder_name):
+        '''
+        Get the alias (or name without prefix) to pass to `get_folder` for a
+        folder name as on the server.
+        '''
+
+        folder_settings = self.settings['folders']
+        prefix = folder_settings.get('prefix')
+
+        for alias in ALIAS_FOLDER_NAMES:
+            alias_folder_name = folder_settings.get(alias)
+            if not alias_folder_name:
+                continue
+
+            if prefix and alias != 'inbox':
+                alias_folder_name = f'{prefix}{alias_folder_name}'
+
+            if alias_folder_name == folder_name:
+                return alias
+
+        if prefix and folder_name.startswith(prefix):
+            return folder_name[len(prefix):]
+
+        return folder_name
 
     def ensure_folder_exists(self, folder):
         folder = self.get_folder(folder)
@@ -120,6 +356,8 @@ class Account(object):
             with self.get_imap_connection() as connection:
                 connection.create_folder(folder.name)
 
+            self.invalidate_folder_status(folder.name)
+
             folder.get_and_set_email_uids()
 
         return folder.name
@@ -2,15 +2,18 @@ import ssl
 
 from base64 import b64encode
 from contextlib import contextmanager
-from queue import LifoQueue
 from socket import error as socket_error
+from threading import Condition, Event, Thread
 from time import time
 
 from imapclient import IMAPClient
 from imapclient.exceptions import IMAPClientAbortError, IMAPClientError, LoginError
+from imapclient.imap_utf7 import decode as decode_utf7
+from imapclient.response_parser import parse_response
 
 from kanmail.log import logger
 from kanmail.secrets import get_password, set_password
+from kanmail.settings import get_system_setting
 from kanmail.settings.constants import DEBUG_SMTP
 
 from .oauth import get_oauth_tokens_from_refresh_token, invalidate_access_token
@@ -18,8 +21,14 @@ from .smtp import SMTP, SMTP_SSL
 
 DEFAULT_ATTEMPTS = 3
 DEFAULT_CONNECTIONS = 10
+DEFAULT_MIN_CONNECTIONS = 2
 DEFAULT_TIMEOUT = 10
 
+# How often the pool manager pings (NOOP) idle connections
+POOL_CHECK_INTERVAL = 120
+# Close connections, above the pool minimum, idle for longer than this
+POOL_IDLE_TIMEOUT = 600
+
 
 class ConnectionSettingsError(ValueError):
     account = None
@@ -37,9 +46,30 @@ class ImapConnectionError(OSError):
         super().__init__(*args, **kwargs)
 
 
+def parse_status_responses(data):
+    '''
+    Parse untagged STATUS responses (ie from LIST-STATUS) into a dict of
+    folder name -> status.
+    '''
+
+    parsed = parse_response([item for item in data if item not in (b'', None)])
+
+    folder_name_to_status = {}
+    for i in range(0, len(parsed) - 1, 2):
+        name, status_items = parsed[i:i + 2]
+        name = str(name) if isinstance(name, int) else decode_utf7(name)
+        folder_name_to_status[name] = {
+            status_items[j]: status_items[j + 1]
+            for j in range(0, len(status_items), 2)
+        }
+
+    return folder_name_to_status
+
+
 class ImapConnectionWrapper(object):
     _imap = None
     _selected_folder = None
+    _selected_readonly = False
 
     def __init__(self, config):
         self.config = config
@@ -90,6 +120,31 @@ class ImapConnectionWrapper(object):
 
         return wrapper
 
+    @property
+    def is_connected(self):
+        return self._imap is not None
+
+    def check(self):
+        '''
+        NOOP the underlying client directly (skipping the reconnect/retry in
+        `__getattr__`) to check the connection is still alive.
+        '''
+
+        self._imap.noop()
+
+    def close(self):
+        if self._imap is None:
+            return
+
+        imap = self._imap
+        self._imap = None
+        self._selected_folder = None
+
+        try:
+            imap.logout()
+        except Exception as e:
+            self.config.log('debug', f'Failed to logout of IMAP connection: {e}')
+
     def try_make_imap(self):
         try:
             self.make_imap()
@@ -130,19 +185,98 @@ class ImapConnectionWrapper(object):
         else:
             imap.login(self.config.username, self.config.password)
 
-        if self._selected_folder:
-            imap.select_folder(self._selected_folder)
-
         # Ensure the IMAP object has capabilities cached as this is used internally
         # within imapclient.
-        imap.capabilities()
+        capabilities = imap.capabilities()
+
+        # Enable QRESYNC so we receive VANISHED responses when fetching changes
+        # (see Folder.get_modseq_changes), this must happen before any select.
+        if b'QRESYNC' in capabilities and b'ENABLE' in capabilities:
+            imap.enable('QRESYNC')
+
+        if self._selected_folder:
+            imap.select_folder(self._selected_folder, readonly=self._selected_readonly)
 
         self._imap = imap
         self.config.log('info', f'Connected to IMAP server: {server_string}')
 
-    def set_selected_folder(self, selected_folder):
-        self.select_folder(selected_folder)
+    def pop_untagged_responses(self, key):
+        '''
+        Pop any untagged responses of a given type (eg VANISHED) that imapclient
+        does not parse itself.
+        '''
+
+        if self._imap is None:
+            return []
+
+        return self._imap._imap.untagged_responses.pop(key, [])
+
+    def list_folder_statuses(self, status_keys):
+        '''
+        Get the status of all folders in one command using LIST-STATUS (RFC 5819),
+        which imapclient does not support itself.
+        '''
+
+        if self._imap is None:
+            self.try_make_imap()
+
+        status_items = ' '.join(
+            key.decode() if isinstance(key, bytes) else key
+            for key in status_keys
+        )
+
+        imap = self._imap._imap
+        imap.untagged_responses.pop('STATUS', None)
+
+        typ, data = imap._simple_command(
+            'LIST', '""', '"*"', 'RETURN', f'(STATUS ({status_items}))',
+        )
+        self._imap._checkok('list', typ, data)
+
+        imap.untagged_responses.pop('LIST', None)
+        return parse_status_responses(imap.untagged_responses.pop('STATUS', []))
+
+    def fetch_many(self, requests):
+        '''
+        Run multiple fetches, a list of (messages, data) tuples, one after another
+        on this connection.
+        '''
+
+        return [self.fetch(*request) for request in requests]
+
+    def clear_untagged_responses(self):
+        '''
+        Drop any untagged responses left over from previous commands, these
+        otherwise accumulate while a folder stays selected.
+        '''
+
+        if self._imap is None:
+            return
+
+        self._imap._imap.untagged_responses.clear()
+
+    def is_selected(self, selected_folder, readonly=False):
+        return (
+            self._selected_folder == selected_folder
+            and self._selected_readonly == readonly
+        )
+
+    def set_selected_folder(self, selected_folder, readonly=False):
+        '''
+        Select (or EXAMINE when readonly) a folder, unless it is already
+        selected in the same mode on this connection.
+        '''
+
+        if self.is_connected and self.is_selected(selected_folder, readonly):
+            return False
+
+        # A failed select leaves no folder selected
+        self._selected_folder = None
+
+        self.select_folder(selected_folder, readonly=readonly)
         self._selected_folder = selected_folder
+        self._selected_readonly = readonly
+        return True
 
     def unset_selected_folder(self):
         if self._selected_folder is None:
@@ -150,6 +284,7 @@ class ImapConnectionWrapper(object):
 
         self.unselect_folder()
         self._selected_folder = None
+        self._selected_readonly = False
 
 
 class ConnectionMixin(object):
@@ -203,8 +338,43 @@ class ConnectionMixin(object):
             )
 
 
+class ImapConnectionPoolManager(Thread):
+    '''
+    Background thread that keeps a pool warm: connects up to the pool minimum,
+    pings idle connections so dead sockets are found before a request uses
+    them and closes connections idle beyond the timeout.
+    '''
+
+    def __init__(self, pool):
+        super().__init__(daemon=True, name=f'ImapConnectionPoolManager({pool.account})')
+
+        self.pool = pool
+        self.stopped = Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def should_warm_up(self):
+        # Starting offline (from the cache), so don't connect until the pool
+        # is first used.
+        return not get_system_setting('offline_startup') or self.pool.acquire_count > 0
+
+    def run(self):
+        if self.should_warm_up():
+            self.pool.warm_up()
+
+        while not self.stopped.wait(self.pool.check_interval):
+            try:
+                self.pool.check_idle_connections()
+                if self.should_warm_up():
+                    self.pool.warm_up()
+            except Exception as e:
+                self.pool.log('warning', f'Failed to check connection pool: {e}')
+
+
 class ImapConnectionPool(ConnectionMixin):
     connection_type = 'IMAP'
+    manager = None
 
     def __init__(
         self,
@@ -218,8 +388,11 @@ class ImapConnectionPool(ConnectionMixin):
         ssl=True,
         ssl_verify_hostname=True,
         timeout=DEFAULT_TIMEOUT,
+        min_connections=DEFAULT_MIN_CONNECTIONS,
         max_connections=DEFAULT_CONNECTIONS,
         max_attempts=DEFAULT_ATTEMPTS,
+        check_interval=POOL_CHECK_INTERVAL,
+        idle_timeout=POOL_IDLE_TIMEOUT,
     ):
         self.account = account
         self.host = host
@@ -232,35 +405,238 @@ class ImapConnectionPool(ConnectionMixin):
         self.ssl_verify_hostname = ssl_verify_hostname
         self.timeout = timeout
         self.max_attempts = max_attempts
+        self.min_connections = min(min_connections, max_connections)
+        self.max_connections = max_connections
+        self.check_interval = check_interval
+        self.idle_timeout = idle_timeout
+
+        self.condition = Condition()
+        # List of (connection, idle since) tuples, most recently used last
+        self.idle_connections = []
+        # Number of connections either idle, in use or being checked
+        self.total_connections = 0
+        self.in_use_connections = 0
+        self.waiting = 0
+
+        self.acquire_count = 0
+        self.reused_selected_count = 0
+        self.wait_count = 0
+        self.total_wait_time = 0
+        self.max_wait_time = 0
+
+    def start_manager(self):
+        if self.manager is None:
+            self.manager = ImapConnectionPoolManager(self)
+            self.manager.start()
+
+    def stop_manager(self):
+        if self.manager is not None:
+            self.manager.stop()
+            self.manager = None
+
+        with self.condition:
+            idle_connections = self.idle_connections
+            self.idle_connections = []
+            self.total_connections -= len(idle_connections)
+
+        for connection, _ in idle_connections:
+            connection.close()
+
+    def _pop_idle_connection(self, selected_folder, readonly):
+        # Prefer the most recently used connection with the folder already
+        # selected, saving a SELECT (and previously UNSELECT) round trip.
+        if selected_folder:
+            for i in range(len(self.idle_connections) - 1, -1, -1):
+                connection = self.idle_connections[i][0]
+                if connection.is_connected and connection.is_selected(selected_folder, readonly):
+                    self.reused_selected_count += 1
+                    return self.idle_connections.pop(i)[0]
+
+        return self.idle_connections.pop()[0]
+
+    def _acquire(self, selected_folder=None, readonly=False):
+        start = time()
+
+        with self.condition:
+            waited = False
+
+            while True:
+                if self.idle_connections:
+                    connection = self._pop_idle_connection(selected_folder, readonly)
+                    break
+
+                # Grow the pool on demand up to the maximum
+                if self.total_connections < self.max_connections:
+                    connection = ImapConnectionWrapper(self)
+                    self.total_connections += 1
+                    break
 
-        self.pool = LifoQueue()
+                waited = True
+                self.waiting += 1
+                self.condition.wait()
+                self.waiting -= 1
 
-        # Push/start all the connections
-        for _ in range(max_connections):
-            self.pool.put(ImapConnectionWrapper(self))
+            self.in_use_connections += 1
+
+            took = time() - start
+            self.acquire_count += 1
+            if waited:
+                self.wait_count += 1
+            self.total_wait_time += took
+            self.max_wait_time = max(self.max_wait_time, took)
+
+            self.log('debug', (
+                f'Got connection from pool: {len(self.idle_connections)} idle, '
+                f'{self.in_use_connections} in use'
+            ))
+
+        return connection
+
+    def _release(self, connection, in_use=True):
+        with self.condition:
+            if in_use:
+                self.in_use_connections -= 1
+
+            self.idle_connections.append((connection, time()))
+            self.condition.notify()
+
+    def _discard(self, connection, in_use=False):
+        with self.condition:
+            if in_use:
+                self.in_use_connections -= 1
+
+            self.total_connections -= 1
+            self.condition.notify()
+
+        connection.close()
 
     @contextmanager
-    def get_connection(self, selected_folder=None):
+    def get_connection(self, selected_folder=None, readonly=False):
+        '''
+        Get a connection from the pool, optionally with a folder selected. Folders
+        are left selected when connections are returned so the next request for
+        the same folder can skip the SELECT.
+        '''
+
         self.check_auth_settings()
 
-        connection = self.pool.get()
-        self.log('debug', f'Got connection from pool: {self.pool.qsize()} (-1)')
+        connection = self._acquire(selected_folder, readonly)
 
         try:
             if selected_folder:
-                connection.set_selected_folder(selected_folder)
+                if not connection.set_selected_folder(selected_folder, readonly=readonly):
+                    connection.clear_untagged_responses()
 
             yield connection
 
         finally:
-            try:
-                if selected_folder:
-                    connection.unset_selected_folder()
-            except Exception:
-                self.log('warning', 'Failed to unselect folder!')
+            self._release(connection)
+            self.log('debug', 'Returned connection to pool')
 
-            self.pool.put(connection)
-            self.log('debug', f'Returned connection to pool: {self.pool.qsize()} (+1)')
+    def warm_up(self):
+        '''
+        Connect new connections until the pool has the minimum number.
+        '''
+
+        try:
+            self.check_auth_settings()
+        except ConnectionSettingsError as e:
+            self.log('warning', f'Not warming up connection pool: {e}')
+            return
+
+        while True:
+            with self.condition:
+                connected_count = self.in_use_connections + sum(
+                    1 for connection, _ in self.idle_connections
+                    if connection.is_connected
+                )
+                if (
+                    connected_count >= self.min_connections
+                    or self.total_connections >= self.max_connections
+                ):
+                    return
+
+                connection = ImapConnectionWrapper(self)
+                self.total_connections += 1
+
+            try:
+                connection.try_make_imap()
+            except ImapConnectionError as e:
+                self.log('warning', f'Failed to warm up connection: {e}')
+                self._discard(connection)
+                return
+
+            self._release(connection, in_use=False)
+
+    def check_idle_connections(self):
+        '''
+        Close connections (above the minimum) that have been idle for too long
+        and NOOP the rest, dropping any that fail.
+        '''
+
+        now = time()
+        to_close = []
+        to_check = []
+
+        with self.condition:
+            keep_count = self.total_connections
+            idle_connections = []
+
+            # Oldest first, so we close the least recently used connections
+            for connection, idle_since in self.idle_connections:
+                if (
+                    now - idle_since > self.idle_timeout
+                    and keep_count > self.min_connections
+                ):
+                    to_close.append(connection)
+                    keep_count -= 1
+                elif connection.is_connected:
+                    to_check.append((connection, idle_since))
+                else:
+                    idle_connections.append((connection, idle_since))
+
+            self.idle_connections = idle_connections
+            self.total_connections -= len(to_close)
+
+        if to_close:
+            self.log('debug', f'Closing {len(to_close)} idle connections')
+
+        for connection in to_close:
+            connection.close()
+
+        for connection, idle_since in to_check:
+            try:
+                connection.check()
+            except Exception as e:
+                self.log('info', f'Dropping dead idle connection: {e}')
+                self._discard(connection)
+                continue
+
+            with self.condition:
+                self.idle_connections.append((connection, idle_since))
+                # Keep the list ordered by idle time for the above
+                self.idle_connections.sort(key=lambda item: item[1])
+                self.condition.notify()
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                'min_connections': self.min_connections,
+                'max_connections': self.max_connections,
+                'total': self.total_connections,
+                'in_use': self.in_use_connections,
+                'idle': len(self.idle_connections),
+                'idle_connected': sum(
+                    1 for connection, _ in self.idle_connections
+                    if connection.is_connected
+                ),
+                'waiting': self.waiting,
+                'acquired': self.acquire_count,
+                'reused_selected': self.reused_selected_count,
+                'waited': self.wait_count,
+                'total_wait_ms': round(self.total_wait_time * 1000, 2),
+                'max_wait_ms': round(self.max_wait_time * 1000, 2),
+            }
 
 
 def _generate_smtp_oauth2_string(username, access_token):
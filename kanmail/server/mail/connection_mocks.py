@@ -190,6 +190,8 @@ class FakeIMAPClient(object):
         logger.debug(f'Creating fake IMAP: ({args}, {kwargs})')
 
         self._imap_host = imap_host
+        # Mirror the underlying imaplib client's untagged responses
+        self._imap = MagicMock(untagged_responses={})
 
         for folder in ALIAS_FOLDERS + OTHER_FOLDERS:
             self._ensure_folder(folder)
@@ -227,7 +229,7 @@ class FakeIMAPClient(object):
         random_sleep()
         return True
 
-    def select_folder(self, folder_name):
+    def select_folder(self, folder_name, readonly=False):
         random_sleep()
         self._current_folder = self._ensure_folder(folder_name)
 
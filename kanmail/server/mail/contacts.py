@@ -2,6 +2,7 @@ from functools import lru_cache
 
 from kanmail.log import logger
 from kanmail.server.app import db
+from kanmail.server.db_writer import execute_write
 from kanmail.server.util import lock_function
 
 
@@ -63,6 +64,11 @@ def save_contacts(*contacts):
     get_contacts.cache_clear()
 
 
+def _insert_contacts(connection, contact_values):
+    # Ignore duplicates - another add may have been queued before this one
+    connection.execute(Contact.__table__.insert().prefix_with('OR IGNORE'), contact_values)
+
+
 def delete_contact(contact):
     logger.debug(f'Deleting contact: {contact}')
 
@@ -107,7 +113,14 @@ def add_contacts(contacts):
             logger.debug(f'Already have contact: ({name} {email})')
             continue
 
-        new_contact = Contact(name=name, email=email)
-        contacts_to_save.append(new_contact)
+        contacts_to_save.append({'name': name, 'email': email})
+
+    if not contacts_to_save:
+        return
+
+    logger.debug(f'Queueing {len(contacts_to_save)} contacts to save')
 
-    save_contacts(*contacts_to_save)
+    # Contacts aren't needed immediately so don't wait for the write, clearing the
+    # cache once committed (clearing before could re-cache the old contacts).
+    future = execute_write('contacts', _insert_contacts, contacts_to_save, wait=False)
+    future.add_done_callback(lambda future: get_contacts.cache_clear())
@@ -1,5 +1,8 @@
+from collections import defaultdict
 from contextlib import contextmanager
 from datetime import date, timedelta
+from itertools import islice
+from threading import Thread
 
 from imapclient.exceptions import IMAPClientError
 
@@ -12,6 +15,7 @@ from .connection import ImapConnectionError
 from .contacts import add_contacts
 from .fixes import fix_email_uids, fix_missing_uids
 from .folder_cache import FolderCache
+from .uid_set import UidSet
 from .util import decode_string, make_email_headers, parse_bodystructure
 
 SEEN_FLAG = b'\\Seen'
@@ -36,6 +40,24 @@ class Folder(object):
     # Whether this folder exists on the server
     exists = None
 
+    # Whether an IDLE watcher is currently pushing changes for this folder, and
+    # whether it has seen any changes since our last sync.
+    idle_watched = False
+    idle_changed = True
+
+    # UIDs ordered best match first, where searched via the local index
+    ranked_email_uids = None
+
+    # Whether our UIDs were loaded from the cache and not yet synced with the
+    # server, and any changes found when reconciling in the background (returned
+    # by the next `sync_emails`).
+    stale = False
+    reconcile_thread = None
+    reconciled_changes = None
+
+    # The (UIDNEXT, MESSAGES) status as of our last sync with the server
+    synced_status = None
+
     def __init__(self, name, alias_name, account, query=None):
         self.name = name
         self.alias_name = alias_name
@@ -52,18 +74,25 @@ class Folder(object):
             self.cache = FolderCache(self)
 
         # If we don't exist, our UID list is empty
-        self.email_uids = set()
+        self.email_uids = UidSet()
         # Set of UIDs we've "seen" - ie ones not to return again
-        self.seen_email_uids = set()
+        self.seen_email_uids = UidSet()
+
+        # Offline first - use any cached UIDs without waiting for the server,
+        # reconciling in the background once the first emails are read. Query
+        # folders always start with any local search index matches, merging in
+        # the server search results the same way.
+        if (
+            (self.query or get_system_setting('offline_startup'))
+            and self.hydrate_from_cache()
+        ):
+            return
 
         try:
             if self.check_exists():
                 self.get_and_set_email_uids()
         except (ImapConnectionError, IMAPClientError):
-            cached_uids = self.get_cached_uids()
-            if cached_uids:
-                self.exists = True
-                self.email_uids = cached_uids
+            self.hydrate_from_cache()
 
     def __str__(self):
         return f'Folder({self.account.name}/{self.name})'
@@ -78,8 +107,7 @@ class Folder(object):
         Check whether this folder exists on the server.
         '''
 
-        with self.account.get_imap_connection() as connection:
-            exists = connection.folder_exists(self.name)
+        exists = self.account.folder_exists(self.name)
 
         self.exists = exists
         return exists
@@ -88,6 +116,15 @@ class Folder(object):
         func = getattr(logger, method)
         func(f'[{self}]: {message}')
 
+    def set_idle_watched(self, idle_watched):
+        self.idle_watched = idle_watched
+        # Anything may have changed while we weren't watching
+        self.idle_changed = True
+
+    def set_idle_changed(self):
+        self.idle_changed = True
+        self.account.invalidate_folder_status(self.name)
+
     @contextmanager
     def get_connection(self):
         '''
@@ -97,89 +134,169 @@ class Folder(object):
         with self.account.get_imap_connection(selected_folder=self.name) as connection:
             yield connection
 
-    @lock_class_method  # prevent parallel writes to the same UID (TODO? lock by uid arg)
-    def add_cache_flags(self, uid, new_flag):
-        headers = self.cache.get_headers(uid)
-
-        if headers and new_flag not in headers['flags']:
-            flags = list(headers['flags'])
-            flags.append(new_flag)
-            headers['flags'] = tuple(flags)
-            self.cache.set_headers(uid, headers)
+    # No locking needed - cache writes are serialized by the database writer and
+    # flag updates are applied in SQL rather than read-modify-write here.
+    def add_cache_flags(self, uids, new_flag):
+        self.cache.batch_add_flags(uids, new_flag)
 
-    @lock_class_method  # prevent parallel writes to the same UID (TODO? lock by uid arg)
-    def remove_cache_flags(self, uid, remove_flag):
-        headers = self.cache.get_headers(uid)
-
-        if headers and remove_flag in headers['flags']:
-            flags = list(headers['flags'])
-            flags.remove(remove_flag)
-            headers['flags'] = tuple(flags)
-            self.cache.set_headers(uid, headers)
+    def remove_cache_flags(self, uids, remove_flag):
+        self.cache.batch_remove_flags(uids, remove_flag)
 
     def get_email_parts(self, email_uids, part, retry=0):
         '''
         Fetch actual email body parts, where the part is the same for each email.
         '''
 
-        self.log('debug', f'Fetching {len(email_uids)} message parts ({part})')
+        uid_to_parts = self.get_multiple_email_parts(
+            [(uid, part) for uid in email_uids],
+            retry=retry,
+        )
+
+        return {
+            uid: parts[part]
+            for uid, parts in uid_to_parts.items()
+            if part in parts
+        }
+
+    def get_multiple_email_parts(self, uid_parts, retry=0):
+        '''
+        Fetch email body parts for a list of (UID, part number) tuples, returning
+        a dict of UID -> part number -> data.
+
+        Emails missing the same set of parts are fetched together (one FETCH can
+        request multiple parts of the same messages), and all the fetches are
+        made one after another on a single connection.
+        '''
+
+        part_to_uids = defaultdict(list)
+        for uid, part in uid_parts:
+            part_to_uids[part].append(uid)
+
+        emails = defaultdict(dict)
+        uid_to_missing_parts = defaultdict(set)
 
-        body_keyname = f'BODY[{part}]'
+        for part, uids in part_to_uids.items():
+            uid_to_cached_data = self.cache.batch_get_parts(uids, part)
+
+            for uid in uids:
+                if uid in uid_to_cached_data:
+                    emails[uid][part] = uid_to_cached_data[uid]
+                else:
+                    uid_to_missing_parts[uid].add(part)
+
+        uid_to_headers = self.get_email_headers(list({uid for uid, _ in uid_parts}))
+
+        # Fetching parts from the server marks them as read, so do the same for
+        # any unread emails we have the parts cached for.
+        unread_cached_uids = [
+            uid for uid in emails
+            if uid not in uid_to_missing_parts
+            and uid in uid_to_headers
+            and SEEN_FLAG not in uid_to_headers[uid]['flags']
+        ]
+
+        # Make map of (part numbers) -> UIDs, each is one FETCH
+        parts_to_uids = defaultdict(list)
+        for uid, parts in uid_to_missing_parts.items():
+            parts_to_uids[tuple(sorted(parts))].append(uid)
+
+        fetches = [
+            (uids, [f'BODY[{part}]' for part in parts])
+            for parts, uids in parts_to_uids.items()
+        ]
+
+        if not unread_cached_uids and not fetches:
+            return emails
+
+        if fetches:
+            self.log('debug', (
+                f'Fetching {len(uid_to_missing_parts)} message parts in {len(fetches)} '
+                f'fetches (+{len(emails)} cached)'
+            ))
 
         with self.get_connection() as connection:
-            email_parts = connection.fetch(email_uids, [body_keyname])
+            if unread_cached_uids:
+                connection.add_flags(unread_cached_uids, [SEEN_FLAG])
 
-        # Fix any dodgy UIDs
-        email_parts = fix_email_uids(email_uids, email_parts)
+            fetch_responses = connection.fetch_many(fetches) if fetches else []
+            max_attempts = connection.config.max_attempts
 
-        self.log('debug', f'Fetched {len(email_uids)} email parts ({part})')
+        seen_uids = set(unread_cached_uids)
+        part_to_fetched_data = defaultdict(dict)
+        failed_uid_parts = []
 
-        emails = {}
-        failed_email_uids = []
-        body_keyname = body_keyname.encode()  # returned as bytes via IMAP
+        for (uids, _), email_parts in zip(fetches, fetch_responses):
+            # Fix any dodgy UIDs
+            email_parts = fix_email_uids(uids, email_parts)
 
-        uid_to_parts = {
-            uid: headers['parts']
-            for uid, headers in self.get_email_headers(email_uids).items()
-        }
+            for uid, data in email_parts.items():
+                parts = uid_to_headers.get(uid, {}).get('parts', {})
 
-        for uid, data in email_parts.items():
-            parts = uid_to_parts.get(uid, {})
-            data_meta = parts.get(part)
+                for part in uid_to_missing_parts.get(uid, ()):
+                    data_meta = parts.get(part)
 
-            if not data_meta:
-                message = f'Unknown part uid={uid}, part={part}, knownParts={parts}'
-                if DEBUG:
-                    raise FolderError(message)
-                else:
-                    self.log('warning', message)
+                    if not data_meta:
+                        message = f'Unknown part uid={uid}, part={part}, knownParts={parts}'
+                        if DEBUG:
+                            raise FolderError(message)
+                        else:
+                            self.log('warning', message)
+
+                    body_keyname = f'BODY[{part}]'.encode()  # returned as bytes via IMAP
 
-            if body_keyname not in data:
-                if retry > connection.config.max_attempts:
-                    raise FolderError(f'Missing data for UID/part {uid}/{part}')
+                    if body_keyname not in data:
+                        if retry > max_attempts:
+                            raise FolderError(f'Missing data for UID/part {uid}/{part}')
 
-                failed_email_uids.append(uid)
-                continue
+                        failed_uid_parts.append((uid, part))
+                        continue
 
-            data = data[body_keyname]
-            if data is not None:
-                data = decode_string(data, data_meta, as_str=False)
+                    part_data = data[body_keyname]
+                    if part_data is not None:
+                        part_data = decode_string(part_data, data_meta, as_str=False)
+                        part_to_fetched_data[part][uid] = part_data
 
-            emails[uid] = data
+                    emails[uid][part] = part_data
+                    seen_uids.add(uid)
 
-            self.add_cache_flags(uid, SEEN_FLAG)
+        self.log('debug', f'Fetched {len(uid_to_missing_parts)} message parts')
 
-        if failed_email_uids:
+        self.add_cache_flags(list(seen_uids), SEEN_FLAG)
+        for part, uid_to_fetched_data in part_to_fetched_data.items():
+            self.cache.batch_set_parts(part, uid_to_fetched_data)
+
+        if failed_uid_parts:
             self.log(
                 'warning',
-                f'Missing {len(failed_email_uids)} parts (part={part}, retry={retry})',
+                f'Missing {len(failed_uid_parts)} parts (retry={retry})',
             )
-            emails.update(self.get_email_parts(
-                failed_email_uids, part,
+            for uid, parts in self.get_multiple_email_parts(
+                failed_uid_parts,
                 retry=retry + 1,
-            ))
+            ).items():
+                emails[uid].update(parts)
+
         return emails
 
+    def get_email_part_range(self, uid, part, offset, length):
+        '''
+        Fetch a range of the raw (encoded) data of an email part, without
+        setting the seen flag. Returns less than length bytes at the end of the
+        part (see part_stream.EmailPartStream).
+        '''
+
+        with self.get_connection() as connection:
+            email_parts = connection.fetch([uid], [f'BODY.PEEK[{part}]<{offset}.{length}>'])
+
+        data = email_parts.get(uid, {}).get(f'BODY[{part}]<{offset}>'.encode())
+        if data is None:
+            return b''
+
+        if isinstance(data, str):
+            data = data.encode()
+
+        return data
+
     def get_email_headers(self, email_uids):
         '''
         Fetch email headers/meta information (to display in a folder list).
@@ -189,14 +306,10 @@ class Folder(object):
 
         # First get/remove any cached headers before fetching
         uids_to_get = []
+        # Note: the account/folder names of cached headers are always set from
+        # this folder (see folder_cache.make_headers), so renamed accounts match.
         uid_to_cached_headers = self.cache.batch_get_headers(email_uids)
 
-        # When an account display name is changed, the underlying headers do not
-        # as they are cached by account user/host names. So simply overwrite the
-        # account_name value.
-        for cached_header in uid_to_cached_headers.values():
-            cached_header['account_name'] = self.account.name
-
         for uid in email_uids:
             cached_headers = uid_to_cached_headers.get(uid)
             if cached_headers:
@@ -254,6 +367,13 @@ class Folder(object):
 
         return emails
 
+    def set_cache_flags(self, uid_to_flags):
+        '''
+        Overwrite the cached flags for any cached headers of the given UIDs.
+        '''
+
+        self.cache.batch_set_flags(uid_to_flags)
+
     def check_update_unread_emails(self, email_uids):
         self.log(
             'debug',
@@ -268,13 +388,69 @@ class Folder(object):
             # For any seen emails, update cache and add to the list
             if SEEN_FLAG in data[b'FLAGS']:
                 read_uids.append(uid)
-                self.add_cache_flags(uid, SEEN_FLAG)
+
+        self.add_cache_flags(read_uids, SEEN_FLAG)
 
         return read_uids
 
     # UID handling
     #
 
+    def hydrate_from_cache(self):
+        cached_uids = self.get_cached_uids()
+        if not cached_uids:
+            return False
+
+        self.exists = True
+        self.email_uids = cached_uids
+        self.stale = True
+        return True
+
+    @lock_class_method
+    def start_reconcile(self):
+        if self.stale and self.reconcile_thread is None:
+            self.reconcile_thread = Thread(
+                target=self.reconcile,
+                daemon=True,
+                name=f'Reconcile({self})',
+            )
+            self.reconcile_thread.start()
+
+    @lock_class_method
+    def reconcile(self):
+        '''
+        Sync a stale (hydrated from the cache) folder with the server, keeping
+        the changes for the next `sync_emails` call.
+        '''
+
+        if not self.stale:
+            return
+
+        try:
+            new_emails, deleted_uids, _ = self.sync_server_emails()
+        except (ImapConnectionError, IMAPClientError) as e:
+            self.log('warning', f'Failed to reconcile with server: {e}')
+
+            try:
+                exists = self.check_exists()
+            except (ImapConnectionError, IMAPClientError):
+                exists = True
+
+            # Try again next time emails are read
+            if exists:
+                self.reconcile_thread = None
+                return
+
+            # The folder has been deleted on the server, all our UIDs are gone
+            self.log('warning', 'Folder no longer exists on the server')
+            new_emails, deleted_uids = [], list(self.email_uids)
+            self.email_uids = UidSet()
+            if not self.query:
+                self.cache.bust()
+
+        self.reconciled_changes = (new_emails, deleted_uids)
+        self.stale = False
+
     def cache_uids(self):
         # If we're a query folder don't save the UIDs as we use the base, non-query
         # cache object to share header/part cache, but the UID lists differ.
@@ -282,7 +458,10 @@ class Folder(object):
             self.cache.set_uids(self.email_uids)
 
     def get_cached_uids(self):
-        # If we're not a query folder we can try for cached UIDs
+        # Query folders share the base folder cache, so search that instead
+        if self.query:
+            return self.get_search_index_uids()
+
         cached_uids = self.cache.get_uids()
         if cached_uids:
             self.log(
@@ -291,7 +470,17 @@ class Folder(object):
             )
             return cached_uids
 
+    def get_search_index_uids(self):
+        ranked_uids = self.cache.search_uids(self.query)
+        if ranked_uids:
+            self.log('debug', f'Found {len(ranked_uids)} message IDs in search index')
+            self.ranked_email_uids = ranked_uids
+            return UidSet(ranked_uids)
+
     def get_email_uids(self, use_cache=True):
+        # Query folders always search on the server as the local index only
+        # covers cached emails (see below). Syncs (use_cache=False) always hit
+        # the server.
         if use_cache and not self.query:
             cached_uids = self.get_cached_uids()
             if cached_uids:
@@ -327,18 +516,98 @@ class Folder(object):
 
         self.log('debug', f'Fetched {len(message_uids)} message UIDs')
 
-        uids = set(message_uids)
-        return uids
+        message_uids = UidSet(message_uids)
+
+        # Merge in any matches from the local search index, which are also
+        # ranked first (see iter_email_uids).
+        if self.query:
+            index_uids = self.get_search_index_uids()
+            if index_uids:
+                message_uids = message_uids | index_uids
 
-    def check_cache_validity(self):
+        return message_uids
+
+    def get_folder_status(self):
         '''
-        Checks if our cached UID validity matches the server.
+        Get the UIDVALIDITY, UIDNEXT, MESSAGES (and HIGHESTMODSEQ where CONDSTORE
+        is supported) for this folder, via the account folder status cache.
         '''
 
+        status = self.account.get_folder_statuses([self.name]).get(self.name)
+        if status is not None:
+            return status
+
+        status_keys = self.account.get_folder_status_keys()
+
         # Note we don't use self.get_connection because we don't want to actually
         # *select* the folder.
         with self.account.get_imap_connection() as connection:
-            status = connection.folder_status(self.name, [b'UIDVALIDITY'])
+            return connection.folder_status(self.name, status_keys)
+
+    def get_modseq_changes(self, status):
+        '''
+        Use CONDSTORE/QRESYNC to get the UIDs and flag changes since our last sync
+        without searching the whole folder.
+
+        Returns a tuple of (message UIDs, UID -> changed flags), or `None` if a
+        full UID diff is required.
+        '''
+
+        # Query folders share the base folder cache (and so it's modseq) and date
+        # limited syncs don't include all the UIDs QRESYNC will tell us about.
+        if self.query or get_system_setting('sync_days'):
+            return
+
+        remote_modseq = status.get(b'HIGHESTMODSEQ')
+        cache_modseq = self.cache.get_highest_modseq()
+
+        if not remote_modseq or not cache_modseq:
+            return
+
+        # Nothing has changed in the folder since our last sync
+        if remote_modseq == cache_modseq:
+            return self.email_uids.copy(), {}
+
+        # Without QRESYNC we can't get expunged UIDs, so do a full diff
+        if b'QRESYNC' not in self.account.get_capabilities():
+            return
+
+        self.log('debug', f'Fetching changes since modseq {cache_modseq}')
+
+        with self.get_connection() as connection:
+            connection.pop_untagged_responses('VANISHED')  # clear any stale responses
+            email_flags = connection.fetch('1:*', ['FLAGS'], modifiers=[
+                f'CHANGEDSINCE {cache_modseq}',
+                'VANISHED',
+            ])
+            vanished_responses = connection.pop_untagged_responses('VANISHED')
+
+        vanished_uids = UidSet()
+        for response in vanished_responses:
+            if isinstance(response, bytes):
+                response = response.decode()
+            response = response.replace('(EARLIER)', '')
+            vanished_uids.update(UidSet.from_sequence_set(response))
+
+        self.log('debug', (
+            f'Fetched {len(email_flags)} changed'
+            f'/{len(vanished_uids)} vanished message IDs'
+        ))
+
+        message_uids = (self.email_uids | email_flags.keys()) - vanished_uids
+        uid_to_flags = {
+            uid: data[b'FLAGS']
+            for uid, data in email_flags.items()
+        }
+        return message_uids, uid_to_flags
+
+    def check_cache_validity(self, status=None):
+        '''
+        Checks if our cached UID validity matches the server.
+        '''
+
+        if status is None:
+            status = self.get_folder_status()
 
         uid_validity = status[b'UIDVALIDITY']
         cache_validity = self.cache.get_uid_validity()
@@ -362,9 +631,51 @@ class Folder(object):
         self.email_uids = self.get_email_uids()
 
     @lock_class_method
-    def sync_emails(self, expected_uid_count=None, check_unread_uids=None):
+    def refresh_email_uids(self):
+        '''
+        Re-fetch our UIDs from the server (used to refresh cached query folders).
+        '''
+
+        if self.exists or self.check_exists():
+            self.email_uids = self.get_email_uids(use_cache=False)
+
+    @lock_class_method
+    def sync_emails(self, expected_uid_count=None, check_unread_uids=None, status=None):
         '''
-        Get new and deleted emails for this folder.
+        Get new and deleted emails for this folder, including any found when
+        reconciling in the background. The folder status may be provided where
+        already fetched (see `Account.get_folder_statuses`).
+        '''
+
+        new_emails, deleted_uids, read_uids = self.sync_server_emails(
+            expected_uid_count=expected_uid_count,
+            check_unread_uids=check_unread_uids,
+            status=status,
+        )
+        self.stale = False
+
+        if self.reconciled_changes:
+            reconciled_new_emails, reconciled_deleted_uids = self.reconciled_changes
+            self.reconciled_changes = None
+
+            deleted_uids = list(set(deleted_uids).union(reconciled_deleted_uids))
+            new_uids = set(email['uid'] for email in new_emails)
+
+            new_emails = [
+                email for email in reconciled_new_emails
+                if email['uid'] not in new_uids and email['uid'] not in deleted_uids
+            ] + new_emails
+
+        return new_emails, deleted_uids, read_uids
+
+    def sync_server_emails(
+        self,
+        expected_uid_count=None,
+        check_unread_uids=None,
+        status=None,
+    ):
+        '''
+        Get new and deleted emails for this folder from the server.
         '''
 
         # If we don't exist, try again or we have nothing
@@ -372,15 +683,72 @@ class Folder(object):
             if not self.check_exists():
                 return [], [], []
 
-        message_uids = self.get_email_uids(use_cache=False)
+        # If IDLE is watching this folder and has seen no changes there's nothing
+        # to sync, unless we're expecting new UIDs (after a move/copy) that the
+        # watcher may not have been told about yet.
+        if self.idle_watched and not expected_uid_count:
+            if not self.idle_changed:
+                return [], [], []
+            # Cleared before syncing so changes seen during the sync aren't lost
+            self.idle_changed = False
+
+        try:
+            return self.sync_server_changes(
+                expected_uid_count=expected_uid_count,
+                check_unread_uids=check_unread_uids,
+                status=status,
+            )
+        except Exception:
+            # Nothing synced, so make sure the next sync doesn't skip the changes
+            self.idle_changed = True
+            raise
+
+    def sync_server_changes(
+        self,
+        expected_uid_count=None,
+        check_unread_uids=None,
+        status=None,
+    ):
+        '''
+        Get the changes for this folder from the server (see sync_server_emails).
+        '''
+
+        if status is None:
+            status = self.get_folder_status()
 
         # Check the folder UIDVALIDITY (busts the cache if needed)
-        uids_valid = self.check_cache_validity()
+        uids_valid = self.check_cache_validity(status)
         uids_changed = False
 
+        # Where possible get only the changes since our last sync, otherwise
+        # search the whole folder and diff against our existing UIDs.
+        changes = None
+        uid_to_changed_flags = None
+
+        if uids_valid:
+            changes = self.get_modseq_changes(status)
+
+        # No new (UIDNEXT) or deleted (MESSAGES) emails since our last sync
+        synced_status = (status.get(b'UIDNEXT'), status.get(b'MESSAGES'))
+        is_status_unchanged = (
+            uids_valid
+            and None not in synced_status
+            and synced_status == self.synced_status
+        )
+
+        if changes:
+            message_uids, uid_to_changed_flags = changes
+        elif is_status_unchanged:
+            self.log('debug', 'Skipping search, folder status unchanged')
+            message_uids = self.email_uids.copy()
+        else:
+            message_uids = self.get_email_uids(use_cache=False)
+
+        self.synced_status = synced_status
+
         if uids_valid:
             # Remove existing from new to get anything new
-            new_message_uids = message_uids - self.email_uids
+            new_message_uids = list(message_uids - self.email_uids)
             # Remove new from existing to get deleted
             deleted_message_uids = self.email_uids - message_uids
 
@@ -395,16 +763,17 @@ class Folder(object):
             deleted_message_uids = self.email_uids
 
             batch_size = get_system_setting('batch_size')
-            sorted_message_uids = sorted(message_uids, reverse=True)
-            new_message_uids = sorted_message_uids[:batch_size]
+            new_message_uids = list(islice(reversed(message_uids), batch_size))
 
         self.email_uids = message_uids
 
         if uids_changed:
             self.cache_uids()
 
-        for uid in deleted_message_uids:
-            self.cache.delete_headers(uid)
+        # For query folders these are UIDs that no longer match, which may still
+        # be in the (shared) base folder cache.
+        if deleted_message_uids and not self.query:
+            self.cache.batch_delete_headers(deleted_message_uids)
 
         if expected_uid_count:
             new_message_uids = fix_missing_uids(
@@ -430,11 +799,44 @@ class Folder(object):
                 uid for uid in check_unread_uids
                 if uid in message_uids
             ]
-            read_uids = self.check_update_unread_emails(check_unread_uids)
+            if uid_to_changed_flags is None:
+                read_uids = self.check_update_unread_emails(check_unread_uids)
+            else:
+                read_uids = [
+                    uid for uid in check_unread_uids
+                    if SEEN_FLAG in uid_to_changed_flags.get(uid, ())
+                ]
+
+        if uid_to_changed_flags:
+            self.set_cache_flags(uid_to_changed_flags)
+
+        if not self.query and b'HIGHESTMODSEQ' in status:
+            self.cache.set_highest_modseq(status[b'HIGHESTMODSEQ'])
 
         # Return the new emails & any deleted uids
         return new_emails, list(deleted_message_uids), read_uids
 
+    def iter_email_uids(self):
+        '''
+        Iterate our UIDs, highest first or best match first for searches.
+        '''
+
+        if not self.ranked_email_uids:
+            yield from reversed(self.email_uids)
+            return
+
+        ranked_uids = set()
+
+        for uid in self.ranked_email_uids:
+            if uid in self.email_uids:
+                ranked_uids.add(uid)
+                yield uid
+
+        # Anything found since (by syncing with the server)
+        for uid in reversed(self.email_uids):
+            if uid not in ranked_uids:
+                yield uid
+
     @lock_class_method
     def get_emails(self, reset=False, batch_size=None):
         '''
@@ -445,18 +847,22 @@ class Folder(object):
         if not self.exists:
             return []
 
+        # Runs once we return, as we hold the lock
+        self.start_reconcile()
+
         if reset:
             self.log('debug', 'Resetting folder')
-            self.seen_email_uids = set()
+            self.seen_email_uids = UidSet()
 
         if not batch_size:
             batch_size = get_system_setting('batch_size')
 
-        unseen_email_uids = self.email_uids - self.seen_email_uids
-        sorted_unseen_email_uids = sorted(unseen_email_uids, reverse=True)
-
-        # Select the slice of UIDs
-        email_uids = sorted_unseen_email_uids[:batch_size]
+        # Select the slice of (highest/best first) UIDs we haven't seen yet, the
+        # UIDs are already sorted so no need to diff/sort the whole set.
+        email_uids = list(islice((
+            uid for uid in self.iter_email_uids()
+            if uid not in self.seen_email_uids
+        ), batch_size))
 
         # Nothing to fetch? Shortcut!
         if not email_uids:
@@ -468,6 +874,28 @@ class Folder(object):
 
         return list(emails.values())
 
+    def get_emails_before(self, before_uid=None, batch_size=None):
+        '''
+        Get a slice of emails (highest UID first) below a given UID. Unlike
+        `get_emails` this does not track seen UIDs, the caller keeps the cursor.
+        '''
+
+        if not self.exists:
+            return []
+
+        if not batch_size:
+            batch_size = get_system_setting('batch_size')
+
+        emails = []
+
+        email_uids = self.email_uids.get_highest(batch_size, below=before_uid)
+        if email_uids:
+            uid_to_headers = self.get_email_headers(email_uids)
+            emails = [uid_to_headers[uid] for uid in email_uids if uid in uid_to_headers]
+
+        self.start_reconcile()
+        return emails
+
     # Functions that affect emails, but not any of the class internals
     #
 
@@ -475,6 +903,8 @@ class Folder(object):
         with self.account.get_imap_connection() as connection:
             connection.append(self.name, email_message.as_string(), flags=(SEEN_FLAG,))
 
+        self.account.invalidate_folder_status(self.name)
+
     def delete_emails(self, email_uids):
         '''
         Delete emails (by UID) from this folder.
@@ -489,6 +919,8 @@ class Folder(object):
             connection.delete_messages(email_uids)
             connection.expunge(email_uids)
 
+        self.account.invalidate_folder_status(self.name)
+
     def move_emails(self, email_uids, new_folder):
         '''
         Move (copy + delete) emails (by UID) from this folder to another.
@@ -509,6 +941,9 @@ class Folder(object):
             connection.delete_messages(email_uids)
             connection.expunge(email_uids)
 
+        self.account.invalidate_folder_status(self.name)
+        self.account.invalidate_folder_status(new_folder)
+
     def copy_emails(self, email_uids, new_folder):
         '''
         Copy emails (by UID) from this folder to another.
@@ -524,6 +959,8 @@ class Folder(object):
         with self.get_connection() as connection:
             connection.copy(email_uids, new_folder)
 
+        self.account.invalidate_folder_status(new_folder)
+
     def star_emails(self, email_uids):
         '''
         Star/flag emails (by UID) in this folder.
@@ -534,8 +971,7 @@ class Folder(object):
         with self.get_connection() as connection:
             connection.add_flags(email_uids, [b'\\Flagged'])
 
-        for uid in email_uids:
-            self.add_cache_flags(uid, b'\\Flagged')
+        self.add_cache_flags(email_uids, b'\\Flagged')
 
     def unstar_emails(self, email_uids):
         '''
@@ -547,5 +983,4 @@ class Folder(object):
         with self.get_connection() as connection:
             connection.remove_flags(email_uids, [b'\\Flagged'])
 
-        for uid in email_uids:
-            self.remove_cache_flags(uid, b'\\Flagged')
+        self.remove_cache_flags(email_uids, b'\\Flagged')
@@ -1,16 +1,44 @@
 from functools import wraps
-from pickle import (
-    dumps as pickle_dumps,
-    loads as pickle_loads,
-)
-
+from hashlib import sha256
+from os import listdir, makedirs, path, remove, replace
+from pickle import loads as pickle_loads
+from shutil import rmtree
+from time import time
+from uuid import uuid4
+
+from sqlalchemy import bindparam, select, text
 from sqlalchemy.orm.exc import NoResultFound
 
 from kanmail.log import logger
 from kanmail.server.app import db
+from kanmail.server.db_writer import execute_write
 from kanmail.server.util import lock_class_method
 from kanmail.settings import get_settings
-from kanmail.settings.constants import CACHE_ENABLED
+from kanmail.settings.constants import (
+    CACHE_ENABLED,
+    PART_CACHE_DIR,
+    PART_CACHE_INLINE_MAX_BYTES,
+    PART_CACHE_MAX_BYTES,
+)
+
+from .header_cache import HEADER_CACHE
+from .search_index import (
+    create_search_index,
+    index_search_bodies,
+    index_search_headers,
+    make_address_text,
+    make_body_text,
+    rebuild_search_index,
+    search_folder_uids,
+)
+from .threads import (
+    make_message_references,
+    rebuild_thread_index,
+    ThreadMessageItem,
+    update_thread_index,
+)
+from .uid_set import UidSet
+from .util import get_date_timestamp
 
 
 def execute_if_enabled(func):
@@ -43,7 +71,8 @@ class FolderCacheItem(db.Model):
     folder_name = db.Column(db.String(300), nullable=False)
 
     uid_validity = db.Column(db.String(300))
-    uids = db.Column(db.Text)
+    highest_modseq = db.Column(db.String(300))
+    uids = db.Column(db.Text)  # IMAP sequence set, see UidSet
 
     def __str__(self):
         return f'{self.account_name}/{self.folder_name}'
@@ -55,15 +84,36 @@ class FolderHeaderCacheItem(db.Model):
     '''
 
     __bind_key__ = 'folders'
-    __tablename__ = 'folder_header_cache_item'
+    __tablename__ = 'folder_header_item'
     __table_args__ = (
         db.UniqueConstraint('uid', 'folder_id'),
+        db.Index('ix_folder_header_item_folder_timestamp', 'folder_id', 'timestamp'),
     )
 
     id = db.Column(db.Integer, primary_key=True)
 
     uid = db.Column(db.Integer, nullable=False, index=True)
-    data = db.Column(db.Text, nullable=False)
+    seq = db.Column(db.Integer)
+
+    # Bitmask of FLAG_BITS + any other flags/keywords (space separated)
+    flags = db.Column(db.Integer, nullable=False, default=0)
+    keywords = db.Column(db.Text)
+
+    size = db.Column(db.Integer)
+    date = db.Column(db.String(64))
+    timestamp = db.Column(db.Integer)
+    subject = db.Column(db.Text)
+    excerpt = db.Column(db.Text)
+    content_encoding = db.Column(db.String(64))
+
+    # Threading keys
+    message_id = db.Column(db.Text, index=True)
+    in_reply_to = db.Column(db.Text, index=True)
+    reference_ids = db.Column(db.Text)  # space separated message IDs
+
+    # Shortcuts to the best text/html part numbers
+    html_part = db.Column(db.String(64))
+    plain_part = db.Column(db.String(64))
 
     folder_id = db.Column(
         db.Integer,
@@ -72,34 +122,497 @@ class FolderHeaderCacheItem(db.Model):
     )
     folder = db.relationship('FolderCacheItem')
 
+    addresses = db.relationship(
+        'FolderHeaderAddressCacheItem',
+        order_by='FolderHeaderAddressCacheItem.position',
+        cascade='all, delete-orphan',
+        passive_deletes=True,
+        lazy='selectin',
+    )
+    struct_parts = db.relationship(
+        'FolderHeaderStructCacheItem',
+        order_by='FolderHeaderStructCacheItem.position',
+        cascade='all, delete-orphan',
+        passive_deletes=True,
+        lazy='selectin',
+    )
+
     def __str__(self):
         return f'{self.folder}/{self.uid}'
 
 
-# class FolderHeaderPartCacheItem(db.Model):
-#     '''
-#     Email part (data) cache items, attached to the relevant email header.
-#     '''
+class FolderHeaderAddressCacheItem(db.Model):
+    '''
+    Email addresses (from/to/cc/etc), attached to the relevant email header.
+    '''
+
+    __bind_key__ = 'folders'
+    __tablename__ = 'folder_header_address_item'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    address_type = db.Column(db.String(16), nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.Text)
+    email = db.Column(db.Text, index=True)
+
+    header_id = db.Column(
+        db.Integer,
+        db.ForeignKey('folder_header_item.id', ondelete='CASCADE'),
+        nullable=False,
+        index=True,
+    )
+
+
+class FolderHeaderStructCacheItem(db.Model):
+    '''
+    Email body structure parts (type, encoding, etc), attached to the relevant
+    email header.
+    '''
+
+    __bind_key__ = 'folders'
+    __tablename__ = 'folder_header_struct_item'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    position = db.Column(db.Integer, nullable=False)
+    part_number = db.Column(db.String(64), nullable=False)
+    is_attachment = db.Column(db.Boolean, nullable=False, default=False)
+
+    type = db.Column(db.String(128))
+    subtype = db.Column(db.String(128))
+    encoding = db.Column(db.String(64))
+    charset = db.Column(db.String(64))
+    content_id = db.Column(db.Text)
+    name = db.Column(db.Text)
+    size = db.Column(db.Integer)
+
+    header_id = db.Column(
+        db.Integer,
+        db.ForeignKey('folder_header_item.id', ondelete='CASCADE'),
+        nullable=False,
+        index=True,
+    )
+
+
+class FolderHeaderPartCacheItem(db.Model):
+    '''
+    Email part (data) cache items, attached to the relevant email header. Small
+    parts are stored inline, larger ones as content addressed files (see
+    write_part_file).
+    '''
+
+    __bind_key__ = 'folders'
+    __tablename__ = 'folder_header_part_item'
+    __table_args__ = (
+        db.UniqueConstraint('part_number', 'header_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    part_number = db.Column(db.String(64), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary)
+    data_hash = db.Column(db.String(64), index=True)
+    # Last access timestamp, the least recently accessed parts are evicted first
+    accessed = db.Column(db.Integer, nullable=False, index=True)
+
+    header_id = db.Column(
+        db.Integer,
+        db.ForeignKey('folder_header_item.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+
+# Part data files
+#
+
+def _get_part_filename(data_hash):
+    return path.join(PART_CACHE_DIR, data_hash[:2], data_hash)
+
+
+def write_part_file(data):
+    '''
+    Write part data to a file named by its hash (identical parts, ie the same
+    attachment in many emails, share one file), returning the hash.
+    '''
+
+    data_hash = sha256(data).hexdigest()
+    filename = _get_part_filename(data_hash)
+
+    if not path.exists(filename):
+        makedirs(path.dirname(filename), exist_ok=True)
+
+        # Write & move so readers never see partial files
+        temp_filename = f'{filename}.{uuid4().hex}.tmp'
+        with open(temp_filename, 'wb') as f:
+            f.write(data)
+        replace(temp_filename, filename)
+
+    return data_hash
+
+
+def read_part_file(data_hash):
+    try:
+        with open(_get_part_filename(data_hash), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+
+def delete_part_files(data_hashes):
+    for data_hash in data_hashes:
+        try:
+            remove(_get_part_filename(data_hash))
+        except FileNotFoundError:
+            pass
+
+
+# Header dict <> cache item conversion
+#
+
+# Bitmask values for the IMAP system flags, any other flags are stored as keywords
+FLAG_BITS = {
+    b'\\Seen': 1,
+    b'\\Answered': 2,
+    b'\\Flagged': 4,
+    b'\\Deleted': 8,
+    b'\\Draft': 16,
+    b'\\Recent': 32,
+}
 
-#     __bind_key__ = 'folders'
-#     __tablename__ = 'folder_header_part_cache_item'
-#     __table_args__ = (
-#         db.UniqueConstraint('part_number', 'header_uid'),
-#     )
+ADDRESS_TYPES = ('from', 'to', 'send', 'cc', 'bcc', 'reply_to')
+STRUCT_PART_KEYS = ('type', 'subtype', 'encoding', 'charset', 'content_id', 'name', 'size')
 
-#     id = db.Column(db.Integer, primary_key=True)
 
-#     part_number = db.Column(db.Integer, nullable=False)
-#     data = db.Column(db.Text, nullable=False)
+def _to_str(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
 
-#     header_id = db.Column(
-#         db.Integer,
-#         db.ForeignKey('folder_header_cache_item.id', ondelete='CASCADE'),
-#         nullable=False,
-#     )
 
+def _to_bytes(value):
+    if isinstance(value, str):
+        return value.encode()
+    return value
 
-def _make_account_key(settings):
+
+def make_flag_values(flags):
+    '''
+    Convert a list of IMAP flags into a (bitmask, keywords) tuple.
+    '''
+
+    flag_bits = 0
+    keywords = []
+
+    for flag in flags:
+        flag = _to_bytes(flag)
+        if flag in FLAG_BITS:
+            flag_bits |= FLAG_BITS[flag]
+        else:
+            keywords.append(flag.decode('utf-8', 'replace'))
+
+    return flag_bits, ' '.join(keywords) or None
+
+
+def make_flags(flag_bits, keywords):
+    flags = [
+        flag for flag, bit in FLAG_BITS.items()
+        if flag_bits & bit
+    ]
+
+    if keywords:
+        flags.extend(keyword.encode() for keyword in keywords.split())
+
+    return tuple(flags)
+
+
+def make_header_values(headers):
+    '''
+    Convert a headers dict into header column values and lists of address &
+    body structure part column values.
+    '''
+
+    parts = headers.get('parts') or {}
+    attachments = set(str(number) for number in parts.get('attachments', []))
+
+    flags, keywords = make_flag_values(headers['flags'])
+    references = headers.get('references')
+    html_part = parts.get('html')
+    plain_part = parts.get('plain')
+
+    values = {
+        'seq': headers.get('seq'),
+        'flags': flags,
+        'keywords': keywords,
+        'size': headers.get('size'),
+        'date': headers.get('date'),
+        'timestamp': get_date_timestamp(headers.get('date')),
+        'subject': headers.get('subject'),
+        'excerpt': headers.get('excerpt'),
+        'content_encoding': headers.get('content_encoding'),
+        'message_id': _to_str(headers.get('message_id')),
+        'in_reply_to': _to_str(headers.get('in_reply_to')),
+        'reference_ids': ' '.join(references) if references else None,
+        'html_part': str(html_part) if html_part else None,
+        'plain_part': str(plain_part) if plain_part else None,
+    }
+
+    addresses = [
+        {
+            'address_type': address_type,
+            'position': position,
+            'name': name,
+            'email': email,
+        }
+        for address_type in ADDRESS_TYPES
+        for position, (name, email) in enumerate(headers.get(address_type) or [])
+    ]
+
+    struct_parts = [
+        {
+            'position': position,
+            'part_number': str(number),
+            'is_attachment': str(number) in attachments,
+            **{
+                key: part.get(key)
+                for key in STRUCT_PART_KEYS
+            },
+        }
+        for position, (number, part) in enumerate(
+            (number, part) for number, part in parts.items()
+            if isinstance(part, dict)
+        )
+    ]
+
+    return values, addresses, struct_parts
+
+
+def update_header_item(header_item, headers):
+    '''
+    Update a header cache item (and it's addresses/parts) from a headers dict.
+    '''
+
+    values, addresses, struct_parts = make_header_values(headers)
+
+    for key, value in values.items():
+        setattr(header_item, key, value)
+
+    header_item.addresses = [
+        FolderHeaderAddressCacheItem(**address)
+        for address in addresses
+    ]
+    header_item.struct_parts = [
+        FolderHeaderStructCacheItem(**struct_part)
+        for struct_part in struct_parts
+    ]
+
+    return header_item
+
+
+def make_headers(header_item, folder):
+    '''
+    Convert a header cache item back into the headers dict returned by the API.
+    '''
+
+    parts = {}
+    attachments = []
+
+    for struct_part in header_item.struct_parts:
+        part = {
+            key: getattr(struct_part, key)
+            for key in STRUCT_PART_KEYS
+        }
+        for key in ('charset', 'name'):
+            if part[key] is None:
+                part.pop(key)
+
+        parts[struct_part.part_number] = part
+        if struct_part.is_attachment:
+            attachments.append(struct_part.part_number)
+
+    parts['attachments'] = attachments
+    if header_item.html_part:
+        parts['html'] = header_item.html_part
+    if header_item.plain_part:
+        parts['plain'] = header_item.plain_part
+
+    addresses = {
+        address_type: []
+        for address_type in ADDRESS_TYPES
+    }
+    for address in header_item.addresses:
+        addresses[address.address_type].append((address.name, address.email))
+
+    references = header_item.reference_ids
+    if references:
+        references = references.split()
+
+    return {
+        'uid': header_item.uid,
+        'seq': header_item.seq,
+        'flags': make_flags(header_item.flags, header_item.keywords),
+        'size': header_item.size,
+        'excerpt': header_item.excerpt,
+        'content_encoding': header_item.content_encoding,
+        'parts': parts,
+
+        # Internal meta
+        'account_name': folder.account.name,
+        'server_folder_name': folder.name,
+        'folder_name': folder.alias_name,
+
+        # Envelope data
+        'date': header_item.date,
+        'subject': header_item.subject,
+
+        # Address data
+        **addresses,
+
+        # Threading
+        'in_reply_to': header_item.in_reply_to,
+        'message_id': header_item.message_id,
+        'references': references,
+    }
+
+
+# Columns added after the initial release of each table, ``db.create_all`` only
+# creates missing tables so these are added by ``upgrade_folder_cache``.
+ADDED_COLUMNS = {
+    'folder_cache_item': {
+        'highest_modseq': 'VARCHAR(300)',
+    },
+}
+
+
+# Max number of variables to pass into a single IN (...) query
+BATCH_QUERY_SIZE = 500
+
+
+def _chunks(items, size=BATCH_QUERY_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Upsert header values using SQLite's "ON CONFLICT" so we don't need to select
+# and compare existing headers when saving.
+HEADER_VALUE_COLUMNS = tuple(
+    column.name for column in FolderHeaderCacheItem.__table__.columns
+    if column.name not in ('id', 'uid', 'folder_id')
+)
+UPSERT_HEADERS_SQL = text((
+    'INSERT INTO folder_header_item ({columns}) VALUES ({values}) '
+    'ON CONFLICT(uid, folder_id) DO UPDATE SET {updates}'
+).format(
+    columns=', '.join(('uid', 'folder_id') + HEADER_VALUE_COLUMNS),
+    values=', '.join(
+        f':{column}' for column in ('uid', 'folder_id') + HEADER_VALUE_COLUMNS
+    ),
+    updates=', '.join(
+        f'{column} = excluded.{column}' for column in HEADER_VALUE_COLUMNS
+    ),
+))
+
+
+# Pre columnar header cache table, pickled header dicts
+LEGACY_HEADER_TABLE = 'folder_header_cache_item'
+LEGACY_HEADER_BATCH_SIZE = 1000
+
+
+def _migrate_legacy_headers():
+    engine = db.get_engine(bind='folders')
+
+    if not engine.has_table(LEGACY_HEADER_TABLE):
+        return
+
+    logger.info('Migrating pickled cache headers to columnar schema')
+
+    migrated = 0
+    last_id = 0
+
+    while True:
+        rows = engine.execute(
+            f'SELECT id, uid, folder_id, data FROM {LEGACY_HEADER_TABLE} '
+            'WHERE id > ? ORDER BY id LIMIT ?',
+            (last_id, LEGACY_HEADER_BATCH_SIZE),
+        ).fetchall()
+
+        if not rows:
+            break
+
+        for row_id, uid, folder_id, data in rows:
+            last_id = row_id
+
+            try:
+                headers = pickle_loads(data)
+            except Exception as e:
+                logger.warning(f'Failed to load legacy cache header {row_id}: {e}')
+                continue
+
+            db.session.add(update_header_item(
+                FolderHeaderCacheItem(uid=uid, folder_id=folder_id),
+                headers,
+            ))
+            migrated += 1
+
+        db.session.commit()
+
+    engine.execute(f'DROP TABLE {LEGACY_HEADER_TABLE}')
+    logger.info(f'Migrated {migrated} cache headers')
+
+
+def upgrade_folder_cache():
+    _migrate_legacy_headers()
+
+    with db.get_engine(bind='folders').begin() as conn:
+        for table_name, columns in ADDED_COLUMNS.items():
+            existing_columns = {
+                row[1] for row in conn.execute(f'PRAGMA table_info({table_name})')
+            }
+
+            for column_name, column_type in columns.items():
+                if column_name in existing_columns:
+                    continue
+
+                logger.info(f'Adding cache column: {table_name}.{column_name}')
+                conn.execute(
+                    f'ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}',
+                )
+
+        # Build the thread index for headers cached before it existed
+        has_thread_index = conn.execute(
+            select([ThreadMessageItem.__table__.c.id]).limit(1),
+        ).first()
+        has_headers = conn.execute(
+            select([FolderHeaderCacheItem.__table__.c.id]).limit(1),
+        ).first()
+
+        if has_headers and not has_thread_index:
+            logger.info('Building thread index from cached headers')
+            rebuild_thread_index(conn)
+
+        # Build the search index for headers cached before it existed
+        if create_search_index(conn) and has_headers:
+            logger.info('Building search index from cached headers')
+            rebuild_search_index(conn)
+
+
+def load_uids(uids_data):
+    '''
+    Load a UID set from the cache, handling older pickled Python sets.
+    '''
+
+    if isinstance(uids_data, bytes):
+        try:
+            return UidSet(pickle_loads(uids_data))
+        except Exception:
+            pass
+
+    return UidSet.from_sequence_set(uids_data)
+
+
+def make_account_key(settings):
     imap_settings = settings['imap_connection']
     return f'{imap_settings["username"]}@{imap_settings["host"]}'
 
@@ -109,7 +622,7 @@ def remove_stale_folders():
     accounts = settings['accounts']
     account_names = set()
     for account in accounts:
-        account_names.add(_make_account_key(account))
+        account_names.add(make_account_key(account))
 
     deleted = 0
     all_folders = FolderCacheItem.query.all()
@@ -120,6 +633,10 @@ def remove_stale_folders():
             delete_cache_items(folder)
             deleted += 1
 
+    if deleted:
+        bump_cache_generation()
+        HEADER_CACHE.clear()
+
     logger.info(f'Deleted {deleted}/{len(all_folders)} cache folders')
 
 
@@ -128,20 +645,59 @@ def remove_stale_headers():
 
     for folder in FolderCacheItem.query.all():
         if folder.uids:
-            folder_id_to_uids[folder.id] = pickle_loads(folder.uids)
+            folder_id_to_uids[folder.id] = load_uids(folder.uids)
+
+    all_headers = db.session.query(
+        FolderHeaderCacheItem.id,
+        FolderHeaderCacheItem.uid,
+        FolderHeaderCacheItem.folder_id,
+    ).all()
+    header_ids_to_delete = []
+
+    for header_id, uid, folder_id in all_headers:
+        if uid not in folder_id_to_uids.get(folder_id, set()):
+            logger.info(f'Deleting stale cache header: {folder_id}/{uid}')
+            header_ids_to_delete.append(header_id)
+
+    for header_ids in _chunks(header_ids_to_delete):
+        (
+            FolderHeaderCacheItem.query
+            .filter(FolderHeaderCacheItem.id.in_(header_ids))
+            .delete(synchronize_session=False)
+        )
+        db.session.commit()
 
-    all_headers = FolderHeaderCacheItem.query.all()
-    headers_to_delete = []
+    if header_ids_to_delete:
+        HEADER_CACHE.clear()
 
-    for header in all_headers:
-        if header.uid not in folder_id_to_uids.get(header.folder_id, set()):
-            logger.info(f'Deleting stale cache header: {header}')
-            headers_to_delete.append(header)
+    remove_stale_part_files()
 
-    if headers_to_delete:
-        delete_cache_items(*headers_to_delete)
+    logger.info(f'Deleted {len(header_ids_to_delete)}/{len(all_headers)} cache headers')
 
-    logger.info(f'Deleted {len(headers_to_delete)}/{len(all_headers)} cache headers')
+
+def remove_stale_part_files():
+    used_hashes = {
+        data_hash for data_hash, in db.session.query(
+            FolderHeaderPartCacheItem.data_hash,
+        ).filter(FolderHeaderPartCacheItem.data_hash.isnot(None))
+    }
+
+    if not path.exists(PART_CACHE_DIR):
+        return
+
+    stale_hashes = []
+
+    for dirname in listdir(PART_CACHE_DIR):
+        for filename in listdir(path.join(PART_CACHE_DIR, dirname)):
+            # Skip any in progress writes (see write_part_file)
+            if filename.endswith('.tmp'):
+                continue
+
+            if filename not in used_hashes:
+                stale_hashes.append(filename)
+
+    delete_part_files(stale_hashes)
+    logger.info(f'Deleted {len(stale_hashes)} stale part files')
 
 
 def vacuum_folder_cache():
@@ -151,11 +707,27 @@ def vacuum_folder_cache():
     logger.info('Folder cache DB vacuumed')
 
 
+# Incremented whenever folder cache items are deleted outside of a FolderCache,
+# invalidating the folder IDs memoized by each FolderCache.
+CACHE_GENERATION = 0
+
+
+def bump_cache_generation():
+    global CACHE_GENERATION
+    CACHE_GENERATION += 1
+
+
 @execute_if_enabled
 def bust_all_caches():
     logger.warning('Busting all cache items!')
     FolderCacheItem.query.delete()
+    ThreadMessageItem.query.delete()
     db.session.commit()
+    bump_cache_generation()
+    HEADER_CACHE.clear()
+
+    # All the part rows are gone (cascade), so are any part files
+    rmtree(PART_CACHE_DIR, ignore_errors=True)
 
 
 def save_cache_items(*items):
@@ -170,6 +742,269 @@ def delete_cache_items(*items):
     db.session.commit()
 
 
+# Write functions - executed on the database writer thread (see db_writer)
+#
+
+def execute_cache_write(func, *args):
+    return execute_write('folders', func, *args)
+
+
+def _insert_folder_cache_item(connection, account_name, folder_name):
+    connection.execute(
+        FolderCacheItem.__table__.insert().prefix_with('OR IGNORE'),
+        account_name=account_name,
+        folder_name=folder_name,
+    )
+
+
+def _update_folder_cache_item(connection, folder_id, values):
+    table = FolderCacheItem.__table__
+    return connection.execute(
+        table.update().where(table.c.id == folder_id).values(**values),
+    ).rowcount
+
+
+def _delete_folder_cache_item(connection, folder_id):
+    data_hashes = _get_part_hashes(
+        connection,
+        FolderHeaderCacheItem.__table__.c.folder_id == folder_id,
+    )
+
+    table = FolderCacheItem.__table__
+    connection.execute(table.delete().where(table.c.id == folder_id))
+
+    _delete_unused_part_files(connection, data_hashes)
+
+
+def _update_header_flags(connection, folder_id, uids, flag, add):
+    table = FolderHeaderCacheItem.__table__
+
+    for chunk_uids in _chunks(uids):
+        where = (table.c.folder_id == folder_id) & (table.c.uid.in_(chunk_uids))
+
+        # System flags are a bitmask so can be updated without loading headers
+        if flag in FLAG_BITS:
+            bit = FLAG_BITS[flag]
+            if add:
+                flags = table.c.flags.op('|')(bit)
+            else:
+                flags = table.c.flags.op('&')(~bit)
+
+            connection.execute(table.update().where(where).values(flags=flags))
+            continue
+
+        keyword = flag.decode('utf-8', 'replace')
+        keyword_values = []
+
+        for uid, keywords in connection.execute(
+            select([table.c.uid, table.c.keywords]).where(where),
+        ):
+            keywords = set((keywords or '').split())
+
+            if add:
+                keywords.add(keyword)
+            else:
+                keywords.discard(keyword)
+
+            keyword_values.append({
+                'b_uid': uid,
+                'b_keywords': ' '.join(sorted(keywords)) or None,
+            })
+
+        if keyword_values:
+            connection.execute(
+                table.update()
+                .where(table.c.folder_id == folder_id)
+                .where(table.c.uid == bindparam('b_uid'))
+                .values(keywords=bindparam('b_keywords')),
+                keyword_values,
+            )
+
+
+def _set_header_flags(connection, folder_id, flag_values):
+    table = FolderHeaderCacheItem.__table__
+
+    connection.execute(
+        table.update()
+        .where(table.c.folder_id == folder_id)
+        .where(table.c.uid == bindparam('b_uid'))
+        .values(flags=bindparam('b_flags'), keywords=bindparam('b_keywords')),
+        flag_values,
+    )
+
+
+def _upsert_headers(connection, folder_id, header_values, uid_to_children):
+    connection.execute(UPSERT_HEADERS_SQL, header_values)
+
+    # Now replace the address/part rows for each of the upserted headers
+    table = FolderHeaderCacheItem.__table__
+
+    uid_to_header_values = {
+        values['uid']: values
+        for values in header_values
+    }
+
+    address_values = []
+    struct_part_values = []
+    search_values = []
+    header_ids = []
+
+    for uids in _chunks(uid_to_children.keys()):
+        for header_id, uid in connection.execute(
+            select([table.c.id, table.c.uid])
+            .where(table.c.folder_id == folder_id)
+            .where(table.c.uid.in_(uids)),
+        ):
+            header_ids.append(header_id)
+
+            addresses, struct_parts = uid_to_children[uid]
+            address_values.extend(
+                {'header_id': header_id, **address}
+                for address in addresses
+            )
+            struct_part_values.extend(
+                {'header_id': header_id, **struct_part}
+                for struct_part in struct_parts
+            )
+
+            values = uid_to_header_values[uid]
+            search_values.append({
+                'id': header_id,
+                'subject': values['subject'],
+                'addresses': make_address_text(addresses),
+                'excerpt': values['excerpt'],
+            })
+
+    for model, values in (
+        (FolderHeaderAddressCacheItem, address_values),
+        (FolderHeaderStructCacheItem, struct_part_values),
+    ):
+        child_table = model.__table__
+
+        for ids in _chunks(header_ids):
+            connection.execute(
+                child_table.delete().where(child_table.c.header_id.in_(ids)),
+            )
+
+        if values:
+            connection.execute(child_table.insert(), values)
+
+    index_search_headers(connection, search_values)
+
+
+def _delete_headers(connection, folder_id, uids):
+    table = FolderHeaderCacheItem.__table__
+
+    data_hashes = set()
+
+    # Addresses & parts are deleted by the database (ON DELETE CASCADE)
+    for chunk_uids in _chunks(uids):
+        where = (table.c.folder_id == folder_id) & (table.c.uid.in_(chunk_uids))
+
+        data_hashes.update(_get_part_hashes(connection, where))
+        connection.execute(table.delete().where(where))
+
+    _delete_unused_part_files(connection, data_hashes)
+
+
+UPSERT_PART_SQL = text(
+    'INSERT INTO folder_header_part_item '
+    '(part_number, size, data, data_hash, accessed, header_id) '
+    'SELECT :part_number, :size, :data, :data_hash, :accessed, id '
+    'FROM folder_header_item WHERE folder_id = :folder_id AND uid = :uid '
+    'ON CONFLICT(part_number, header_id) DO UPDATE SET '
+    'size = excluded.size, data = excluded.data, '
+    'data_hash = excluded.data_hash, accessed = excluded.accessed',
+)
+
+
+def _get_part_hashes(connection, header_where):
+    '''
+    Get the data hashes of any file stored parts for the matching headers.
+    '''
+
+    part_table = FolderHeaderPartCacheItem.__table__
+    header_table = FolderHeaderCacheItem.__table__
+
+    return {
+        data_hash
+        for data_hash, in connection.execute(
+            select([part_table.c.data_hash])
+            .select_from(part_table.join(header_table))
+            .where(header_where)
+            .where(part_table.c.data_hash.isnot(None)),
+        )
+    }
+
+
+def _delete_unused_part_files(connection, data_hashes):
+    if not data_hashes:
+        return
+
+    table = FolderHeaderPartCacheItem.__table__
+    used_hashes = set()
+
+    for chunk_hashes in _chunks(data_hashes):
+        used_hashes.update(
+            data_hash
+            for data_hash, in connection.execute(
+                select([table.c.data_hash]).where(table.c.data_hash.in_(chunk_hashes)),
+            )
+        )
+
+    delete_part_files(set(data_hashes) - used_hashes)
+
+
+def _upsert_parts(connection, part_values, body_values=None):
+    connection.execute(UPSERT_PART_SQL, part_values)
+    _evict_parts(connection)
+
+    if body_values:
+        index_search_bodies(connection, body_values)
+
+
+def _touch_parts(connection, part_ids, accessed):
+    table = FolderHeaderPartCacheItem.__table__
+
+    for chunk_ids in _chunks(part_ids):
+        connection.execute(
+            table.update().where(table.c.id.in_(chunk_ids)).values(accessed=accessed),
+        )
+
+
+def _evict_parts(connection, max_bytes=PART_CACHE_MAX_BYTES):
+    table = FolderHeaderPartCacheItem.__table__
+
+    total_bytes = connection.execute(select([db.func.sum(table.c.size)])).scalar() or 0
+    if total_bytes <= max_bytes:
+        return
+
+    # Evict down to 90% of the budget so we don't evict on every write
+    bytes_to_free = total_bytes - (max_bytes * 0.9)
+
+    part_ids = []
+    data_hashes = set()
+
+    for part_id, size, data_hash in connection.execute(
+        select([table.c.id, table.c.size, table.c.data_hash])
+        .order_by(table.c.accessed),
+    ).fetchall():
+        if bytes_to_free <= 0:
+            break
+
+        bytes_to_free -= size
+        part_ids.append(part_id)
+        if data_hash:
+            data_hashes.add(data_hash)
+
+    logger.debug(f'Evicting {len(part_ids)} cached parts ({total_bytes} bytes cached)')
+
+    for chunk_ids in _chunks(part_ids):
+        connection.execute(table.delete().where(table.c.id.in_(chunk_ids)))
+
+    _delete_unused_part_files(connection, data_hashes)
+
+
 class FolderCache(object):
     def __init__(self, folder):
         self.folder = folder
@@ -177,27 +1012,68 @@ class FolderCache(object):
 
         # Use user@host for the cache key, so we invalidate when accounts are changed
         # TODO: cache cleanup
-        self.cache_key = _make_account_key(self.folder.account.settings)
+        self.cache_key = make_account_key(self.folder.account.settings)
+        # Key for this folder's headers in the in-memory header cache
+        self.header_cache_key = (self.cache_key, self.folder.name)
+
+        # Memoized FolderCacheItem ID (see get_folder_id)
+        self.folder_id = None
+        self.folder_id_generation = None
+        self.saved_folder_queries = 0
 
     def __str__(self):
         return f'FolderCache({self.name})'
 
     @lock_class_method
     def get_folder_cache_item(self):
+        query = FolderCacheItem.query.filter_by(
+            account_name=self.cache_key,
+            folder_name=self.folder.name,
+        )
+
         try:
-            folder_cache_item = FolderCacheItem.query.filter_by(
-                account_name=self.cache_key,
-                folder_name=self.folder.name,
-            ).one()
+            folder_cache_item = query.one()
         except NoResultFound:
-            folder_cache_item = FolderCacheItem(
-                account_name=self.cache_key,
-                folder_name=self.folder.name,
+            execute_cache_write(
+                _insert_folder_cache_item, self.cache_key, self.folder.name,
             )
-            save_cache_items(folder_cache_item)
+            folder_cache_item = query.one()
+
+        self.folder_id = folder_cache_item.id
+        self.folder_id_generation = CACHE_GENERATION
 
         return folder_cache_item
 
+    def get_folder_id(self):
+        '''
+        Get the (memoized) ID of our FolderCacheItem, avoiding a query to lookup
+        the folder for every cache operation.
+        '''
+
+        if self.folder_id is None or self.folder_id_generation != CACHE_GENERATION:
+            return self.get_folder_cache_item().id
+
+        self.saved_folder_queries += 1
+        return self.folder_id
+
+    def reset_folder_id(self):
+        self.folder_id = None
+
+    def _update_folder_cache_item(self, **values):
+        updated = execute_cache_write(
+            _update_folder_cache_item, self.get_folder_id(), values,
+        )
+
+        # Our memoized folder has been deleted elsewhere, recreate it
+        if not updated:
+            self.reset_folder_id()
+            self._update_folder_cache_item(**values)
+
+    def _get_folder_cache_value(self, column):
+        return db.session.query(column).filter(
+            FolderCacheItem.id == self.get_folder_id(),
+        ).scalar()
+
     def log(self, method, message):
         func = getattr(logger, method)
         func(f'[{self}]: {message}')
@@ -205,72 +1081,64 @@ class FolderCache(object):
     @execute_if_enabled
     def bust(self):
         self.log('warning', 'busting the cache!')
-        delete_cache_items(self.get_folder_cache_item())
+        execute_cache_write(_delete_folder_cache_item, self.get_folder_id())
+        self.reset_folder_id()
+        HEADER_CACHE.invalidate_folder(self.header_cache_key)
 
     # Single operations
     #
 
     def set_uid_validity(self, uid_validity):
         self.log('debug', f'Save UID validity: {uid_validity}')
-        folder_cache_item = self.get_folder_cache_item()
-        folder_cache_item.uid_validity = uid_validity
-        save_cache_items(folder_cache_item)
+        self._update_folder_cache_item(uid_validity=uid_validity)
 
     def get_uid_validity(self):
-        uid_validity = self.get_folder_cache_item().uid_validity
+        uid_validity = self._get_folder_cache_value(FolderCacheItem.uid_validity)
         if uid_validity:
             return int(uid_validity)
 
+    def set_highest_modseq(self, highest_modseq):
+        self.log('debug', f'Save HIGHESTMODSEQ: {highest_modseq}')
+        self._update_folder_cache_item(highest_modseq=highest_modseq)
+
+    def get_highest_modseq(self):
+        highest_modseq = self._get_folder_cache_value(FolderCacheItem.highest_modseq)
+        if highest_modseq:
+            return int(highest_modseq)
+
     def set_uids(self, uids):
         self.log('debug', f'Saving {len(uids)} UIDs')
-        folder_cache_item = self.get_folder_cache_item()
-        folder_cache_item.uids = pickle_dumps(uids)
-        save_cache_items(folder_cache_item)
+        self._update_folder_cache_item(uids=UidSet(uids).to_sequence_set())
 
     def get_uids(self):
-        uids = self.get_folder_cache_item().uids
+        uids = self._get_folder_cache_value(FolderCacheItem.uids)
         if uids:
-            return pickle_loads(uids)
+            return load_uids(uids)
 
     @execute_if_enabled
     def set_headers(self, uid, headers):
         self.log('debug', f'Set headers for UID {uid}: {headers}')
-
-        headers_data = pickle_dumps(headers)
-
-        headers = self.get_header_cache_item(uid)
-        if headers:
-            headers.data = headers_data
-        else:
-            headers = FolderHeaderCacheItem(
-                folder_id=self.get_folder_cache_item().id,
-                uid=uid,
-                data=headers_data,
-            )
-
-        save_cache_items(headers)
+        self.batch_set_headers({uid: headers})
 
     @execute_if_enabled
     def get_header_cache_item(self, uid):
+        # Writes happen on the writer thread, so always refresh any header
+        # items already in this thread's session.
         try:
             return FolderHeaderCacheItem.query.filter_by(
-                folder_id=self.get_folder_cache_item().id,
+                folder_id=self.get_folder_id(),
                 uid=uid,
-            ).one()
+            ).populate_existing().one()
         except NoResultFound:
             pass
 
     @execute_if_enabled
     def delete_headers(self, uid):
-        headers = self.get_header_cache_item(uid)
-        if headers:
-            delete_cache_items(headers)
+        self.batch_delete_headers([uid])
 
     @execute_if_enabled
     def get_headers(self, uid):
-        headers = self.get_header_cache_item(uid)
-        if headers:
-            return pickle_loads(headers.data)
+        return self.batch_get_headers([uid]).get(uid)
 
     @execute_if_enabled
     def get_parts(self, uid):
@@ -287,8 +1155,9 @@ class FolderCache(object):
 
         matched_headers = (
             FolderHeaderCacheItem.query
-            .filter_by(folder_id=self.get_folder_cache_item().id)
+            .filter_by(folder_id=self.get_folder_id())
             .filter(FolderHeaderCacheItem.uid.in_(uids))
+            .populate_existing()
         )
 
         return {
@@ -296,36 +1165,215 @@ class FolderCache(object):
             for header in matched_headers
         }
 
+    def _copy_headers(self, headers):
+        # Cached headers are shared between folder objects (and callers may
+        # modify them), so always return a copy named for this folder.
+        return {
+            **headers,
+            'account_name': self.folder.account.name,
+            'server_folder_name': self.folder.name,
+            'folder_name': self.folder.alias_name,
+        }
+
     def batch_get_headers(self, uids):
         if not CACHE_ENABLED:
             return {}
 
-        self.log('debug', f'Batch get {len(uids)} headers')
+        uid_to_headers = HEADER_CACHE.get_many(self.header_cache_key, uids)
+        missing_uids = [uid for uid in uids if uid not in uid_to_headers]
+
+        self.log('debug', (
+            f'Batch get {len(uids)} headers ({len(uid_to_headers)} in memory, '
+            f'saved {self.saved_folder_queries} folder queries)'
+        ))
+
+        if missing_uids:
+            marker = HEADER_CACHE.get_marker()
+
+            uid_to_loaded_headers = {
+                uid: make_headers(header_item, self.folder)
+                for uid, header_item in self.batch_get_header_items(missing_uids).items()
+            }
+
+            HEADER_CACHE.set_many(self.header_cache_key, uid_to_loaded_headers, marker)
+            uid_to_headers.update(uid_to_loaded_headers)
 
         return {
-            uid: pickle_loads(header.data)
-            for uid, header in self.batch_get_header_items(uids).items()
+            uid: self._copy_headers(headers)
+            for uid, headers in uid_to_headers.items()
         }
 
+    @execute_if_enabled
+    def search_uids(self, query):
+        return search_folder_uids(self.get_folder_id(), query)
+
     @execute_if_enabled
     def batch_set_headers(self, uid_to_headers):
-        self.log('debug', f'Batch set {len(uid_to_headers)} headers')
+        self.log('debug', (
+            f'Batch set {len(uid_to_headers)} headers '
+            f'(saved {self.saved_folder_queries} folder queries)'
+        ))
 
-        existing_headers = self.batch_get_header_items(uid_to_headers.keys())
-        items_to_save = []
+        if not uid_to_headers:
+            return
+
+        folder_id = self.get_folder_id()
+
+        header_values = []
+        uid_to_children = {}
 
         for uid, headers in uid_to_headers.items():
-            headers_data = pickle_dumps(headers)
+            values, addresses, struct_parts = make_header_values(headers)
+            header_values.append({'uid': uid, 'folder_id': folder_id, **values})
+            uid_to_children[uid] = (addresses, struct_parts)
 
-            existing_header = existing_headers.get(uid)
-            if existing_header:
-                existing_header.data = headers_data
-                items_to_save.append(existing_header)
-            else:
-                items_to_save.append(FolderHeaderCacheItem(
-                    folder_id=self.get_folder_cache_item().id,
-                    uid=uid,
-                    data=headers_data,
+        # Queued first so (normally) committed in the same transaction as the headers
+        update_thread_index([
+            make_message_references(headers)
+            for headers in uid_to_headers.values()
+        ], wait=False)
+
+        execute_cache_write(_upsert_headers, folder_id, header_values, uid_to_children)
+        HEADER_CACHE.invalidate(self.header_cache_key, uid_to_headers.keys())
+
+    @execute_if_enabled
+    def batch_delete_headers(self, uids):
+        self.log('debug', f'Batch delete {len(uids)} headers')
+
+        if not uids:
+            return
+
+        execute_cache_write(_delete_headers, self.get_folder_id(), list(uids))
+        HEADER_CACHE.invalidate(self.header_cache_key, uids)
+
+    def _batch_update_flags(self, uids, flag, add):
+        if not uids:
+            return
+
+        action = 'add' if add else 'remove'
+        self.log('debug', f'Batch {action} flag {flag} for {len(uids)} UIDs')
+
+        execute_cache_write(
+            _update_header_flags, self.get_folder_id(), list(uids), _to_bytes(flag), add,
+        )
+        HEADER_CACHE.invalidate(self.header_cache_key, uids)
+
+    @execute_if_enabled
+    def batch_add_flags(self, uids, flag):
+        self._batch_update_flags(uids, flag, add=True)
+
+    @execute_if_enabled
+    def batch_remove_flags(self, uids, flag):
+        self._batch_update_flags(uids, flag, add=False)
+
+    @execute_if_enabled
+    def batch_set_flags(self, uid_to_flags):
+        '''
+        Overwrite the flags of any cached headers for the given UIDs.
+        '''
+
+        if not uid_to_flags:
+            return
+
+        self.log('debug', f'Batch set flags for {len(uid_to_flags)} UIDs')
+
+        flag_values = []
+        for uid, flags in uid_to_flags.items():
+            flag_bits, keywords = make_flag_values(flags)
+            flag_values.append({'b_uid': uid, 'b_flags': flag_bits, 'b_keywords': keywords})
+
+        execute_cache_write(_set_header_flags, self.get_folder_id(), flag_values)
+        HEADER_CACHE.invalidate(self.header_cache_key, uid_to_flags.keys())
+
+    def batch_get_parts(self, uids, part_number):
+        if not CACHE_ENABLED:
+            return {}
+
+        folder_id = self.get_folder_id()
+        uid_to_data = {}
+        part_ids = []
+
+        for chunk_uids in _chunks(uids):
+            for part_id, uid, data, data_hash, charset in (
+                db.session.query(
+                    FolderHeaderPartCacheItem.id,
+                    FolderHeaderCacheItem.uid,
+                    FolderHeaderPartCacheItem.data,
+                    FolderHeaderPartCacheItem.data_hash,
+                    FolderHeaderStructCacheItem.charset,
+                )
+                .select_from(FolderHeaderPartCacheItem)
+                .join(FolderHeaderCacheItem)
+                .outerjoin(FolderHeaderStructCacheItem, (
+                    (FolderHeaderStructCacheItem.header_id == FolderHeaderCacheItem.id)
+                    & (FolderHeaderStructCacheItem.part_number == part_number)
                 ))
+                .filter(FolderHeaderCacheItem.folder_id == folder_id)
+                .filter(FolderHeaderCacheItem.uid.in_(chunk_uids))
+                .filter(FolderHeaderPartCacheItem.part_number == part_number)
+            ):
+                if data_hash:
+                    data = read_part_file(data_hash)
+                    if data is None:  # evicted since the query
+                        continue
+
+                # Parts with a charset are decoded to text when fetched (see
+                # decode_string) and stored as UTF-8, so return the same type.
+                if charset:
+                    data = data.decode('utf-8', 'replace')
+
+                uid_to_data[uid] = data
+                part_ids.append(part_id)
 
-        save_cache_items(*items_to_save)
+        self.log('debug', f'Batch get {len(uids)} parts ({len(uid_to_data)} cached)')
+
+        # Mark as recently accessed, nothing needs to wait for this
+        if part_ids:
+            execute_write('folders', _touch_parts, part_ids, int(time()), wait=False)
+
+        return uid_to_data
+
+    @execute_if_enabled
+    def batch_set_parts(self, part_number, uid_to_data):
+        self.log('debug', f'Batch set {len(uid_to_data)} parts ({part_number})')
+
+        folder_id = self.get_folder_id()
+        accessed = int(time())
+        part_values = []
+        # Index any html/plain parts for local search (see search_index), not
+        # attachments/other parts.
+        body_values = []
+        body_uids = set()
+
+        for uid, headers in self.batch_get_headers(list(uid_to_data.keys())).items():
+            parts = headers.get('parts') or {}
+            if part_number in (str(parts.get('html')), str(parts.get('plain'))):
+                body_uids.add(uid)
+
+        for uid, data in uid_to_data.items():
+            if data and uid in body_uids:
+                body_values.append({
+                    'folder_id': folder_id,
+                    'uid': uid,
+                    'part_number': part_number,
+                    'body': make_body_text(data),
+                })
+
+            data = _to_bytes(data)
+            data_hash = None
+
+            if len(data) > PART_CACHE_INLINE_MAX_BYTES:
+                data_hash = write_part_file(data)
+
+            part_values.append({
+                'folder_id': folder_id,
+                'uid': uid,
+                'part_number': part_number,
+                'size': len(data),
+                'data': None if data_hash else data,
+                'data_hash': data_hash,
+                'accessed': accessed,
+            })
+
+        if part_values:
+            execute_cache_write(_upsert_parts, part_values, body_values)
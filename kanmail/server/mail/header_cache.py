@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from threading import Lock
+
+from kanmail.settings.constants import HEADER_CACHE_MAX_BYTES, HEADER_CACHE_MAX_ITEMS
+
+
+def _estimate_size(value):
+    '''
+    Rough size (in bytes) of a headers dict - good enough to bound the cache
+    without the cost of sys.getsizeof on every nested object.
+    '''
+
+    if isinstance(value, (str, bytes)):
+        return len(value) + 50
+
+    if isinstance(value, dict):
+        return 100 + sum(
+            _estimate_size(key) + _estimate_size(item)
+            for key, item in value.items()
+        )
+
+    if isinstance(value, (list, tuple, set)):
+        return 50 + sum(_estimate_size(item) for item in value)
+
+    return 30
+
+
+class HeaderCache(object):
+    '''
+    Bounded (by entry count and approximate bytes) in-memory LRU of email
+    headers, keyed by (folder key, UID), in front of the folder cache database.
+    '''
+
+    def __init__(self, max_items=HEADER_CACHE_MAX_ITEMS, max_bytes=HEADER_CACHE_MAX_BYTES):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+
+        self.lock = Lock()
+        self.items = OrderedDict()  # (folder key, uid) -> (headers, size)
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        # Incremented on every invalidation, see get_marker/set_many
+        self.invalidations = 0
+
+    def get_many(self, folder_key, uids):
+        uid_to_headers = {}
+
+        with self.lock:
+            for uid in uids:
+                key = (folder_key, uid)
+                item = self.items.get(key)
+
+                if item is None:
+                    self.misses += 1
+                    continue
+
+                self.hits += 1
+                self.items.move_to_end(key)
+                uid_to_headers[uid] = item[0]
+
+        return uid_to_headers
+
+    def get_marker(self):
+        '''
+        Get a marker to pass to `set_many` for headers read from the database
+        after this call, so they're only stored if nothing has been invalidated
+        since (which could mean the headers read are already stale).
+        '''
+
+        return self.invalidations
+
+    def set_many(self, folder_key, uid_to_headers, marker):
+        if not self.max_items:
+            return
+
+        with self.lock:
+            if marker != self.invalidations:
+                return
+
+            for uid, headers in uid_to_headers.items():
+                key = (folder_key, uid)
+                self._pop(key)
+
+                size = _estimate_size(headers)
+                self.items[key] = (headers, size)
+                self.total_bytes += size
+
+            while self.items and (
+                len(self.items) > self.max_items
+                or self.total_bytes > self.max_bytes
+            ):
+                _, (_, size) = self.items.popitem(last=False)
+                self.total_bytes -= size
+
+    def _pop(self, key):
+        item = self.items.pop(key, None)
+        if item:
+            self.total_bytes -= item[1]
+
+    def invalidate(self, folder_key, uids):
+        with self.lock:
+            self.invalidations += 1
+
+            for uid in uids:
+                self._pop((folder_key, uid))
+
+    def invalidate_folder(self, folder_key):
+        with self.lock:
+            self.invalidations += 1
+
+            for key in [key for key in self.items if key[0] == folder_key]:
+                self._pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.invalidations += 1
+            self.items.clear()
+            self.total_bytes = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'items': len(self.items),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+HEADER_CACHE = HeaderCache()
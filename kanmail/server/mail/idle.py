@@ -0,0 +1,171 @@
+'''
+IMAP IDLE watchers - one per account, each on a dedicated connection outside of
+the connection pool. Changes are pushed into the relevant `Folder` object and
+published as events for the frontend to long-poll (see `get_idle_events`).
+'''
+
+from collections import deque
+from itertools import count
+from threading import Condition, Event, Thread
+from time import time
+from uuid import uuid4
+
+from kanmail.log import logger
+
+from .connection import ImapConnectionWrapper
+
+# Re-issue the IDLE command before servers drop it (RFC 2177 says 29 minutes)
+IDLE_RENEW_INTERVAL = 60 * 25
+# How long to wait for responses in each idle check
+IDLE_CHECK_TIMEOUT = 30
+# How long to wait before reconnecting a failed watcher
+IDLE_RECONNECT_DELAY = 30
+
+MAX_IDLE_EVENTS = 1000
+
+IDLE_EVENTS = deque(maxlen=MAX_IDLE_EVENTS)
+IDLE_EVENTS_CONDITION = Condition()
+IDLE_EVENT_IDS = count(1)
+# Event IDs restart on every boot, so clients send back the epoch with their last
+# seen ID - a different epoch means the ID is from a previous boot.
+IDLE_EVENTS_EPOCH = uuid4().hex
+
+
+def push_idle_event(folder, response_types):
+    with IDLE_EVENTS_CONDITION:
+        IDLE_EVENTS.append({
+            'id': next(IDLE_EVENT_IDS),
+            'account_name': folder.account.name,
+            'folder_name': folder.alias_name,
+            'types': sorted(response_types),
+        })
+        IDLE_EVENTS_CONDITION.notify_all()
+
+
+def get_idle_events(since=None, epoch=None, timeout=IDLE_CHECK_TIMEOUT):
+    '''
+    Get any events after the `since` event ID, waiting up to `timeout` seconds
+    for new events to arrive. Returns a list of events, the latest event ID and
+    the events epoch.
+    '''
+
+    # The since ID is from a previous boot, so return every event we have
+    if since is not None and epoch != IDLE_EVENTS_EPOCH:
+        since = 0
+
+    def get_events():
+        return [
+            event for event in IDLE_EVENTS
+            if since is None or event['id'] > since
+        ]
+
+    with IDLE_EVENTS_CONDITION:
+        # First call, return the latest event ID to wait on
+        if since is None:
+            latest_id = IDLE_EVENTS[-1]['id'] if IDLE_EVENTS else 0
+            return [], latest_id, IDLE_EVENTS_EPOCH
+
+        events = get_events()
+        if not events:
+            IDLE_EVENTS_CONDITION.wait(timeout)
+            events = get_events()
+
+    latest_id = events[-1]['id'] if events else since
+    return events, latest_id, IDLE_EVENTS_EPOCH
+
+
+class IdleWatcher(Thread):
+    '''
+    Background thread that IDLEs on a folder (the inbox), notifying the folder
+    object whenever the server reports new, expunged or changed messages.
+    '''
+
+    def __init__(self, account, folder_alias='inbox'):
+        super().__init__(daemon=True, name=f'IdleWatcher({account.name})')
+
+        self.account = account
+        self.folder_alias = folder_alias
+        self.stopped = Event()
+
+    def __str__(self):
+        return f'IdleWatcher({self.account.name}/{self.folder_alias})'
+
+    def log(self, method, message):
+        func = getattr(logger, method)
+        func(f'[{self}]: {message}')
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        try:
+            capabilities = self.account.get_capabilities()
+        except Exception as e:
+            self.log('warning', f'Failed to get capabilities, not watching: {e}')
+            return
+
+        if b'IDLE' not in capabilities:
+            self.log('debug', 'Server does not support IDLE, not watching')
+            return
+
+        while not self.stopped.is_set():
+            try:
+                self.watch()
+            except Exception as e:
+                self.log('warning', f'IDLE failed, reconnecting later: {e}')
+                self.stopped.wait(IDLE_RECONNECT_DELAY)
+
+    def watch(self):
+        folder = self.account.get_folder(self.folder_alias)
+
+        connection = ImapConnectionWrapper(self.account.connection_pool)
+        connection.set_selected_folder(folder.name)
+
+        # Use the underlying client directly as the wrapper will reconnect on
+        # failure, which loses the IDLE state - instead we restart the watch.
+        imap = connection._imap
+
+        # We may have missed changes while not watching, so force a sync
+        folder.set_idle_watched(True)
+        self.log('debug', f'Watching {folder}')
+
+        try:
+            while not self.stopped.is_set():
+                imap.idle()
+                idle_started = time()
+
+                try:
+                    while (
+                        not self.stopped.is_set()
+                        and time() - idle_started < IDLE_RENEW_INTERVAL
+                    ):
+                        responses = imap.idle_check(timeout=IDLE_CHECK_TIMEOUT)
+                        if responses:
+                            self.handle_responses(folder, responses)
+                finally:
+                    imap.idle_done()
+        finally:
+            folder.set_idle_watched(False)
+
+            try:
+                imap.logout()
+            except Exception:
+                pass
+
+    def handle_responses(self, folder, responses):
+        response_types = set()
+
+        # Responses are either (number, type, ...) or (type, ...) for VANISHED
+        for response in responses:
+            for bit in response[:2]:
+                if isinstance(bit, bytes):
+                    response_types.add(bit.decode().upper())
+
+        response_types &= {'EXISTS', 'EXPUNGE', 'FETCH', 'VANISHED'}
+        if not response_types:
+            return
+
+        self.log('debug', f'Received IDLE responses: {response_types}')
+
+        folder.set_idle_changed()
+        push_idle_event(folder, response_types)
@@ -0,0 +1,255 @@
+'''
+Streaming of (large) email parts - these are fetched from the server in chunks
+using partial fetches (BODY.PEEK[part]<offset.length>) and decoded as they
+arrive, so an attachment never has to be held in memory in full.
+'''
+
+from binascii import a2b_base64, a2b_qp
+
+from .folder import SEEN_FLAG
+
+# Size (of the encoded part data) to fetch in each partial fetch
+PART_STREAM_CHUNK_SIZE = 1024 * 1024
+# Parts at or below this size are fetched (and cached) in one go
+PART_STREAM_MIN_SIZE = PART_STREAM_CHUNK_SIZE
+
+WHITESPACE = b' \t\r\n'
+
+
+class IdentityDecoder(object):
+    def decode(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+class Base64Decoder(object):
+    '''
+    Decode base64 in chunks, holding back any trailing characters that don't
+    make up a complete (4 character) group until the next chunk.
+    '''
+
+    def __init__(self):
+        self.buffer = b''
+
+    def decode(self, data):
+        data = self.buffer + data.translate(None, WHITESPACE)
+
+        complete_length = len(data) - (len(data) % 4)
+        self.buffer = data[complete_length:]
+        return a2b_base64(data[:complete_length])
+
+    def flush(self):
+        data = self.buffer
+        self.buffer = b''
+
+        if not data:
+            return b''
+
+        # Tolerate truncated/unpadded payloads
+        data += b'=' * (-len(data) % 4)
+        return a2b_base64(data)
+
+
+class QuotedPrintableDecoder(object):
+    '''
+    Decode quoted-printable in chunks of complete lines, so soft line breaks
+    and escape sequences are never split.
+    '''
+
+    def __init__(self):
+        self.buffer = b''
+
+    def decode(self, data):
+        data = self.buffer + data
+
+        line_end = data.rfind(b'\n') + 1
+        self.buffer = data[line_end:]
+        return a2b_qp(data[:line_end])
+
+    def flush(self):
+        data = self.buffer
+        self.buffer = b''
+        return a2b_qp(data)
+
+
+def make_decoder(encoding):
+    encoding = (encoding or '').lower()
+
+    if encoding == 'base64':
+        return Base64Decoder()
+
+    if encoding == 'quoted-printable':
+        return QuotedPrintableDecoder()
+
+    return IdentityDecoder()
+
+
+class EmailPartStream(object):
+    '''
+    A single email part that can be read in (optionally ranged) chunks.
+
+    Where possible the decoded size of the part is calculated (see `size`) so
+    byte ranges of the decoded data can be mapped back to offsets into the
+    encoded data. For base64 this relies on the encoded lines being the same
+    length, which is the case for any sensible encoder.
+    '''
+
+    # The decoded size, only set when ranges are supported
+    size = None
+
+    # Set when small enough to fetch in one go, see `open`
+    data = None
+
+    # Base64 line layout - characters per line & line ending length
+    line_length = None
+    line_ending_length = None
+
+    def __init__(self, folder, uid, part_number, part_struct):
+        self.folder = folder
+        self.uid = uid
+        self.part_number = part_number
+
+        self.encoding = (part_struct.get('encoding') or '').lower()
+        self.encoded_size = part_struct.get('size') or 0
+
+        self.mime_type = f'{part_struct["type"]}/{part_struct["subtype"]}'.lower()
+
+        self.charset = None
+        if self.mime_type.startswith('text/'):
+            self.charset = part_struct.get('charset')
+
+    def open(self):
+        if self.encoded_size <= PART_STREAM_MIN_SIZE:
+            self.open_data()
+            return
+
+        # We fetch with BODY.PEEK, so set the seen flag as a normal fetch would
+        uid_to_headers = self.folder.get_email_headers([self.uid])
+        headers = uid_to_headers.get(self.uid)
+        if headers and SEEN_FLAG not in headers['flags']:
+            with self.folder.get_connection() as connection:
+                connection.add_flags([self.uid], [SEEN_FLAG])
+            self.folder.add_cache_flags([self.uid], SEEN_FLAG)
+
+        if self.encoding == 'base64':
+            self.open_base64()
+        elif self.encoding != 'quoted-printable':
+            self.size = self.encoded_size
+
+    def open_data(self):
+        # Small parts go via the usual (cached) path, decoded in full
+        data = self.folder.get_email_parts([self.uid], self.part_number).get(self.uid)
+
+        if data is None:
+            data = b''
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+            if self.charset:
+                self.charset = 'utf-8'
+
+        self.data = data
+        self.size = len(data)
+
+    def open_base64(self):
+        head = self.folder.get_email_part_range(
+            self.uid, self.part_number,
+            0, PART_STREAM_CHUNK_SIZE,
+        )
+
+        lines = head.split(b'\n')[:-1]  # drop the incomplete last line
+        if len(lines) < 2:
+            return
+
+        line_ending_length = 2 if lines[0].endswith(b'\r') else 1
+        line_length = len(lines[0]) - (line_ending_length - 1)
+
+        if line_length % 4 or any(len(line) != len(lines[0]) for line in lines):
+            return
+
+        tail_length = min(self.encoded_size, 4 * (line_length + line_ending_length))
+        tail = self.folder.get_email_part_range(
+            self.uid, self.part_number,
+            self.encoded_size - tail_length, tail_length,
+        )
+
+        stripped_tail = tail.rstrip(WHITESPACE)
+        padding = len(stripped_tail) - len(stripped_tail.rstrip(b'='))
+
+        # Encoded size without any trailing whitespace, made up of full lines
+        # and a final partial line without a line ending.
+        content_size = self.encoded_size - (len(tail) - len(stripped_tail))
+        full_line_size = line_length + line_ending_length
+        full_lines = (content_size - 1) // full_line_size
+        last_line_length = content_size - (full_lines * full_line_size)
+
+        if not 0 < last_line_length <= line_length:
+            return
+
+        characters = (full_lines * line_length) + last_line_length
+        if characters % 4:
+            return
+
+        self.line_length = line_length
+        self.line_ending_length = line_ending_length
+        self.size = (characters // 4 * 3) - padding
+
+    def get_encoded_offset(self, offset):
+        '''
+        Map an offset into the decoded data to an offset into the encoded data,
+        returning the encoded offset and the number of decoded bytes to skip.
+        '''
+
+        if not offset or self.encoding != 'base64':
+            return offset, 0
+
+        group = offset // 3
+        character = group * 4
+
+        encoded_offset = (
+            (character // self.line_length)
+            * (self.line_length + self.line_ending_length)
+            + (character % self.line_length)
+        )
+        return encoded_offset, offset - (group * 3)
+
+    def iter_bytes(self, start=0, stop=None):
+        if self.data is not None:
+            yield self.data[start:stop]
+            return
+
+        if start and self.size is None:
+            raise ValueError('Cannot seek in a part of unknown size!')
+
+        offset, skip = self.get_encoded_offset(start)
+        remaining = None if stop is None else stop - start
+
+        decoder = make_decoder(self.encoding)
+
+        while remaining is None or remaining > 0:
+            chunk = self.folder.get_email_part_range(
+                self.uid, self.part_number,
+                offset, PART_STREAM_CHUNK_SIZE,
+            )
+            offset += len(chunk)
+
+            is_last_chunk = len(chunk) < PART_STREAM_CHUNK_SIZE
+            data = decoder.decode(chunk)
+            if is_last_chunk:
+                data += decoder.flush()
+
+            if skip:
+                data = data[skip:]
+                skip = 0
+
+            if remaining is not None:
+                data = data[:remaining]
+                remaining -= len(data)
+
+            if data:
+                yield data
+
+            if is_last_chunk:
+                break
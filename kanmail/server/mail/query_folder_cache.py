@@ -0,0 +1,157 @@
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import time
+
+from kanmail.log import logger
+from kanmail.settings.constants import (
+    QUERY_FOLDER_CACHE_MAX_BYTES,
+    QUERY_FOLDER_CACHE_MAX_ITEMS,
+    QUERY_FOLDER_CACHE_REFRESH_INTERVAL,
+    QUERY_FOLDER_CACHE_TTL,
+)
+
+
+def _estimate_size(folder):
+    '''
+    Rough size (in bytes) of a query folder - the UID sets are 4 bytes per UID,
+    any ranked (search index) UIDs are a list of ints.
+    '''
+
+    size = 1000 + 4 * (len(folder.email_uids) + len(folder.seen_email_uids))
+
+    if folder.ranked_email_uids:
+        size += 60 * len(folder.ranked_email_uids)
+
+    return size
+
+
+class QueryFolderCacheItem(object):
+    def __init__(self, folder):
+        self.folder = folder
+        self.created = self.refreshed = time()
+        self.refreshing = False
+
+
+class QueryFolderCache(object):
+    '''
+    Bounded (by entry count, approximate bytes and age) in-memory LRU of query
+    (search) folders for an account, keyed by folder name + query.
+
+    Repeated searches reuse the existing folder (and it's UIDs), which is
+    refreshed in the background (without blocking the search) if it hasn't
+    been for a while, and rebuilt once older than the TTL.
+    '''
+
+    def __init__(
+        self,
+        max_items=QUERY_FOLDER_CACHE_MAX_ITEMS,
+        max_bytes=QUERY_FOLDER_CACHE_MAX_BYTES,
+        ttl=QUERY_FOLDER_CACHE_TTL,
+        refresh_interval=QUERY_FOLDER_CACHE_REFRESH_INTERVAL,
+    ):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+
+        self.lock = Lock()
+        self.items = OrderedDict()  # key -> QueryFolderCacheItem
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.evictions = 0
+
+    def get(self, key, make_folder):
+        '''
+        Get the query folder for a key, calling `make_folder` to create it if
+        missing or expired.
+        '''
+
+        now = time()
+
+        with self.lock:
+            item = self.items.get(key)
+
+            if item and now - item.created > self.ttl:
+                self.items.pop(key)
+                item = None
+
+            if item:
+                self.hits += 1
+                self.items.move_to_end(key)
+
+                if (
+                    not item.refreshing
+                    and now - item.refreshed > self.refresh_interval
+                ):
+                    item.refreshing = True
+                    self.refreshes += 1
+                    Thread(
+                        target=self.refresh,
+                        args=(item,),
+                        daemon=True,
+                        name=f'QueryFolderRefresh({item.folder})',
+                    ).start()
+
+                return item.folder
+
+            self.misses += 1
+
+        # Create the folder (which searches) outside the lock, so other searches
+        # aren't blocked.
+        folder = make_folder()
+
+        with self.lock:
+            # Another thread may have created the same folder meanwhile
+            item = self.items.get(key)
+            if item:
+                return item.folder
+
+            if self.max_items:
+                self.items[key] = QueryFolderCacheItem(folder)
+                self.evict()
+
+        return folder
+
+    def refresh(self, item):
+        try:
+            item.folder.refresh_email_uids()
+        except Exception as e:
+            logger.warning(f'Failed to refresh query folder {item.folder}: {e}')
+        finally:
+            item.refreshed = time()
+            item.refreshing = False
+
+    def evict(self):
+        total_bytes = sum(
+            _estimate_size(item.folder)
+            for item in self.items.values()
+        )
+
+        # Always keep the most recently used folder, even if over the limits
+        while len(self.items) > 1 and (
+            len(self.items) > self.max_items
+            or total_bytes > self.max_bytes
+        ):
+            _, item = self.items.popitem(last=False)
+            total_bytes -= _estimate_size(item.folder)
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'items': len(self.items),
+                'bytes': sum(
+                    _estimate_size(item.folder)
+                    for item in self.items.values()
+                ),
+                'hits': self.hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,210 @@
+'''
+Local full text search - an SQLite FTS5 index of the cached headers (subject,
+addresses & excerpt) and any fetched text parts, stored alongside the folder
+cache.
+
+Rows are keyed by the header cache item ID and removed by a trigger whenever a
+header is deleted (including via ON DELETE CASCADE), so the index can never
+return UIDs we no longer have headers for. The index only covers cached emails
+so query folders also search on the server, merging & ranking the index matches
+first (see `Folder.get_email_uids`).
+'''
+
+import re
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from kanmail.log import logger
+from kanmail.server.app import db
+
+SEARCH_INDEX_TABLE = 'folder_header_search'
+
+# Only index the start of (very) long bodies
+SEARCH_INDEX_MAX_BODY_LENGTH = 64 * 1024
+
+# Max number of UIDs to return from a single search
+SEARCH_INDEX_MAX_RESULTS = 1000
+
+CREATE_SEARCH_INDEX_SQL = (
+    f'CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_INDEX_TABLE} USING fts5('
+    'subject, addresses, excerpt, body, '
+    "tokenize = 'unicode61 remove_diacritics 2'"
+    ')'
+)
+
+CREATE_SEARCH_INDEX_TRIGGER_SQL = (
+    f'CREATE TRIGGER IF NOT EXISTS {SEARCH_INDEX_TABLE}_delete '
+    'AFTER DELETE ON folder_header_item BEGIN '
+    f'DELETE FROM {SEARCH_INDEX_TABLE} WHERE rowid = old.id; '
+    'END'
+)
+
+# FTS5 tables don't support UPSERT, so update any existing row (keeping the body)
+# and insert where missing.
+UPDATE_SEARCH_ROW_SQL = text((
+    f'UPDATE {SEARCH_INDEX_TABLE} '
+    'SET subject = :subject, addresses = :addresses, excerpt = :excerpt '
+    'WHERE rowid = :id'
+))
+
+INSERT_SEARCH_ROW_SQL = text((
+    f'INSERT INTO {SEARCH_INDEX_TABLE} (rowid, subject, addresses, excerpt) '
+    'SELECT :id, :subject, :addresses, :excerpt '
+    f'WHERE NOT EXISTS (SELECT 1 FROM {SEARCH_INDEX_TABLE} WHERE rowid = :id)'
+))
+
+# Only updates rows where the part is the header's html/plain part
+UPDATE_SEARCH_BODY_SQL = text((
+    f'UPDATE {SEARCH_INDEX_TABLE} SET body = :body WHERE rowid = ('
+    'SELECT id FROM folder_header_item '
+    'WHERE folder_id = :folder_id AND uid = :uid '
+    'AND (html_part = :part_number OR plain_part = :part_number)'
+    ')'
+))
+
+SEARCH_SQL = text((
+    'SELECT folder_header_item.uid '
+    f'FROM {SEARCH_INDEX_TABLE} '
+    f'JOIN folder_header_item ON folder_header_item.id = {SEARCH_INDEX_TABLE}.rowid '
+    f'WHERE {SEARCH_INDEX_TABLE} MATCH :query '
+    'AND folder_header_item.folder_id = :folder_id '
+    # Weight subject & address matches over the excerpt & body
+    f'ORDER BY bm25({SEARCH_INDEX_TABLE}, 10.0, 5.0, 2.0, 1.0) '
+    'LIMIT :limit'
+))
+
+REBUILD_SEARCH_INDEX_SQL = (
+    f'INSERT INTO {SEARCH_INDEX_TABLE} (rowid, subject, addresses, excerpt) '
+    'SELECT folder_header_item.id, subject, ('
+    "SELECT group_concat(coalesce(name, '') || ' ' || coalesce(email, ''), ' ') "
+    'FROM folder_header_address_item '
+    'WHERE folder_header_address_item.header_id = folder_header_item.id'
+    '), excerpt FROM folder_header_item'
+)
+
+SEARCH_TOKEN_REGEX = re.compile(r'\w+', re.UNICODE)
+
+# Queries using these can't be answered locally (Gmail style operators, etc)
+SERVER_ONLY_QUERY_CHARACTERS = (':', '"', '(', ')')
+
+# Set by `create_search_index`, disabled where SQLite lacks FTS5
+SEARCH_INDEX_ENABLED = False
+
+
+def create_search_index(connection):
+    '''
+    Create the search index table & trigger, returning whether the table was
+    newly created (and so needs building from any existing headers).
+    '''
+
+    global SEARCH_INDEX_ENABLED
+
+    has_search_index = connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (SEARCH_INDEX_TABLE,),
+    ).first()
+
+    try:
+        connection.execute(CREATE_SEARCH_INDEX_SQL)
+    except OperationalError as e:
+        logger.warning(f'Local search disabled, could not create index: {e}')
+        return False
+
+    connection.execute(CREATE_SEARCH_INDEX_TRIGGER_SQL)
+    SEARCH_INDEX_ENABLED = True
+
+    return not has_search_index
+
+
+def rebuild_search_index(connection):
+    '''
+    (Re)build the search index from all the cached headers. Bodies are indexed
+    as the text parts are fetched & cached again.
+    '''
+
+    connection.execute(f'DELETE FROM {SEARCH_INDEX_TABLE}')
+    connection.execute(REBUILD_SEARCH_INDEX_SQL)
+
+
+def make_address_text(addresses):
+    return ' '.join(
+        bit
+        for address in addresses
+        for bit in (address.get('name'), address.get('email'))
+        if bit
+    )
+
+
+def make_body_text(data):
+    if isinstance(data, bytes):
+        data = data[:SEARCH_INDEX_MAX_BODY_LENGTH].decode('utf-8', 'ignore')
+    else:
+        data = data[:SEARCH_INDEX_MAX_BODY_LENGTH]
+
+    # Remove style/script tags and content, then any other tags
+    data = re.sub(r'<(style|script).*?(?:</\1>|$)', ' ', data, flags=re.DOTALL | re.I)
+    data = re.sub(r'<[^>]*>?', ' ', data)
+    return data
+
+
+def make_search_query(query):
+    '''
+    Convert a user search query into an FTS5 query matching all of the words,
+    treating the last word as a prefix (search as you type). Returns `None` if
+    the query can't be answered by the index.
+    '''
+
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'ignore')
+
+    if not query or any(char in query for char in SERVER_ONLY_QUERY_CHARACTERS):
+        return
+
+    tokens = SEARCH_TOKEN_REGEX.findall(query)
+    if not tokens:
+        return
+
+    search_query = ' '.join(f'"{token}"' for token in tokens)
+    return f'{search_query}*'
+
+
+def index_search_headers(connection, search_values):
+    if not SEARCH_INDEX_ENABLED or not search_values:
+        return
+
+    connection.execute(UPDATE_SEARCH_ROW_SQL, search_values)
+    connection.execute(INSERT_SEARCH_ROW_SQL, search_values)
+
+
+def index_search_bodies(connection, body_values):
+    if not SEARCH_INDEX_ENABLED or not body_values:
+        return
+
+    connection.execute(UPDATE_SEARCH_BODY_SQL, body_values)
+
+
+def search_folder_uids(folder_id, query, limit=SEARCH_INDEX_MAX_RESULTS):
+    '''
+    Search the index for a given folder, returning a list of matching UIDs, best
+    match first, or `None` if the query can't be answered locally.
+    '''
+
+    if not SEARCH_INDEX_ENABLED:
+        return
+
+    search_query = make_search_query(query)
+    if not search_query:
+        return
+
+    try:
+        results = db.session.execute(SEARCH_SQL, {
+            'query': search_query,
+            'folder_id': folder_id,
+            'limit': limit,
+        }, bind=db.get_engine(bind='folders'))
+    except OperationalError as e:
+        logger.warning(f'Local search failed for query: {search_query} ({e})')
+        return
+
+    return [uid for uid, in results]
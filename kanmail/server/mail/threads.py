@@ -0,0 +1,215 @@
+'''
+Conversation threading - a persistent message ID -> thread ID index, across all
+accounts & folders, stored alongside the folder cache.
+
+This follows the JWZ threading approach (https://www.jwz.org/doc/threading.html)
+of linking messages by their References/In-Reply-To headers, including any
+referenced messages we don't have (yet), which means threads still join up
+when the messages between them aren't loaded. The index is updated as headers
+are fetched (see `FolderCache.batch_set_headers`), so each message is only
+threaded once rather than the whole thread on every list.
+'''
+
+from sqlalchemy import select
+
+from kanmail.server.app import db
+from kanmail.server.db_writer import execute_write
+
+
+class ThreadMessageItem(db.Model):
+    '''
+    Maps a message ID, which may or may not be a message we have the headers
+    for, to the ID of the thread it belongs to.
+    '''
+
+    __bind_key__ = 'folders'
+    __tablename__ = 'thread_message_item'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    message_id = db.Column(db.Text, nullable=False, unique=True)
+    thread_id = db.Column(db.Text, nullable=False, index=True)
+
+
+def clean_message_id(message_id):
+    if isinstance(message_id, bytes):
+        message_id = message_id.decode('utf-8', 'ignore')
+
+    if message_id:
+        message_id = message_id.strip().strip(',')
+
+    return message_id or None
+
+
+def make_message_references(headers):
+    '''
+    Get a (message ID, [referenced message IDs]) tuple from a headers dict, or
+    `None` if the message has no message ID.
+    '''
+
+    message_id = clean_message_id(headers.get('message_id'))
+    if not message_id:
+        return
+
+    references = []
+    for reference in (headers.get('references') or []) + [headers.get('in_reply_to')]:
+        reference = clean_message_id(reference)
+        if reference and reference != message_id and reference not in references:
+            references.append(reference)
+
+    return message_id, references
+
+
+def _update_thread_index(connection, message_references):
+    table = ThreadMessageItem.__table__
+
+    for message_id, references in message_references:
+        # References are oldest first, so the first is the thread root
+        message_ids = references + [message_id]
+
+        message_id_to_thread_id = dict(connection.execute(
+            select([table.c.message_id, table.c.thread_id])
+            .where(table.c.message_id.in_(message_ids)),
+        ).fetchall())
+
+        thread_ids = []
+        for linked_message_id in message_ids:
+            thread_id = message_id_to_thread_id.get(linked_message_id)
+            if thread_id and thread_id not in thread_ids:
+                thread_ids.append(thread_id)
+
+        if thread_ids:
+            thread_id = thread_ids[0]
+
+            # This message links multiple existing threads, merge them
+            if len(thread_ids) > 1:
+                connection.execute(
+                    table.update()
+                    .where(table.c.thread_id.in_(thread_ids[1:]))
+                    .values(thread_id=thread_id),
+                )
+        else:
+            thread_id = message_ids[0]
+
+        new_message_ids = [
+            linked_message_id
+            for linked_message_id in message_ids
+            if linked_message_id not in message_id_to_thread_id
+        ]
+
+        if new_message_ids:
+            connection.execute(table.insert().prefix_with('OR IGNORE'), [
+                {'message_id': linked_message_id, 'thread_id': thread_id}
+                for linked_message_id in new_message_ids
+            ])
+
+
+def update_thread_index(message_references, wait=True):
+    message_references = [references for references in message_references if references]
+    if message_references:
+        return execute_write('folders', _update_thread_index, message_references, wait=wait)
+
+
+def get_thread_ids(message_ids):
+    '''
+    Get a dict of message ID -> thread ID for a list of message IDs.
+    '''
+
+    message_ids = [
+        message_id for message_id in (
+            clean_message_id(message_id) for message_id in message_ids
+        )
+        if message_id
+    ]
+
+    message_id_to_thread_id = {}
+
+    for i in range(0, len(message_ids), 500):
+        message_id_to_thread_id.update(
+            db.session.query(ThreadMessageItem.message_id, ThreadMessageItem.thread_id)
+            .filter(ThreadMessageItem.message_id.in_(message_ids[i:i + 500]))
+            .all(),
+        )
+
+    return message_id_to_thread_id
+
+
+def get_thread_message_locations(thread_id):
+    '''
+    Get a list of (account name, folder name, UID) for the messages we have
+    the headers for in a given thread.
+    '''
+
+    # Avoid circular import (folder_cache updates the index)
+    from .folder_cache import FolderCacheItem, FolderHeaderCacheItem
+
+    thread_message_ids = (
+        db.session.query(ThreadMessageItem.message_id)
+        .filter(ThreadMessageItem.thread_id == thread_id)
+    )
+
+    return (
+        db.session.query(
+            FolderCacheItem.account_name,
+            FolderCacheItem.folder_name,
+            FolderHeaderCacheItem.uid,
+        )
+        .join(FolderHeaderCacheItem.folder)
+        .filter(FolderHeaderCacheItem.message_id.in_(thread_message_ids.subquery()))
+        .all()
+    )
+
+
+def get_thread_message_counts(thread_ids):
+    '''
+    Get a dict of thread ID -> number of (distinct) messages we have the headers
+    for in each thread.
+    '''
+
+    # Avoid circular import (folder_cache updates the index)
+    from .folder_cache import FolderHeaderCacheItem
+
+    if not thread_ids:
+        return {}
+
+    return dict(
+        db.session.query(
+            ThreadMessageItem.thread_id,
+            db.func.count(db.distinct(FolderHeaderCacheItem.message_id)),
+        )
+        .join(
+            FolderHeaderCacheItem,
+            FolderHeaderCacheItem.message_id == ThreadMessageItem.message_id,
+        )
+        .filter(ThreadMessageItem.thread_id.in_(list(thread_ids)))
+        .group_by(ThreadMessageItem.thread_id)
+        .all(),
+    )
+
+
+def rebuild_thread_index(connection):
+    '''
+    (Re)build the thread index from all the cached headers.
+    '''
+
+    from .folder_cache import FolderHeaderCacheItem
+
+    table = FolderHeaderCacheItem.__table__
+    connection.execute(ThreadMessageItem.__table__.delete())
+
+    message_references = []
+
+    for message_id, in_reply_to, reference_ids in connection.execute(
+        select([table.c.message_id, table.c.in_reply_to, table.c.reference_ids])
+        .where(table.c.message_id.isnot(None))
+        .order_by(table.c.timestamp),
+    ):
+        message_references.append(make_message_references({
+            'message_id': message_id,
+            'in_reply_to': in_reply_to,
+            'references': reference_ids.split() if reference_ids else None,
+        }))
+
+    _update_thread_index(connection, [
+        references for references in message_references if references
+    ])
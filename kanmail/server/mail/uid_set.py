@@ -0,0 +1,174 @@
+from array import array
+from bisect import bisect_left
+from itertools import chain
+
+# Unsigned int (4 bytes) - IMAP UIDs are 32 bit unsigned integers
+UID_TYPECODE = 'I'
+
+
+class UidSet(object):
+    '''
+    Compact, sorted set of IMAP UIDs backed by an unsigned int array. This uses
+    4 bytes per UID rather than ~60 for a Python set of ints, and serializes
+    to/from IMAP sequence sets (eg "1:4000,4002:9000") for storage.
+    '''
+
+    def __init__(self, uids=None):
+        if isinstance(uids, UidSet):
+            self._uids = array(UID_TYPECODE, uids._uids)
+        elif uids:
+            self._uids = array(UID_TYPECODE, sorted(set(uids)))
+        else:
+            self._uids = array(UID_TYPECODE)
+
+    @classmethod
+    def from_sequence_set(cls, sequence_set):
+        if isinstance(sequence_set, bytes):
+            sequence_set = sequence_set.decode()
+
+        ranges = []
+
+        for bit in sequence_set.split(','):
+            bit = bit.strip()
+            if not bit:
+                continue
+
+            if ':' in bit:
+                start, end = sorted(int(number) for number in bit.split(':', 1))
+            else:
+                start = end = int(bit)
+
+            ranges.append((start, end))
+
+        uid_set = cls()
+
+        # Already sorted & non-overlapping (as we write them), no need to de-dupe
+        if all(ranges[i][1] < ranges[i + 1][0] for i in range(len(ranges) - 1)):
+            for start, end in ranges:
+                uid_set._uids.extend(range(start, end + 1))
+            return uid_set
+
+        return cls(chain.from_iterable(
+            range(start, end + 1)
+            for start, end in ranges
+        ))
+
+    def to_sequence_set(self):
+        bits = []
+
+        start = end = None
+
+        for uid in self._uids:
+            if end is not None and uid == end + 1:
+                end = uid
+                continue
+
+            if start is not None:
+                bits.append(f'{start}:{end}' if start != end else f'{start}')
+
+            start = end = uid
+
+        if start is not None:
+            bits.append(f'{start}:{end}' if start != end else f'{start}')
+
+        return ','.join(bits)
+
+    def __repr__(self):
+        return f'UidSet({self.to_sequence_set()})'
+
+    def __len__(self):
+        return len(self._uids)
+
+    def __bool__(self):
+        return len(self._uids) > 0
+
+    def __iter__(self):
+        return iter(self._uids)
+
+    def __reversed__(self):
+        return reversed(self._uids)
+
+    def __contains__(self, uid):
+        index = bisect_left(self._uids, uid)
+        return index < len(self._uids) and self._uids[index] == uid
+
+    def __eq__(self, other):
+        if isinstance(other, UidSet):
+            return self._uids == other._uids
+
+        if isinstance(other, (set, frozenset)):
+            return len(self) == len(other) and all(uid in other for uid in self._uids)
+
+        return NotImplemented
+
+    def __sub__(self, other):
+        uid_set = self.copy()
+        uid_set.difference_update(other)
+        return uid_set
+
+    def __or__(self, other):
+        uid_set = self.copy()
+        uid_set.update(other)
+        return uid_set
+
+    def copy(self):
+        return UidSet(self)
+
+    def max(self):
+        if self._uids:
+            return self._uids[-1]
+
+    def get_highest(self, limit, below=None):
+        '''
+        Get up to `limit` of the highest UIDs (highest first), optionally only
+        those below a given UID.
+        '''
+
+        end = len(self._uids) if below is None else bisect_left(self._uids, below)
+        start = max(end - limit, 0)
+        return list(reversed(self._uids[start:end]))
+
+    def add(self, uid):
+        # Fast path - new UIDs are almost always higher than any existing ones
+        if not self._uids or uid > self._uids[-1]:
+            self._uids.append(uid)
+            return
+
+        index = bisect_left(self._uids, uid)
+        if index >= len(self._uids) or self._uids[index] != uid:
+            self._uids.insert(index, uid)
+
+    def discard(self, uid):
+        index = bisect_left(self._uids, uid)
+        if index < len(self._uids) and self._uids[index] == uid:
+            del self._uids[index]
+
+    def update(self, uids):
+        uids = sorted(set(uids))
+        if not uids:
+            return
+
+        # Append only, ie new messages
+        if not self._uids or uids[0] > self._uids[-1]:
+            self._uids.extend(uids)
+            return
+
+        self._uids = array(UID_TYPECODE, sorted(set(chain(self._uids, uids))))
+
+    def difference_update(self, uids):
+        if not isinstance(uids, (set, frozenset, UidSet)):
+            uids = set(uids)
+
+        if not uids:
+            return
+
+        # Removing only a few UIDs, delete them in place
+        if len(uids) * 8 < len(self._uids):
+            for uid in uids:
+                self.discard(uid)
+            return
+
+        self._uids = array(UID_TYPECODE, [
+            uid for uid in self._uids
+            if uid not in uids
+        ])
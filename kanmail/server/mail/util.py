@@ -4,6 +4,7 @@ import re
 
 from base64 import b64decode
 from binascii import Error as BinasciiError
+from datetime import datetime
 
 from markdown import markdown
 from mdx_linkify.mdx_linkify import LinkifyExtension
@@ -173,6 +174,20 @@ def decode_header(subject):
     return ''.join(bits)
 
 
+def get_date_timestamp(date):
+    '''
+    Get an integer timestamp from an (ISO format) email date string.
+    '''
+
+    if not date:
+        return
+
+    try:
+        return int(datetime.fromisoformat(date).timestamp())
+    except (ValueError, OverflowError, OSError):
+        pass
+
+
 def decode_string(string, string_meta=None, as_str=True):
     encoding = None
     charset = None
@@ -360,7 +375,9 @@ def _parse_bodystructure(bodystructure, item_number=None):
             if b'FILENAME' in any_attachment_data:
                 data['name'] = decode_string(any_attachment_data[b'FILENAME'])
 
-        item_number = item_number or 1
+        # Always use string part numbers so fresh & cached (see folder_cache)
+        # headers match.
+        item_number = item_number or '1'
         items[item_number] = data
 
     return items
@@ -1,7 +1,15 @@
+from concurrent.futures import (
+    ALL_COMPLETED,
+    CancelledError,
+    FIRST_EXCEPTION,
+    ThreadPoolExecutor,
+    wait,
+)
 from functools import wraps
-from queue import Queue
-from threading import RLock, Thread
+from threading import BoundedSemaphore, Event, local, Lock, RLock
+from time import time
 from typing import Optional, Union
+from weakref import WeakValueDictionary
 
 from flask import abort
 from werkzeug.datastructures import ImmutableMultiDict
@@ -38,6 +46,96 @@ def lock_class_method(func):
     return wrapper
 
 
+class SingleFlightCall(object):
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    '''
+    Run a function once for any concurrent calls with the same key, with the
+    callers that arrive while it's running waiting for and sharing the result
+    (or exception).
+
+    If `ttl` is provided successful results are also returned to calls with the
+    same key for `ttl` seconds after, absorbing bursts of identical calls.
+    '''
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+
+        self.lock = Lock()
+        self.calls = {}  # key -> SingleFlightCall
+        self.results = {}  # key -> (expires, result)
+
+        self.shared = 0
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            if key in self.results:
+                expires, result = self.results[key]
+                if expires > time():
+                    self.shared += 1
+                    return result
+                self.results.pop(key)
+
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.calls[key] = SingleFlightCall()
+            else:
+                self.shared += 1
+
+        if not is_leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                # Forgotten calls may have been replaced by a new one meanwhile
+                forgotten = self.calls.get(key) is not call
+                if not forgotten:
+                    self.calls.pop(key)
+
+                if self.ttl and not call.error and not forgotten:
+                    now = time()
+                    for expired_key in [
+                        result_key for result_key, (expires, _) in self.results.items()
+                        if expires <= now
+                    ]:
+                        self.results.pop(expired_key)
+
+                    self.results[key] = (now + self.ttl, call.result)
+
+            call.done.set()
+
+        return call.result
+
+    def forget(self, matches):
+        '''
+        Forget any in-flight calls & results where `matches(key)`, so later calls
+        run the function again rather than sharing a (now) outdated result.
+        '''
+
+        with self.lock:
+            for calls in (self.calls, self.results):
+                for key in [key for key in calls if matches(key)]:
+                    calls.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+
 def get_or_400(obj: ImmutableMultiDict, key: str) -> Union[None, str, dict]:
     data = obj.get(key)
 
@@ -65,33 +163,162 @@ def get_list_or_400(obj: ImmutableMultiDict, key: str, **kwargs) -> Optional[lis
     return data
 
 
-def execute_threaded(func, args_list):
-    queue = Queue()
+class ThreadedExecutionError(Exception):
+    '''
+    One or more tasks executed by `execute_threaded` failed (or timed out or
+    were cancelled), with the `errors` as (args, exception) tuples and the
+    ordered `results` (None for failed tasks).
+    '''
+
+    def __init__(self, errors, results):
+        self.errors = errors
+        self.results = results
+
+        error_messages = ', '.join(
+            f'{error.__class__.__name__}: {error}'
+            for _, error in errors
+        )
+        super().__init__(f'{len(errors)}/{len(results)} tasks failed: {error_messages}')
+
+
+# Shared, bounded worker pool for execute_threaded
+EXECUTOR_MAX_WORKERS = 32
 
-    def wrapper(queue, *args):
+EXECUTOR = None
+EXECUTOR_LOCK = Lock()
+EXECUTOR_STATE = local()
+
+# Only kept while in use (held by running tasks), so don't grow with every key
+KEY_SEMAPHORES = WeakValueDictionary()
+
+
+def get_executor():
+    global EXECUTOR
+
+    with EXECUTOR_LOCK:
+        if EXECUTOR is None:
+            EXECUTOR = ThreadPoolExecutor(
+                max_workers=EXECUTOR_MAX_WORKERS,
+                thread_name_prefix='Executor',
+            )
+
+    return EXECUTOR
+
+
+def _get_key_semaphore(key, limit):
+    with EXECUTOR_LOCK:
+        semaphore = KEY_SEMAPHORES.get((key, limit))
+        if semaphore is None:
+            semaphore = KEY_SEMAPHORES[(key, limit)] = BoundedSemaphore(limit)
+
+    return semaphore
+
+
+def _execute_inline(func, args_list, cancel_on_error):
+    results = [None] * len(args_list)
+    errors = []
+
+    for i, args in enumerate(args_list):
         try:
-            output = func(*args)
+            results[i] = func(*args)
         except Exception as e:
-            output = e
-        queue.put(output)
+            errors.append((args, e))
+            if cancel_on_error:
+                break
+
+    if errors:
+        raise ThreadedExecutionError(errors, results)
+    return results
+
+
+def execute_threaded(func, args_list, key=None, limit=None, timeout=None, cancel_on_error=False):
+    '''
+    Execute `func(*args)` for each args tuple on the shared worker pool and
+    return the results in the same order.
+
+    If `key` and `limit` are provided no more than `limit` tasks for each
+    `key(*args)` (ie an account) run at once, across all callers - `limit` may
+    also be a function of the key (ie the account's connection limit). Tasks not
+    complete within `timeout` seconds, or still pending after a failure when
+    `cancel_on_error` is set, are cancelled. Any failures are raised together,
+    once all tasks have finished, as a `ThreadedExecutionError`.
+    '''
+
+    args_list = list(args_list)
+
+    # Already in a worker - execute inline, waiting on tasks queued behind us
+    # in the pool could otherwise deadlock.
+    if getattr(EXECUTOR_STATE, 'in_worker', False):
+        return _execute_inline(func, args_list, cancel_on_error)
+
+    def run_task(args):
+        EXECUTOR_STATE.in_worker = True
+        return func(*args)
+
+    executor = get_executor()
+    deadline = time() + timeout if timeout else None
+
+    def get_remaining_time():
+        if deadline:
+            return max(deadline - time(), 0)
+
+    futures = [None] * len(args_list)
+
+    for i, args in enumerate(args_list):
+        semaphore = None
+        if key and limit:
+            task_key = key(*args)
+            task_limit = limit(task_key) if callable(limit) else limit
+            semaphore = _get_key_semaphore(task_key, task_limit)
+
+            if not semaphore.acquire(timeout=get_remaining_time()):
+                break
+
+        # Checked after waiting for the semaphore, as a task may have failed since
+        if cancel_on_error and any(
+            future.done() and not future.cancelled() and future.exception()
+            for future in futures[:i]
+        ):
+            if semaphore:
+                semaphore.release()
+            break
+
+        future = executor.submit(run_task, args)
+        if semaphore:
+            future.add_done_callback(lambda _, semaphore=semaphore: semaphore.release())
+
+        futures[i] = future
+
+    pending = {future for future in futures if future}
+    return_when = FIRST_EXCEPTION if cancel_on_error else ALL_COMPLETED
+
+    while pending:
+        done, pending = wait(pending, timeout=get_remaining_time(), return_when=return_when)
 
-    threads = []
+        if not done or (cancel_on_error and any(
+            not future.cancelled() and future.exception()
+            for future in done
+        )):
+            break
 
-    for args in args_list:
-        args = (queue,) + args
-        thread = Thread(target=wrapper, args=args)
-        threads.append(thread)
-        thread.start()
+    for future in pending:
+        future.cancel()
 
-    for thread in threads:
-        thread.join()
+    results = [None] * len(args_list)
+    errors = []
 
-    # Grab the queue - not thread safe but after threads :)
-    items = list(queue.queue)
+    for i, (args, future) in enumerate(zip(args_list, futures)):
+        if future is None or future.cancelled() or not future.done():
+            error = TimeoutError(f'Timed out after {timeout}s') if (
+                deadline and time() >= deadline
+            ) else CancelledError('Cancelled after another task failed')
+            errors.append((args, error))
+        elif future.exception():
+            errors.append((args, future.exception()))
+        else:
+            results[i] = future.result()
 
-    # Raise any exceptions (will only raise first)
-    for item in items:
-        if isinstance(item, Exception):
-            raise item
+    if errors:
+        raise ThreadedExecutionError(errors, results)
 
-    return items
+    return results
@@ -5,7 +5,11 @@ from imapclient import imapclient
 
 from kanmail.log import logger
 from kanmail.server.app import add_route
-from kanmail.server.mail import Account
+from kanmail.server.mail import (
+    Account,
+    get_connection_pool_stats,
+    get_query_folder_cache_stats,
+)
 from kanmail.server.mail.autoconf import get_autoconf_settings
 from kanmail.server.mail.oauth import set_oauth_tokens
 
@@ -158,6 +162,19 @@ def api_test_account_settings():
     return jsonify(connected=True, settings=account_settings)
 
 
+@add_route('/api/account/stats', methods=('GET',))
+def api_get_account_stats():
+    '''
+    Get IMAP connection pool stats (connections in use/idle, wait times) and
+    query folder cache stats for each account.
+    '''
+
+    return jsonify(
+        connection_pools=get_connection_pool_stats(),
+        query_folder_caches=get_query_folder_cache_stats(),
+    )
+
+
 @add_route('/api/account/new', methods=('POST',))
 def api_test_new_account_settings():
     '''
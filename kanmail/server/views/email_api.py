@@ -2,20 +2,26 @@ from functools import wraps
 from os import path
 from urllib.parse import unquote
 
-from flask import jsonify, make_response, request, Response
+from flask import abort, jsonify, make_response, request, Response
 
 from kanmail.server.app import add_route
 from kanmail.server.mail import (
     append_folder_email,
+    ColumnCursorError,
     copy_folder_emails,
     delete_folder_emails,
     get_account,
     get_all_folders,
-    get_folder_email_part,
+    get_column_emails,
+    get_column_threads,
+    get_folder_email_part_stream,
     get_folder_email_texts,
     get_folder_emails,
+    get_folder_events,
+    get_thread_emails,
     move_folder_emails,
     star_folder_emails,
+    sync_all_folder_emails,
     sync_folder_emails,
     unstar_folder_emails,
 )
@@ -36,6 +42,28 @@ def api_get_folders() -> Response:
     return jsonify(folders=folders, folder_meta=meta)
 
 
+@add_route('/api/emails/events', methods=('GET',))
+def api_get_email_events() -> Response:
+    '''
+    Long-poll for folder change events (new/deleted/changed emails) pushed from
+    the server via IMAP IDLE.
+    '''
+
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            abort(400, 'invalid since')
+
+    events, latest_id, epoch = get_folder_events(
+        since=since,
+        epoch=request.args.get('epoch'),
+    )
+
+    return jsonify(events=events, latest_id=latest_id, epoch=epoch)
+
+
 def _fix_flask_path_fail(func):
     '''
     Fix for nonsense from werkzeug: https://github.com/pallets/flask/issues/900
@@ -73,6 +101,74 @@ def api_get_account_folder_emails(account, folder) -> Response:
     return jsonify(emails=emails, meta=meta)
 
 
+@add_route('/api/columns/<folder>/emails', methods=('GET',))
+def api_get_column_emails(folder) -> Response:
+    '''
+    Get a page of emails for a folder across all accounts, merged by date. Pass
+    the returned `next_cursor` as `cursor` to get the following page. API only,
+    not yet used by the client.
+    '''
+
+    batch_size = None
+
+    try:
+        batch_size = int(request.args.get('batch_size'))  # type: ignore
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        emails, next_cursor, meta = get_column_emails(
+            unquote(folder),
+            query=request.args.get('query'),
+            cursor=request.args.get('cursor'),
+            batch_size=batch_size,
+        )
+    except ColumnCursorError as e:
+        abort(400, f'{e}')
+
+    return jsonify(emails=emails, next_cursor=next_cursor, meta=meta)
+
+
+@add_route('/api/columns/<folder>/threads', methods=('GET',))
+def api_get_column_threads(folder) -> Response:
+    '''
+    Get a page of emails for a folder across all accounts grouped into threads,
+    paginated like `api_get_column_emails`. API only, not yet used by the client.
+    '''
+
+    batch_size = None
+
+    try:
+        batch_size = int(request.args.get('batch_size'))  # type: ignore
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        threads, next_cursor, meta = get_column_threads(
+            unquote(folder),
+            query=request.args.get('query'),
+            cursor=request.args.get('cursor'),
+            batch_size=batch_size,
+        )
+    except ColumnCursorError as e:
+        abort(400, f'{e}')
+
+    return jsonify(threads=threads, next_cursor=next_cursor, meta=meta)
+
+
+@add_route('/api/threads', methods=('GET',))
+def api_get_thread_emails() -> Response:
+    '''
+    Get all the emails in a thread (by thread ID) across accounts and folders.
+    API only, not yet used by the client.
+    '''
+
+    thread_id = get_or_400(request.args, 'thread_id')
+    emails = get_thread_emails(thread_id)
+
+    return jsonify(thread_id=thread_id, emails=emails)
+
+
 @add_route('/api/emails/<account>/<folder>/sync', methods=('GET',))
 @_fix_flask_path_fail
 def api_sync_account_folder_emails(account, folder) -> Response:
@@ -100,6 +196,46 @@ def api_sync_account_folder_emails(account, folder) -> Response:
     )
 
 
+@add_route('/api/folders/sync', methods=('POST',))
+def api_sync_all_folder_emails() -> Response:
+    '''
+    Sync emails within multiple account/folders in one request - takes a list
+    of folder syncs (account, folder and optional query, uid_count and
+    unread_uids) and returns the results for each in the same order. API only,
+    not yet used by the client.
+    '''
+
+    request_data = request.get_json(silent=True)
+    if not isinstance(request_data, dict):
+        abort(400, 'invalid JSON body')
+
+    folder_syncs = get_or_400(request_data, 'folders')
+    if not isinstance(folder_syncs, list):
+        abort(400, 'invalid data: folders')
+
+    for folder_sync in folder_syncs:
+        if not isinstance(folder_sync, dict):
+            abort(400, 'invalid data: folders')
+
+        get_or_400(folder_sync, 'account')
+        get_or_400(folder_sync, 'folder')
+
+        try:
+            uid_count = folder_sync.get('uid_count')
+            if uid_count:
+                folder_sync['uid_count'] = int(uid_count)
+
+            folder_sync['unread_uids'] = [
+                int(uid) for uid in folder_sync.get('unread_uids') or []
+            ]
+        except (TypeError, ValueError) as e:
+            abort(400, f'invalid data: {e}')
+
+    results = sync_all_folder_emails(folder_syncs)
+
+    return jsonify(results=results)
+
+
 @add_route('/api/emails/<account>/<folder>/text', methods=('GET',))
 @_fix_flask_path_fail
 def api_get_account_email_texts(account, folder) -> Response:
@@ -114,24 +250,58 @@ def api_get_account_email_texts(account, folder) -> Response:
     return jsonify(emails=emails)
 
 
+def _make_part_not_found_response(part_number) -> Response:
+    response = jsonify(error=f'Could not find part: {part_number}')
+    response.status_code = 404
+    return response
+
+
 @add_route('/api/emails/<account>/<folder>/<int:uid>/<part_number>', methods=('GET',))
 @_fix_flask_path_fail
 def api_get_account_email_part(account, folder, uid, part_number) -> Response:
     '''
-    Return a specific part of an email by account/folder/UID.
+    Return a specific part of an email by account/folder/UID. The part is
+    streamed and supports (single) byte range requests where the size of the
+    decoded part is known.
     '''
 
-    mime_type, data = get_folder_email_part(
-        account, folder, uid, part_number,
-    )
-
-    if mime_type is None:
-        response = jsonify(error=f'Could not find part: {part_number}')
-        response.status_code = 404
-        return response
-
-    response = make_response(data)
-    response.headers['Content-Type'] = mime_type
+    stream = get_folder_email_part_stream(account, folder, uid, part_number)
+
+    if stream is None:
+        return _make_part_not_found_response(part_number)
+
+    content_type = stream.mime_type
+    if stream.charset:
+        content_type = f'{content_type}; charset={stream.charset}'
+
+    byte_range = None
+    if (
+        stream.size is not None
+        and request.range
+        and request.range.units == 'bytes'
+        and len(request.range.ranges) == 1
+    ):
+        byte_range = request.range.range_for_length(stream.size)
+
+        if byte_range is None:
+            response = make_response('', 416)
+            response.headers['Content-Range'] = f'bytes */{stream.size}'
+            return response
+
+    if byte_range:
+        start, stop = byte_range
+        response = Response(stream.iter_bytes(start, stop), status=206)
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{stream.size}'
+        response.content_length = stop - start
+    else:
+        response = Response(stream.iter_bytes())
+        if stream.size is not None:
+            response.content_length = stream.size
+
+    if stream.size is not None:
+        response.headers['Accept-Ranges'] = 'bytes'
+
+    response.headers['Content-Type'] = content_type
     return response
 
 
@@ -155,20 +325,14 @@ def api_download_account_email_part(account, folder, uid, part_number) -> Respon
         if extension:
             local_filename = f'{local_filename}.{extension}'
 
-    mime_type, data = get_folder_email_part(
-        account, folder, uid, part_number,
-    )
-
-    if mime_type is None:
-        response = jsonify(error=f'Could not find part: {part_number}')
-        response.status_code = 404
-        return response
+    stream = get_folder_email_part_stream(account, folder, uid, part_number)
 
-    if isinstance(data, str):
-        data = data.encode()
+    if stream is None:
+        return _make_part_not_found_response(part_number)
 
     with open(local_filename, 'wb') as f:
-        f.write(data)
+        for chunk in stream.iter_bytes():
+            f.write(chunk)
 
     return jsonify(saved=True, filename=local_filename)
 
@@ -6,6 +6,7 @@ from werkzeug.exceptions import HTTPException
 from kanmail.log import logger
 from kanmail.server.app import app
 from kanmail.server.mail.connection import ConnectionSettingsError, ImapConnectionError
+from kanmail.server.util import ThreadedExecutionError
 
 
 @app.errorhandler(400)
@@ -46,6 +47,26 @@ def error_network_exception(e) -> Response:
     ), 503)
 
 
+@app.errorhandler(ThreadedExecutionError)
+def error_threaded_exception(e) -> Response:
+    # Only report as a network/settings error if every task failed that way
+    status_code = 500
+    for error_class, error_status_code in (
+        (ConnectionSettingsError, 400),
+        (ImapConnectionError, 503),
+    ):
+        if all(isinstance(error, error_class) for _, error in e.errors):
+            status_code = error_status_code
+
+    trace = traceback.format_exc().strip()
+    logger.warning(f'Threaded error(s) in view: {e}: {trace}')
+    return make_response(jsonify(
+        status_code=status_code,
+        error_name=e.__class__.__name__,
+        error_message=f'{e}',
+    ), status_code)
+
+
 @app.errorhandler(Exception)
 def error_unexpected_exception(e) -> Response:
     if isinstance(e, HTTPException):
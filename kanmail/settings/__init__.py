@@ -19,6 +19,7 @@ from .constants import (
     DEVICE_ID_FILE,
     ICON_CACHE_DIR,
     LOG_FILE,
+    PART_CACHE_DIR,
     SETTINGS_FILE,
     WINDOW_CACHE_FILE,
 )
@@ -28,7 +29,7 @@ from .model import fix_any_old_setings, get_default_settings, validate_settings
 # Bootstrap logging before we use logging!
 #
 
-for needed_dir in (APP_DIR, CACHE_DIR, ICON_CACHE_DIR):
+for needed_dir in (APP_DIR, CACHE_DIR, ICON_CACHE_DIR, PART_CACHE_DIR):
     if not path.exists(needed_dir):
         makedirs(needed_dir)
 
@@ -28,6 +28,7 @@ APP_DIR = environ.get('KANMAIL_APP_DIR', get_app_dir(APP_NAME))
 # Cache directory
 CACHE_DIR = path.join(APP_DIR, 'cache')
 ICON_CACHE_DIR = path.join(CACHE_DIR, 'icons')
+PART_CACHE_DIR = path.join(CACHE_DIR, 'parts')
 
 CONTACTS_CACHE_DB_FILE = path.join(CACHE_DIR, 'contacts.db')
 FOLDER_CACHE_DB_FILE = path.join(CACHE_DIR, 'folders.db')
@@ -78,6 +79,22 @@ CACHE_ENABLED = (
     and not environ.get('KANMAIL_FAKE_IMAP') == 'on'  # never cache fake IMAP responses
 )
 
+# Limits for the in-memory email header LRU (in front of the folder cache)
+HEADER_CACHE_MAX_ITEMS = int(environ.get('KANMAIL_HEADER_CACHE_ITEMS', 10000))
+HEADER_CACHE_MAX_BYTES = int(environ.get('KANMAIL_HEADER_CACHE_BYTES', 32 * 1024 * 1024))
+
+# Limits for the in-memory LRU of query (search) folders, each is refreshed in
+# the background when reused after the refresh interval & dropped after the TTL.
+QUERY_FOLDER_CACHE_MAX_ITEMS = int(environ.get('KANMAIL_QUERY_FOLDER_CACHE_ITEMS', 50))
+QUERY_FOLDER_CACHE_MAX_BYTES = int(environ.get('KANMAIL_QUERY_FOLDER_CACHE_BYTES', 16 * 1024 * 1024))
+QUERY_FOLDER_CACHE_TTL = 30 * 60
+QUERY_FOLDER_CACHE_REFRESH_INTERVAL = 60
+
+# Total size budget for cached email parts, and the size above which parts are
+# stored as files (in PART_CACHE_DIR) rather than in the database.
+PART_CACHE_MAX_BYTES = int(environ.get('KANMAIL_PART_CACHE_BYTES', 512 * 1024 * 1024))
+PART_CACHE_INLINE_MAX_BYTES = 64 * 1024
+
 
 # Get the client root directory - if we're frozen (by pyinstaller) this is relative
 # to the executable, otherwise ./client.
@@ -36,6 +36,8 @@ MODEL = {
         'initial_batches': (int, 3),
         'sync_days': (int, 0),
         'sync_interval': (int, 60000),
+        # Show cached emails before connecting, then reconcile with the server
+        'offline_startup': (bool, False),
         'undo_ms': (int, 5000),
         'load_contact_icons': (bool, True),
         'group_single_sender_threads': (bool, True),
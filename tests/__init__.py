@@ -0,0 +1,5 @@
+from os import environ
+from tempfile import mkdtemp
+
+# Never touch the real app directory (settings/caches) when testing
+environ.setdefault('KANMAIL_APP_DIR', mkdtemp(prefix='kanmail-tests-'))
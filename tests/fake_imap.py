@@ -0,0 +1,378 @@
+'''
+A deterministic, in-memory IMAP server for tests, its clients patched in place
+of IMAPClient (like connection_mocks, which serves random data for development).
+Supports CONDSTORE/QRESYNC style changes (MODSEQ, CHANGEDSINCE & VANISHED).
+'''
+
+import re
+
+from datetime import datetime
+from os import path, remove
+from types import SimpleNamespace
+from unittest import mock, TestCase
+
+from imapclient.exceptions import IMAPClientError
+from imapclient.response_types import Address, Envelope
+
+from kanmail.server.app import db
+from kanmail.server.mail.account import Account
+from kanmail.server.mail.folder_cache import upgrade_folder_cache
+from kanmail.server.mail.header_cache import HEADER_CACHE
+from kanmail.settings.constants import FOLDER_CACHE_DB_FILE
+
+CONDSTORE_CAPABILITIES = (b'IMAP4REV1', b'ENABLE', b'CONDSTORE', b'QRESYNC')
+
+HEADER_FIELDS_KEY = b'BODY[HEADER.FIELDS (REFERENCES CONTENT-TRANSFER-ENCODING)]'
+
+
+def reset_folder_cache_db():
+    '''
+    Start each test with an empty folder cache.
+    '''
+
+    # Including sessions left by (pooled) worker threads, which would otherwise
+    # keep reading the removed database file.
+    sessions = db.session.registry.registry
+    for session in list(sessions.values()):
+        session.close()
+    sessions.clear()
+
+    HEADER_CACHE.clear()
+
+    db.get_engine(bind='folders').dispose()
+
+    for suffix in ('', '-wal', '-shm'):
+        filename = f'{FOLDER_CACHE_DB_FILE}{suffix}'
+        if path.exists(filename):
+            remove(filename)
+
+    db.create_all()
+    upgrade_folder_cache()
+
+
+def make_account(name='account', **imap_settings):
+    return Account(name, {
+        'imap_connection': {
+            'host': 'imap.example.com',
+            'port': 993,
+            'username': f'{name}@example.com',
+            'password': 'password',
+            'max_attempts': 0,
+            **imap_settings,
+        },
+        'smtp_connection': {
+            'host': 'smtp.example.com',
+            'port': 465,
+            'username': f'{name}@example.com',
+            'password': 'password',
+        },
+        'folders': {
+            'inbox': 'INBOX',
+        },
+    })
+
+
+class FakeImapTestCase(TestCase):
+    '''
+    Tests against fake IMAP servers (one per host, `self.server` for the default
+    imap.example.com) with an empty folder cache.
+    '''
+
+    capabilities = CONDSTORE_CAPABILITIES
+
+    def setUp(self):
+        reset_folder_cache_db()
+
+        self.servers = {}
+        self.server = self.add_server('imap.example.com')
+
+        patcher = mock.patch('kanmail.server.mail.connection.IMAPClient', self.make_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_server(self, host):
+        server = self.servers[host] = FakeImapServer(capabilities=self.capabilities)
+        return server
+
+    def make_client(self, host, *args, **kwargs):
+        return self.servers[host].make_client()
+
+
+def _parse_uids(folder, uids):
+    if isinstance(uids, str):  # only 1:* is used
+        return list(folder.messages)
+    return [uid for uid in uids if uid in folder.messages]
+
+
+class FakeMessage(object):
+    def __init__(self, uid, subject, body, flags, charset, date):
+        self.uid = uid
+        self.subject = subject
+        self.body = body
+        self.flags = tuple(flags)
+        self.charset = charset
+        self.date = date
+        self.modseq = 0
+
+
+class FakeFolder(object):
+    def __init__(self, name, uid_validity):
+        self.name = name
+        self.uid_validity = uid_validity
+        self.uid_next = 1
+        self.highest_modseq = 1
+        self.messages = {}
+        # UID -> modseq of expunge
+        self.vanished = {}
+
+    def bump_modseq(self):
+        self.highest_modseq += 1
+        return self.highest_modseq
+
+
+class FakeImapServer(object):
+    def __init__(self, capabilities=CONDSTORE_CAPABILITIES):
+        self.capabilities = tuple(capabilities)
+        self.folders = {}
+        self.clients = []
+        # List of (command, folder name) tuples
+        self.commands = []
+
+        self.add_folder('INBOX')
+
+    def make_client(self):
+        client = FakeImapClient(self)
+        self.clients.append(client)
+        return client
+
+    def get_commands(self, command):
+        return [folder_name for name, folder_name in self.commands if name == command]
+
+    def get_folder_status(self, folder):
+        status = {
+            b'UIDVALIDITY': folder.uid_validity,
+            b'UIDNEXT': folder.uid_next,
+            b'MESSAGES': len(folder.messages),
+        }
+        if b'CONDSTORE' in self.capabilities:
+            status[b'HIGHESTMODSEQ'] = folder.highest_modseq
+        return status
+
+    def add_folder(self, name, uid_validity=1):
+        self.folders[name] = FakeFolder(name, uid_validity)
+
+    def reset_folder(self, name, uid_validity):
+        '''
+        Recreate a folder with a new UIDVALIDITY, keeping the messages (renumbered).
+        '''
+
+        messages = self.folders[name].messages.values()
+        self.add_folder(name, uid_validity)
+
+        for message in messages:
+            self.add_message(
+                name, message.subject, message.body,
+                flags=message.flags, charset=message.charset, date=message.date,
+            )
+
+    def add_message(
+        self, folder_name, subject,
+        body='Hello', flags=(), charset='UTF-8', date=None,
+    ):
+        folder = self.folders[folder_name]
+
+        uid = folder.uid_next
+        folder.uid_next += 1
+
+        message = FakeMessage(
+            uid, subject, body, flags, charset,
+            date or datetime(2020, 1, 1, 10, uid % 60),
+        )
+        message.modseq = folder.bump_modseq()
+        folder.messages[uid] = message
+        return uid
+
+    def set_flags(self, folder_name, uid, flags):
+        folder = self.folders[folder_name]
+        message = folder.messages[uid]
+        message.flags = tuple(flags)
+        message.modseq = folder.bump_modseq()
+
+    def expunge(self, folder_name, uids):
+        folder = self.folders[folder_name]
+        modseq = folder.bump_modseq()
+
+        for uid in uids:
+            folder.messages.pop(uid)
+            folder.vanished[uid] = modseq
+
+
+class FakeImapClient(object):
+    normalise_times = True
+
+    def __init__(self, server):
+        self.server = server
+        self.selected_folder_name = None
+        self.enabled = []
+        self.logged_out = False
+        # Set to make NOOPs fail, like a dropped connection
+        self.dead = False
+        # Mirror the underlying imaplib client's untagged responses
+        self._imap = SimpleNamespace(untagged_responses={})
+
+    @property
+    def selected_folder(self):
+        # Looked up by name as the server may recreate folders (see reset_folder)
+        return self.server.folders[self.selected_folder_name]
+
+    def command(self, name, folder_name=None):
+        self.server.commands.append((name, folder_name))
+
+    def get_folder(self, folder_name):
+        folder = self.server.folders.get(folder_name)
+        if folder is None:
+            raise IMAPClientError(f'NO folder does not exist: {folder_name}')
+        return folder
+
+    # Connection
+    #
+
+    def login(self, username, password):
+        self.command('login')
+
+    def logout(self):
+        self.logged_out = True
+
+    def noop(self):
+        self.command('noop')
+        if self.dead:
+            raise IMAPClientError('connection is dead')
+
+    def capabilities(self):
+        return self.server.capabilities
+
+    def enable(self, *capabilities):
+        self.enabled.extend(capabilities)
+
+    # Folders
+    #
+
+    def list_folders(self):
+        return [((), b'/', name) for name in self.server.folders]
+
+    def folder_exists(self, folder_name):
+        return folder_name in self.server.folders
+
+    def folder_status(self, folder_name, keys):
+        self.command('status', folder_name)
+        return self.server.get_folder_status(self.get_folder(folder_name))
+
+    def select_folder(self, folder_name, readonly=False):
+        self.command('select', folder_name)
+        self.get_folder(folder_name)
+        self.selected_folder_name = folder_name
+
+    def unselect_folder(self):
+        self.selected_folder_name = None
+
+    # Messages
+    #
+
+    def search(self, criteria, charset=None):
+        self.command('search', self.selected_folder.name)
+        messages = self.selected_folder.messages.values()
+
+        # Only OR SUBJECT <query> BODY <query> searches, otherwise everything
+        if 'SUBJECT' in criteria:
+            query = criteria[criteria.index('SUBJECT') + 1].lower()
+            messages = [
+                message for message in messages
+                if query in message.subject.lower() or query in message.body.lower()
+            ]
+
+        return [message.uid for message in messages]
+
+    def fetch(self, uids, keys, modifiers=None):
+        folder = self.selected_folder
+        self.command('fetch', folder.name)
+
+        changed_since = None
+        for modifier in modifiers or ():
+            match = re.match(r'CHANGEDSINCE (\d+)', modifier)
+            if match:
+                changed_since = int(match.group(1))
+
+        uids = _parse_uids(folder, uids)
+
+        if changed_since is not None:
+            self.command('fetch_changed', folder.name)
+
+            if 'VANISHED' in modifiers:
+                vanished_uids = [
+                    uid for uid, modseq in folder.vanished.items()
+                    if modseq > changed_since
+                ]
+                if vanished_uids:
+                    self._imap.untagged_responses.setdefault('VANISHED', []).append(
+                        '(EARLIER) ' + ','.join(str(uid) for uid in vanished_uids),
+                    )
+
+            uids = [uid for uid in uids if folder.messages[uid].modseq > changed_since]
+
+        return {
+            uid: self.make_fetch_item(folder.messages[uid], keys)
+            for uid in uids
+        }
+
+    def make_fetch_item(self, message, keys):
+        item = {b'SEQ': message.uid}
+
+        for key in keys:
+            if key == 'FLAGS':
+                item[b'FLAGS'] = message.flags
+            elif key == 'RFC822.SIZE':
+                item[b'RFC822.SIZE'] = len(message.body)
+            elif key == 'ENVELOPE':
+                address = (Address(b'Sender', None, b'sender', b'example.com'),)
+                item[b'ENVELOPE'] = Envelope(
+                    message.date, message.subject.encode(),
+                    address, address, address,
+                    None, None, None, None,
+                    f'<{message.uid}@example.com>'.encode(),
+                )
+            elif key == 'BODYSTRUCTURE':
+                params = (b'CHARSET', message.charset.encode()) if message.charset else None
+                item[b'BODYSTRUCTURE'] = (
+                    b'TEXT', b'PLAIN', params, None, None, b'7BIT', len(message.body),
+                )
+            elif key.startswith('BODY.PEEK[HEADER.FIELDS'):
+                item[HEADER_FIELDS_KEY] = b'\r\n'
+            elif key.startswith('BODY.PEEK[1]<'):
+                item[b'BODY[1]<0>'] = message.body.encode()
+            elif key == 'BODY[1]':
+                item[b'BODY[1]'] = message.body.encode()
+                if b'\\Seen' not in message.flags:
+                    self.server.set_flags(
+                        self.selected_folder.name, message.uid,
+                        message.flags + (b'\\Seen',),
+                    )
+            else:
+                raise ValueError(f'Unsupported fetch key: {key}')
+
+        return item
+
+    def add_flags(self, uids, flags):
+        for uid in _parse_uids(self.selected_folder, uids):
+            message = self.selected_folder.messages[uid]
+            new_flags = tuple(flag for flag in flags if flag not in message.flags)
+            if new_flags:
+                self.server.set_flags(
+                    self.selected_folder.name, uid, message.flags + new_flags,
+                )
+
+    def remove_flags(self, uids, flags):
+        for uid in _parse_uids(self.selected_folder, uids):
+            message = self.selected_folder.messages[uid]
+            self.server.set_flags(self.selected_folder.name, uid, tuple(
+                flag for flag in message.flags if flag not in flags
+            ))
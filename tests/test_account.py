@@ -0,0 +1,235 @@
+from threading import Barrier, Event, Lock, Thread
+from time import sleep
+from unittest import mock, TestCase
+
+from kanmail.server.mail import account as account_module
+from kanmail.server.mail.account import Account
+from kanmail.server.mail.connection import ImapConnectionWrapper
+
+from .fake_imap import CONDSTORE_CAPABILITIES, FakeImapTestCase, make_account
+
+ACCOUNT_SETTINGS = {
+    'imap_connection': {
+        'host': 'imap.example.com',
+        'port': 993,
+        'username': 'user@example.com',
+    },
+    'smtp_connection': {
+        'host': 'smtp.example.com',
+        'port': 465,
+        'username': 'user@example.com',
+    },
+    'folders': {
+        'inbox': 'INBOX',
+        'archive': 'Archive',
+    },
+}
+
+
+class FakeFolder(object):
+    '''
+    Slow to create (like a real folder, which connects & searches the server).
+    '''
+
+    lock = Lock()
+    created = []
+    creating = 0
+    max_creating = 0
+
+    def __init__(self, name, alias_name, account, query=None):
+        cls = type(self)
+
+        with cls.lock:
+            cls.creating += 1
+            cls.max_creating = max(cls.max_creating, cls.creating)
+
+        sleep(0.1)
+
+        with cls.lock:
+            cls.creating -= 1
+            cls.created.append((name, query))
+
+        self.name = name
+        self.alias_name = alias_name
+        self.query = query
+
+        self.email_uids = self.seen_email_uids = ()
+        self.ranked_email_uids = None
+
+
+class TestAccountGetFolder(TestCase):
+    def setUp(self):
+        FakeFolder.created = []
+        FakeFolder.creating = 0
+        FakeFolder.max_creating = 0
+
+        patcher = mock.patch.object(account_module, 'Folder', FakeFolder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.account = Account('account', ACCOUNT_SETTINGS)
+
+    def get_folders_concurrently(self, *args_list):
+        results = [None] * len(args_list)
+        barrier = Barrier(len(args_list))
+
+        def target(i, args):
+            barrier.wait()
+            results[i] = self.account.get_folder(*args)
+
+        threads = [
+            Thread(target=target, args=(i, args))
+            for i, args in enumerate(args_list)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_same_folder_created_once(self):
+        folders = self.get_folders_concurrently(*[('inbox',)] * 5)
+
+        assert FakeFolder.created == [('INBOX', None)]
+        assert all(folder is folders[0] for folder in folders)
+        assert self.account.folders == {'INBOX': folders[0]}
+
+        # Created folders are reused
+        assert self.account.get_folder('inbox') is folders[0]
+        assert len(FakeFolder.created) == 1
+
+    def test_different_folders_created_in_parallel(self):
+        folders = self.get_folders_concurrently(('inbox',), ('archive',), ('Other',))
+
+        assert [folder.name for folder in folders] == ['INBOX', 'Archive', 'Other']
+        assert sorted(FakeFolder.created) == [
+            ('Archive', None),
+            ('INBOX', None),
+            ('Other', None),
+        ]
+        assert FakeFolder.max_creating == 3
+
+    def test_same_query_folder_created_once(self):
+        folders = self.get_folders_concurrently(*[('inbox', 'lunch')] * 5)
+
+        assert FakeFolder.created == [('INBOX', 'lunch')]
+        assert all(folder is folders[0] for folder in folders)
+        # Query folders are kept separately from the account's folders
+        assert self.account.folders == {}
+
+
+class TestAccountFolderStatuses(FakeImapTestCase):
+    capabilities = CONDSTORE_CAPABILITIES + (b'LIST-STATUS',)
+
+    def setUp(self):
+        super().setUp()
+
+        self.server.add_folder('Archive')
+        self.account = make_account()
+
+        self.list_calls = 0
+        self.list_started = Event()
+        self.list_release = Event()
+        self.list_release.set()
+
+        patcher = mock.patch.object(
+            ImapConnectionWrapper, 'list_folder_statuses', self.list_folder_statuses,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def list_folder_statuses(self, status_keys):
+        self.list_calls += 1
+        self.list_started.set()
+        self.list_release.wait()
+
+        return {
+            folder_name: self.server.get_folder_status(folder)
+            for folder_name, folder in self.server.folders.items()
+        }
+
+    def get_statuses(self, *folder_names):
+        self.server.commands = []
+        return self.account.get_folder_statuses(folder_names)
+
+    def test_list_status(self):
+        statuses = self.get_statuses('INBOX', 'Archive', 'Missing')
+
+        assert set(statuses) == {'INBOX', 'Archive'}
+        assert self.list_calls == 1
+
+        # Cached, and missing folders aren't looked up individually
+        assert self.get_statuses('INBOX', 'Missing') == {'INBOX': statuses['INBOX']}
+        assert self.list_calls == 1
+        assert self.server.get_commands('status') == []
+
+    def test_invalidate_single_folder(self):
+        self.get_statuses('INBOX', 'Archive')
+        self.server.add_message('INBOX', 'New email')
+
+        self.account.invalidate_folder_status('INBOX')
+        statuses = self.get_statuses('INBOX', 'Archive')
+
+        # Only the invalidated folder is fetched again, not every folder
+        assert self.list_calls == 1
+        assert self.server.get_commands('status') == ['INBOX']
+        assert statuses['INBOX'][b'MESSAGES'] == 1
+
+    def test_invalidate_created_folder(self):
+        self.get_statuses('INBOX')
+        self.server.add_folder('New')
+
+        assert self.get_statuses('New') == {}
+
+        self.account.invalidate_folder_status('New')
+        assert set(self.get_statuses('New')) == {'New'}
+        assert self.list_calls == 1
+
+    def test_fetch_outside_lock(self):
+        self.list_release.clear()
+        results = []
+
+        def get_statuses():
+            results.append(self.account.get_folder_statuses(['INBOX']))
+
+        threads = [Thread(target=get_statuses) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+
+        self.list_started.wait()
+        # Not held while fetching, and the concurrent fetches are shared
+        assert self.account.folder_statuses_lock.acquire(blocking=False)
+        self.account.folder_statuses_lock.release()
+
+        # Changed while the status is being fetched
+        self.server.add_message('INBOX', 'New email')
+        self.account.invalidate_folder_status('INBOX')
+
+        self.list_release.set()
+        for thread in threads:
+            thread.join()
+
+        assert self.list_calls == 1
+        # The listed status is from before the invalidation, so is fetched again
+        assert all(result['INBOX'][b'MESSAGES'] == 1 for result in results)
+
+
+class TestAccountFolderStatusesWithoutListStatus(FakeImapTestCase):
+    def test_invalidate(self):
+        account = make_account()
+
+        account.get_folder_statuses(['INBOX', 'Missing'])
+        assert self.server.get_commands('status') == ['INBOX', 'Missing']
+
+        # Cached, except for the missing folder
+        account.get_folder_statuses(['INBOX', 'Missing'])
+        assert self.server.get_commands('status') == ['INBOX', 'Missing', 'Missing']
+
+        self.server.commands = []
+        self.server.add_message('INBOX', 'New email')
+        account.invalidate_folder_status('INBOX')
+
+        statuses = account.get_folder_statuses(['INBOX'])
+        assert self.server.get_commands('status') == ['INBOX']
+        assert statuses['INBOX'][b'MESSAGES'] == 1
@@ -0,0 +1,135 @@
+from unittest import mock
+
+from kanmail.server.mail import connection as connection_module
+from kanmail.server.mail.connection import ImapConnectionPoolManager
+
+from .fake_imap import FakeImapTestCase, make_account
+
+
+class TestImapConnectionPool(FakeImapTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.pool = make_account(min_connections=1, max_connections=3).connection_pool
+        self.addCleanup(self.pool.stop_manager)
+
+    def use_connections(self, count):
+        # Acquire & release count connections together, growing the pool
+        connections = [self.pool._acquire() for _ in range(count)]
+        for connection in connections:
+            connection.noop()
+            self.pool._release(connection)
+        return connections
+
+    def age_idle_connections(self, seconds):
+        self.pool.idle_connections = [
+            (connection, idle_since - seconds)
+            for connection, idle_since in self.pool.idle_connections
+        ]
+
+    def test_warm_up(self):
+        self.pool.warm_up()
+
+        stats = self.pool.get_stats()
+        assert stats['total'] == 1
+        assert stats['idle'] == stats['idle_connected'] == 1
+        assert self.server.get_commands('login') == [None]
+
+        # Already at the minimum
+        self.pool.warm_up()
+        assert len(self.server.get_commands('login')) == 1
+
+    def test_get_stats(self):
+        with self.pool.get_connection(selected_folder='INBOX'):
+            stats = self.pool.get_stats()
+            assert stats['in_use'] == 1
+            assert stats['idle'] == 0
+
+        with self.pool.get_connection(selected_folder='INBOX'):
+            pass
+
+        stats = self.pool.get_stats()
+        assert stats['total'] == 1
+        assert stats['in_use'] == 0
+        assert stats['idle'] == stats['idle_connected'] == 1
+        assert stats['acquired'] == 2
+        # The second acquire reused the connection with INBOX selected
+        assert stats['reused_selected'] == 1
+        assert self.server.get_commands('select') == ['INBOX']
+        assert stats['waited'] == 0
+
+    def test_idle_connections_reaped(self):
+        connections = self.use_connections(3)
+        assert self.pool.get_stats()['total'] == 3
+
+        self.age_idle_connections(self.pool.idle_timeout + 1)
+        self.pool.check_idle_connections()
+
+        # Closed down to the minimum, keeping the most recently used
+        stats = self.pool.get_stats()
+        assert stats['total'] == stats['idle'] == 1
+        assert self.pool.idle_connections[0][0] is connections[-1]
+        assert [
+            connection.is_connected for connection in connections
+        ] == [False, False, True]
+
+    def test_recent_connections_checked(self):
+        self.use_connections(2)
+        self.server.commands = []
+
+        self.pool.check_idle_connections()
+
+        stats = self.pool.get_stats()
+        assert stats['total'] == stats['idle_connected'] == 2
+        assert len(self.server.get_commands('noop')) == 2
+
+    def test_dead_connections_dropped(self):
+        connections = self.use_connections(2)
+        connections[0]._imap.dead = True
+
+        self.pool.check_idle_connections()
+
+        stats = self.pool.get_stats()
+        assert stats['total'] == stats['idle'] == 1
+        assert self.pool.idle_connections[0][0] is connections[1]
+
+
+class TestImapConnectionPoolManager(FakeImapTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.pool = make_account(min_connections=2).connection_pool
+        self.manager = ImapConnectionPoolManager(self.pool)
+
+    def patch_offline_startup(self, offline_startup):
+        patcher = mock.patch.object(
+            connection_module, 'get_system_setting',
+            lambda key: offline_startup if key == 'offline_startup' else None,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_manager(self):
+        # Stopped first, so runs the initial warm up only
+        self.manager.stop()
+        self.manager.start()
+        self.manager.join()
+
+    def test_warm_up(self):
+        self.patch_offline_startup(False)
+        self.run_manager()
+
+        assert self.pool.get_stats()['idle_connected'] == 2
+
+    def test_offline_startup_skips_warm_up(self):
+        self.patch_offline_startup(True)
+        self.run_manager()
+
+        assert self.pool.get_stats()['total'] == 0
+        assert self.server.get_commands('login') == []
+        assert self.manager.should_warm_up() is False
+
+        # Until the pool is used
+        with self.pool.get_connection():
+            pass
+        assert self.manager.should_warm_up() is True
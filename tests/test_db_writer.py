@@ -0,0 +1,113 @@
+from unittest import TestCase
+
+from kanmail.server.app import db
+from kanmail.server.db_writer import DatabaseWriter, execute_write
+
+
+def _create_table(connection):
+    connection.execute('CREATE TABLE IF NOT EXISTS db_writer_test (value TEXT UNIQUE)')
+
+
+def _drop_table(connection):
+    connection.execute('DROP TABLE IF EXISTS db_writer_test')
+
+
+def _insert(connection, value):
+    connection.execute('INSERT INTO db_writer_test (value) VALUES (?)', value)
+    return value
+
+
+def _insert_then_fail(connection, value):
+    _insert(connection, value)
+    raise ValueError(f'failed after inserting {value}')
+
+
+def _nested_write(connection):
+    return execute_write('folders', _insert, 'nested')
+
+
+def get_values():
+    with db.get_engine(bind='folders').connect() as connection:
+        return sorted(
+            value for value, in
+            connection.execute('SELECT value FROM db_writer_test')
+        )
+
+
+class TestExecuteWrite(TestCase):
+    def setUp(self):
+        execute_write('folders', _create_table)
+        self.addCleanup(execute_write, 'folders', _drop_table)
+
+    def test_write(self):
+        assert execute_write('folders', _insert, 'a') == 'a'
+        assert get_values() == ['a']
+
+    def test_failed_write_rolled_back(self):
+        with self.assertRaises(ValueError):
+            execute_write('folders', _insert_then_fail, 'a')
+        assert get_values() == []
+
+        # The writer carries on with later writes
+        assert execute_write('folders', _insert, 'b') == 'b'
+        assert get_values() == ['b']
+
+    def test_no_wait(self):
+        future = execute_write('folders', _insert, 'a', wait=False)
+        assert future.result(timeout=5) == 'a'
+        assert get_values() == ['a']
+
+    def test_no_wait_failed_write(self):
+        future = execute_write('folders', _insert_then_fail, 'a', wait=False)
+        with self.assertRaises(ValueError):
+            future.result(timeout=5)
+        assert get_values() == []
+
+    def test_write_from_writer_thread(self):
+        with self.assertRaises(RuntimeError):
+            execute_write('folders', _nested_write)
+        assert get_values() == []
+
+
+class TestDatabaseWriterBatch(TestCase):
+    def setUp(self):
+        execute_write('folders', _create_table)
+        self.addCleanup(execute_write, 'folders', _drop_table)
+
+        # Not started, so we can execute a batch of queued writes directly
+        self.writer = DatabaseWriter()
+
+    def execute_queued_writes(self):
+        writes = []
+        while not self.writer.queue.empty():
+            writes.append(self.writer.queue.get_nowait())
+        self.writer.execute_writes('folders', writes)
+
+    def test_batch(self):
+        futures = [
+            self.writer.submit('folders', _insert, (value,))
+            for value in ('a', 'b', 'c')
+        ]
+        self.execute_queued_writes()
+
+        assert [future.result(timeout=0) for future in futures] == ['a', 'b', 'c']
+        assert get_values() == ['a', 'b', 'c']
+
+    def test_batch_with_failed_write(self):
+        futures = [
+            self.writer.submit('folders', _insert, ('a',)),
+            self.writer.submit('folders', _insert_then_fail, ('b',)),
+            # Duplicate value, fails the unique constraint
+            self.writer.submit('folders', _insert, ('a',)),
+            self.writer.submit('folders', _insert, ('c',)),
+        ]
+        self.execute_queued_writes()
+
+        # Only the failed writes fail, the rest are committed individually
+        assert futures[0].result(timeout=0) == 'a'
+        with self.assertRaises(ValueError):
+            futures[1].result(timeout=0)
+        assert futures[2].exception(timeout=0) is not None
+        assert futures[3].result(timeout=0) == 'c'
+
+        assert get_values() == ['a', 'c']
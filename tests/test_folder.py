@@ -0,0 +1,189 @@
+from unittest import mock, skipUnless
+
+from kanmail.settings.constants import CACHE_ENABLED
+
+from .fake_imap import FakeImapTestCase, make_account
+
+SEEN_FLAG = b'\\Seen'
+
+
+@skipUnless(CACHE_ENABLED, 'cache is disabled')
+class TestFolderModseqSync(FakeImapTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.uids = [
+            self.server.add_message('INBOX', f'Email {i}')
+            for i in range(3)
+        ]
+
+        self.account = make_account()
+        self.folder = self.account.get_folder('inbox')
+
+        # The first sync sets the UIDVALIDITY & HIGHESTMODSEQ of the cache
+        self.sync()
+        self.server.commands = []
+
+    def sync(self, **kwargs):
+        # As if IDLE reported changes, so the folder status is fetched again
+        self.account.invalidate_folder_status(self.folder.name)
+        new_emails, deleted_uids, read_uids = self.folder.sync_emails(**kwargs)
+        return sorted(email['uid'] for email in new_emails), sorted(deleted_uids), read_uids
+
+    def assert_searched(self, searched):
+        assert bool(self.server.get_commands('search')) is searched
+
+    def test_unchanged(self):
+        assert self.sync() == ([], [], [])
+        assert self.folder.cache.get_highest_modseq() == 4
+
+        # Same HIGHESTMODSEQ, so no search or fetch of changes
+        self.assert_searched(False)
+        assert self.server.get_commands('fetch_changed') == []
+
+    def test_changed_flags(self):
+        self.server.set_flags('INBOX', self.uids[0], [SEEN_FLAG])
+
+        assert self.sync(check_unread_uids=self.uids) == ([], [], [self.uids[0]])
+        assert self.folder.cache.get_highest_modseq() == 5
+
+        self.assert_searched(False)
+        assert self.server.get_commands('fetch_changed') == ['INBOX']
+        # Changed flags are written to the cached headers, without fetching them
+        assert SEEN_FLAG in self.folder.cache.get_headers(self.uids[0])['flags']
+        assert SEEN_FLAG not in self.folder.cache.get_headers(self.uids[1])['flags']
+
+    def test_new_emails(self):
+        new_uid = self.server.add_message('INBOX', 'New email')
+
+        assert self.sync() == ([new_uid], [], [])
+        assert list(self.folder.email_uids) == self.uids + [new_uid]
+        assert list(self.folder.cache.get_uids()) == self.uids + [new_uid]
+        self.assert_searched(False)
+
+    def test_vanished(self):
+        self.server.expunge('INBOX', [self.uids[1]])
+
+        assert self.sync() == ([], [self.uids[1]], [])
+        assert list(self.folder.email_uids) == [self.uids[0], self.uids[2]]
+        assert self.folder.cache.get_headers(self.uids[1]) is None
+        self.assert_searched(False)
+
+    def test_uidvalidity_reset(self):
+        self.server.reset_folder('INBOX', uid_validity=2)
+        new_uids = list(self.server.folders['INBOX'].messages)
+
+        # Every UID is invalid, so all are deleted and re-fetched via a search
+        new_emails, deleted_uids, _ = self.sync()
+        assert new_emails == new_uids
+        assert deleted_uids == self.uids
+        self.assert_searched(True)
+        assert self.server.get_commands('fetch_changed') == []
+
+        assert self.folder.cache.get_uid_validity() == 2
+        assert self.folder.cache.get_highest_modseq() == (
+            self.server.folders['INBOX'].highest_modseq
+        )
+
+        # And back to incremental syncs
+        self.server.commands = []
+        assert self.sync() == ([], [], [])
+        self.assert_searched(False)
+
+    def test_query_folder_starts_from_search_index(self):
+        lunch_uids = [
+            self.server.add_message('INBOX', subject)
+            for subject in ('Lunch today?', 'Other', 'Lunch tomorrow?')
+        ]
+        del lunch_uids[1]
+        self.sync()
+        self.folder.get_emails(reset=True, batch_size=10)  # caches & indexes headers
+
+        # Not cached or indexed yet, only found by the server search
+        new_uid = self.server.add_message('INBOX', 'Lunch later?')
+        self.server.commands = []
+
+        # Created with the index matches, without waiting for a server search
+        query_folder = self.account.get_folder('inbox', query='lunch')
+        assert query_folder.stale is True
+        assert self.server.get_commands('search') == []
+
+        emails = query_folder.get_emails(reset=True)
+        assert sorted(email['uid'] for email in emails) == lunch_uids
+
+        # The server search results are merged in by the background reconcile
+        query_folder.reconcile_thread.join()
+        assert self.server.get_commands('search') == ['INBOX']
+
+        new_emails, deleted_uids, _ = query_folder.sync_emails()
+        assert [email['uid'] for email in new_emails] == [new_uid]
+        assert deleted_uids == []
+        assert new_uid in query_folder.email_uids
+
+    def test_query_folder_searches(self):
+        # Query folders share the base folder's cache (and HIGHESTMODSEQ), so
+        # always search.
+        query_folder = self.account.get_folder('inbox', query='Email')
+        self.server.commands = []
+        query_folder.sync_emails()
+        self.assert_searched(True)
+
+    def test_idle_changed_kept_on_failure(self):
+        self.folder.set_idle_watched(True)
+        new_uid = self.server.add_message('INBOX', 'New email')
+
+        with mock.patch.object(
+            self.folder, 'get_folder_status', side_effect=ConnectionError,
+        ):
+            with self.assertRaises(ConnectionError):
+                self.sync()
+
+        # The failed sync mustn't mark the IDLE changes as synced
+        assert self.folder.idle_changed is True
+        assert self.sync() == ([new_uid], [], [])
+        assert self.folder.idle_changed is False
+        assert self.sync() == ([], [], [])
+
+
+@skipUnless(CACHE_ENABLED, 'cache is disabled')
+class TestFolderStatusSync(FakeImapTestCase):
+    # No CONDSTORE, so changes are found by searching & comparing UIDs
+    capabilities = (b'IMAP4REV1',)
+
+    def setUp(self):
+        super().setUp()
+
+        self.uids = [
+            self.server.add_message('INBOX', f'Email {i}')
+            for i in range(3)
+        ]
+
+        self.account = make_account()
+        self.folder = self.account.get_folder('inbox')
+
+        self.sync()
+        self.server.commands = []
+
+    def sync(self, **kwargs):
+        self.account.invalidate_folder_status(self.folder.name)
+        new_emails, deleted_uids, read_uids = self.folder.sync_emails(**kwargs)
+        return sorted(email['uid'] for email in new_emails), sorted(deleted_uids), read_uids
+
+    def test_status_unchanged_skips_search(self):
+        assert self.sync() == ([], [], [])
+
+        assert self.server.get_commands('status') == ['INBOX']
+        assert self.server.get_commands('search') == []
+
+    def test_status_changed_searches(self):
+        new_uid = self.server.add_message('INBOX', 'New email')
+
+        assert self.sync() == ([new_uid], [], [])
+        assert self.server.get_commands('search') == ['INBOX']
+
+    def test_flags_checked_by_fetch(self):
+        self.server.set_flags('INBOX', self.uids[0], [SEEN_FLAG])
+
+        # Flag changes don't change the status, so are fetched directly
+        assert self.sync(check_unread_uids=self.uids) == ([], [], [self.uids[0]])
+        assert self.server.get_commands('search') == []
@@ -0,0 +1,232 @@
+from os import path, remove
+from pickle import dumps as pickle_dumps
+from unittest import skipUnless, TestCase
+
+from kanmail.server.app import db
+from kanmail.server.mail.folder_cache import (
+    FolderCache,
+    LEGACY_HEADER_TABLE,
+    upgrade_folder_cache,
+)
+from kanmail.server.mail.header_cache import HEADER_CACHE
+from kanmail.server.mail.search_index import search_folder_uids
+from kanmail.server.mail.threads import ThreadMessageItem
+from kanmail.settings.constants import CACHE_ENABLED, FOLDER_CACHE_DB_FILE
+
+ACCOUNT_SETTINGS = {
+    'imap_connection': {
+        'host': 'imap.example.com',
+        'username': 'user@example.com',
+    },
+}
+ACCOUNT_KEY = 'user@example.com@imap.example.com'
+
+# Folder cache schema (and pickled header dicts) before the columnar header cache
+BASELINE_SCHEMA = (
+    'CREATE TABLE folder_cache_item ('
+    'id INTEGER NOT NULL, '
+    'account_name VARCHAR(300) NOT NULL, '
+    'folder_name VARCHAR(300) NOT NULL, '
+    'uid_validity VARCHAR(300), '
+    'uids TEXT, '
+    'PRIMARY KEY (id), '
+    'UNIQUE (account_name, folder_name)'
+    ')',
+    f'CREATE TABLE {LEGACY_HEADER_TABLE} ('
+    'id INTEGER NOT NULL, '
+    'uid INTEGER NOT NULL, '
+    'data TEXT NOT NULL, '
+    'folder_id INTEGER NOT NULL, '
+    'PRIMARY KEY (id), '
+    'UNIQUE (uid, folder_id), '
+    'FOREIGN KEY(folder_id) REFERENCES folder_cache_item (id) ON DELETE CASCADE'
+    ')',
+    f'CREATE INDEX ix_{LEGACY_HEADER_TABLE}_uid ON {LEGACY_HEADER_TABLE} (uid)',
+)
+
+BASELINE_HEADERS = {
+    1: {
+        'uid': 1,
+        'seq': 1,
+        'flags': (b'\\Seen', b'$Important'),
+        'size': 1024,
+        'excerpt': 'Lunch tomorrow?',
+        'content_encoding': None,
+        'parts': {
+            '1': {
+                'type': 'TEXT',
+                'subtype': 'PLAIN',
+                'encoding': '7bit',
+                'content_id': None,
+                'size': 15,
+                'charset': 'utf-8',
+            },
+            '2': {
+                'type': 'IMAGE',
+                'subtype': 'PNG',
+                'encoding': 'base64',
+                'content_id': None,
+                'size': 512,
+                'name': 'menu.png',
+            },
+            'attachments': ['2'],
+            'plain': '1',
+        },
+        'date': '2020-01-01T10:00:00+00:00',
+        'subject': 'Lunch',
+        'from': [('Alice', 'alice@example.com')],
+        'to': [('Bob', 'bob@example.com')],
+        'send': [],
+        'cc': [(None, 'carol@example.com')],
+        'bcc': [],
+        'reply_to': [],
+        'in_reply_to': None,
+        'message_id': b'<lunch@example.com>',
+        'references': None,
+    },
+    2: {
+        'uid': 2,
+        'seq': 2,
+        'flags': (),
+        'size': 2048,
+        'excerpt': 'Sounds good',
+        'content_encoding': None,
+        'parts': {
+            '1': {
+                'type': 'TEXT',
+                'subtype': 'HTML',
+                'encoding': 'quoted-printable',
+                'content_id': None,
+                'size': 11,
+            },
+            'attachments': [],
+            'html': '1',
+        },
+        'date': '2020-01-01T11:00:00+00:00',
+        'subject': 'Re: Lunch',
+        'from': [('Bob', 'bob@example.com')],
+        'to': [('Alice', 'alice@example.com')],
+        'send': [],
+        'cc': [],
+        'bcc': [],
+        'reply_to': [],
+        'in_reply_to': b'<lunch@example.com>',
+        'message_id': b'<re-lunch@example.com>',
+        'references': ['<lunch@example.com>'],
+    },
+}
+
+
+class FakeAccount(object):
+    name = 'account'
+    settings = ACCOUNT_SETTINGS
+
+
+class FakeFolder(object):
+    name = 'INBOX'
+    alias_name = 'inbox'
+    account = FakeAccount()
+
+
+def reset_folder_cache_db():
+    engine = db.get_engine(bind='folders')
+    engine.dispose()
+
+    for suffix in ('', '-wal', '-shm'):
+        filename = f'{FOLDER_CACHE_DB_FILE}{suffix}'
+        if path.exists(filename):
+            remove(filename)
+
+    return engine
+
+
+@skipUnless(CACHE_ENABLED, 'cache is disabled')
+class TestUpgradeFolderCache(TestCase):
+    def setUp(self):
+        db.session.remove()
+        HEADER_CACHE.clear()
+
+        engine = reset_folder_cache_db()
+
+        for statement in BASELINE_SCHEMA:
+            engine.execute(statement)
+
+        folder_id = engine.execute(
+            'INSERT INTO folder_cache_item '
+            '(account_name, folder_name, uid_validity, uids) VALUES (?, ?, ?, ?)',
+            (ACCOUNT_KEY, 'INBOX', '1', pickle_dumps({1, 2})),
+        ).lastrowid
+
+        for uid, headers in BASELINE_HEADERS.items():
+            engine.execute(
+                f'INSERT INTO {LEGACY_HEADER_TABLE} (uid, data, folder_id) '
+                'VALUES (?, ?, ?)',
+                (uid, pickle_dumps(headers), folder_id),
+            )
+
+        # Unreadable headers are skipped
+        engine.execute(
+            f'INSERT INTO {LEGACY_HEADER_TABLE} (uid, data, folder_id) VALUES (?, ?, ?)',
+            (3, b'not a pickle', folder_id),
+        )
+
+        db.create_all()
+        upgrade_folder_cache()
+
+    def tearDown(self):
+        db.session.remove()
+        HEADER_CACHE.clear()
+
+        reset_folder_cache_db()
+        db.create_all()
+        upgrade_folder_cache()
+
+    def test_drops_legacy_table(self):
+        assert not db.get_engine(bind='folders').has_table(LEGACY_HEADER_TABLE)
+
+    def test_loads_pickled_uids(self):
+        folder_cache = FolderCache(FakeFolder())
+
+        assert sorted(folder_cache.get_uids()) == [1, 2]
+        assert folder_cache.get_uid_validity() == 1
+
+    def test_migrates_headers(self):
+        folder_cache = FolderCache(FakeFolder())
+        uid_to_headers = folder_cache.batch_get_headers([1, 2, 3])
+
+        assert set(uid_to_headers) == {1, 2}
+
+        for uid, headers in uid_to_headers.items():
+            baseline_headers = BASELINE_HEADERS[uid]
+
+            for key in (
+                'seq', 'size', 'excerpt', 'date', 'subject',
+                'from', 'to', 'send', 'cc', 'bcc', 'reply_to',
+            ):
+                assert headers[key] == baseline_headers[key], key
+
+            assert set(headers['flags']) == set(baseline_headers['flags'])
+            assert headers['parts'] == baseline_headers['parts']
+            assert headers['references'] == baseline_headers['references']
+
+        assert uid_to_headers[1]['message_id'] == '<lunch@example.com>'
+        assert uid_to_headers[2]['in_reply_to'] == '<lunch@example.com>'
+        assert uid_to_headers[1]['folder_name'] == 'inbox'
+
+    def test_builds_thread_index(self):
+        assert ThreadMessageItem.query.count() == 2
+
+    def test_builds_search_index(self):
+        folder_id = FolderCache(FakeFolder()).get_folder_id()
+
+        assert set(search_folder_uids(folder_id, 'lunch')) == {1, 2}
+        assert search_folder_uids(folder_id, 'carol') == [1]
+
+    def test_upgrade_again(self):
+        upgrade_folder_cache()
+
+        folder_cache = FolderCache(FakeFolder())
+
+        assert sorted(folder_cache.get_uids()) == [1, 2]
+        assert set(folder_cache.batch_get_headers([1, 2])) == {1, 2}
+        assert ThreadMessageItem.query.count() == 2
@@ -0,0 +1,86 @@
+from unittest import TestCase
+
+from kanmail.server.mail.header_cache import _estimate_size, HeaderCache
+
+
+def make_headers(uid, subject='Hello'):
+    return {'uid': uid, 'subject': subject}
+
+
+class TestHeaderCache(TestCase):
+    def test_get_set(self):
+        cache = HeaderCache(max_items=10, max_bytes=100000)
+        cache.set_many('folder', {1: make_headers(1), 2: make_headers(2)}, cache.get_marker())
+
+        assert cache.get_many('folder', [1, 2, 3]) == {
+            1: make_headers(1),
+            2: make_headers(2),
+        }
+        assert cache.get_many('other-folder', [1]) == {}
+
+        stats = cache.get_stats()
+        assert stats['items'] == 2
+        assert stats['hits'] == 2
+        assert stats['misses'] == 2
+
+    def test_evicts_least_recently_used(self):
+        cache = HeaderCache(max_items=2, max_bytes=100000)
+        cache.set_many('folder', {1: make_headers(1), 2: make_headers(2)}, cache.get_marker())
+
+        # Use 1 so 2 is the least recently used
+        cache.get_many('folder', [1])
+        cache.set_many('folder', {3: make_headers(3)}, cache.get_marker())
+
+        assert set(cache.get_many('folder', [1, 2, 3])) == {1, 3}
+
+    def test_bounded_by_bytes(self):
+        size = _estimate_size(make_headers(1, 'x' * 100))
+        cache = HeaderCache(max_items=100, max_bytes=size * 2)
+
+        cache.set_many('folder', {
+            uid: make_headers(uid, 'x' * 100)
+            for uid in range(1, 6)
+        }, cache.get_marker())
+
+        assert set(cache.get_many('folder', range(1, 6))) == {4, 5}
+        assert cache.get_stats()['bytes'] == size * 2
+
+    def test_replace_keeps_byte_count(self):
+        cache = HeaderCache(max_items=10, max_bytes=100000)
+        cache.set_many('folder', {1: make_headers(1, 'a')}, cache.get_marker())
+        cache.set_many('folder', {1: make_headers(1, 'b' * 50)}, cache.get_marker())
+
+        assert cache.get_many('folder', [1]) == {1: make_headers(1, 'b' * 50)}
+        assert cache.get_stats()['bytes'] == _estimate_size(make_headers(1, 'b' * 50))
+
+    def test_disabled(self):
+        cache = HeaderCache(max_items=0)
+        cache.set_many('folder', {1: make_headers(1)}, cache.get_marker())
+
+        assert cache.get_many('folder', [1]) == {}
+
+    def test_invalidate(self):
+        cache = HeaderCache(max_items=10, max_bytes=100000)
+        cache.set_many('folder', {1: make_headers(1), 2: make_headers(2)}, cache.get_marker())
+        cache.set_many('other-folder', {1: make_headers(1)}, cache.get_marker())
+
+        cache.invalidate('folder', [1])
+        assert set(cache.get_many('folder', [1, 2])) == {2}
+
+        cache.invalidate_folder('folder')
+        assert cache.get_many('folder', [1, 2]) == {}
+        assert set(cache.get_many('other-folder', [1])) == {1}
+
+        cache.clear()
+        assert cache.get_stats()['items'] == 0
+        assert cache.get_stats()['bytes'] == 0
+
+    def test_stale_marker_not_stored(self):
+        cache = HeaderCache(max_items=10, max_bytes=100000)
+
+        # Headers read from the database, then invalidated before being stored
+        marker = cache.get_marker()
+        cache.invalidate('folder', [1])
+        cache.set_many('folder', {1: make_headers(1)}, marker)
+
+        assert cache.get_many('folder', [1]) == {}
@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+from unittest import mock, TestCase
+
+from kanmail.server.mail import idle
+
+FOLDER = SimpleNamespace(
+    account=SimpleNamespace(name='account'),
+    alias_name='inbox',
+)
+
+
+class TestGetIdleEvents(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(idle, 'IDLE_EVENTS', idle.IDLE_EVENTS.copy())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        idle.IDLE_EVENTS.clear()
+
+    def test_events_since(self):
+        events, latest_id, epoch = idle.get_idle_events()
+        assert events == []
+        assert epoch == idle.IDLE_EVENTS_EPOCH
+
+        idle.push_idle_event(FOLDER, {'EXISTS'})
+
+        events, new_latest_id, _ = idle.get_idle_events(since=latest_id, epoch=epoch)
+        assert [event['types'] for event in events] == [['EXISTS']]
+        assert new_latest_id == events[0]['id']
+
+        events, _, _ = idle.get_idle_events(
+            since=new_latest_id, epoch=epoch, timeout=0,
+        )
+        assert events == []
+
+    def test_events_since_previous_epoch(self):
+        idle.push_idle_event(FOLDER, {'EXPUNGE'})
+        _, latest_id, _ = idle.get_idle_events()
+
+        # After a restart the client's ID may be ahead of ours - the epoch tells
+        # us to ignore it and return everything.
+        events, new_latest_id, epoch = idle.get_idle_events(
+            since=latest_id + 100, epoch='previous-boot', timeout=0,
+        )
+        assert [event['types'] for event in events] == [['EXPUNGE']]
+        assert new_latest_id == latest_id
+        assert epoch == idle.IDLE_EVENTS_EPOCH
@@ -0,0 +1,163 @@
+from datetime import datetime
+from threading import Barrier, Thread
+from time import sleep
+from unittest import mock, skipUnless, TestCase
+
+from kanmail.server import mail
+from kanmail.server.mail import (
+    ColumnCursorError,
+    get_column_emails,
+    get_folder_email_texts,
+    get_folder_emails,
+)
+from kanmail.server.mail.util import markdownify
+from kanmail.settings.constants import CACHE_ENABLED
+
+from .fake_imap import FakeImapTestCase, make_account
+
+
+class MailTestCase(FakeImapTestCase):
+    account_names = ('account',)
+
+    def setUp(self):
+        super().setUp()
+
+        # Each account on its own server
+        self.accounts = {}
+        self.account_servers = {}
+
+        for name in self.account_names:
+            host = f'imap.{name}.example.com'
+            self.account_servers[name] = self.add_server(host)
+            self.accounts[name] = make_account(name, host=host)
+        patcher = mock.patch.dict(mail.ACCOUNTS, self.accounts, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestGetFolderEmails(TestCase):
+    def setUp(self):
+        self.calls = []
+
+        def get_emails(account_key, folder_name, query=None, reset=False, batch_size=None):
+            self.calls.append(reset)
+            page = len(self.calls)
+            sleep(0.1)
+            return [page], {}
+
+        patcher = mock.patch.object(mail, '_get_folder_emails', get_emails)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_concurrently(self, count=3, **kwargs):
+        results = [None] * count
+        barrier = Barrier(count)
+
+        def target(i):
+            barrier.wait()
+            results[i] = get_folder_emails('account', 'inbox', **kwargs)[0]
+
+        threads = [Thread(target=target, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_reset_calls_shared(self):
+        results = self.get_concurrently(reset=True)
+
+        assert self.calls == [True]
+        assert results == [[1]] * 3
+
+    def test_next_page_calls_not_shared(self):
+        # Each gets the next page, so must not share another call's page
+        results = self.get_concurrently()
+
+        assert self.calls == [False] * 3
+        assert sorted(results) == [[1], [2], [3]]
+
+
+@skipUnless(CACHE_ENABLED, 'cache is disabled')
+class TestGetFolderEmailTexts(MailTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = self.account_servers['account']
+
+    def test_cached_text_parts(self):
+        uid = self.server.add_message('INBOX', 'Hello', body='Hello\nworld')
+
+        texts = get_folder_email_texts('account', 'inbox', [uid])
+        assert texts[uid]['text'] == 'Hello\nworld'
+        assert texts[uid]['text_as_html'] == markdownify('Hello\nworld')
+
+        fetch_count = len(self.server.get_commands('fetch'))
+
+        # Read from the part cache, not the server, as the same (text) type
+        cached_texts = get_folder_email_texts('account', 'inbox', [uid])
+        assert cached_texts == texts
+        assert len(self.server.get_commands('fetch')) == fetch_count
+
+    def test_cached_binary_parts(self):
+        uid = self.server.add_message('INBOX', 'Binary', body='data', charset=None)
+        folder = self.accounts['account'].get_folder('inbox')
+
+        assert folder.get_email_parts([uid], '1') == {uid: b'data'}
+        assert folder.cache.batch_get_parts([uid], '1') == {uid: b'data'}
+
+
+@skipUnless(CACHE_ENABLED, 'cache is disabled')
+class TestGetColumnEmails(MailTestCase):
+    account_names = ('a', 'b')
+
+    def add_messages(self, account_name, minutes):
+        return [
+            self.account_servers[account_name].add_message(
+                'INBOX', f'{account_name}{minute}',
+                date=datetime(2020, 1, 1, 10, minute),
+            )
+            for minute in minutes
+        ]
+
+    def get_pages(self, batch_size=2):
+        pages = []
+        cursor = None
+
+        while True:
+            emails, cursor, meta = get_column_emails(
+                'inbox', cursor=cursor, batch_size=batch_size,
+            )
+            assert set(meta) == {'a', 'b'}
+
+            if not emails:
+                assert cursor is None
+                return pages
+
+            pages.append([email['subject'] for email in emails])
+
+    def test_interleaved_pages(self):
+        self.add_messages('a', [0, 2, 4])
+        self.add_messages('b', [1, 3])
+
+        assert self.get_pages() == [
+            ['a4', 'b3'],
+            ['a2', 'b1'],
+            ['a0'],
+        ]
+
+    def test_page_without_account_emails(self):
+        self.add_messages('a', [10, 11, 12])
+        self.add_messages('b', [0, 1])
+
+        # b contributes nothing to the first page, so its cursor stays unset and
+        # the next page starts from its newest email.
+        assert self.get_pages() == [
+            ['a12', 'a11'],
+            ['a10', 'b1'],
+            ['b0'],
+        ]
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ColumnCursorError):
+            get_column_emails('inbox', cursor='not-a-cursor')
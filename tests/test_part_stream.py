@@ -0,0 +1,188 @@
+from base64 import encodebytes
+from binascii import b2a_qp
+from contextlib import contextmanager
+from unittest import mock, TestCase
+
+from werkzeug.http import parse_range_header
+
+from kanmail.server.mail import part_stream
+from kanmail.server.mail.part_stream import (
+    Base64Decoder,
+    EmailPartStream,
+    QuotedPrintableDecoder,
+)
+
+# Large enough for the first chunk to include at least two base64 lines
+CHUNK_SIZE = 200
+
+DATA = bytes(range(256)) * 16
+
+
+def decode_in_chunks(decoder, data, chunk_size):
+    decoded = b''.join(
+        decoder.decode(data[i:i + chunk_size])
+        for i in range(0, len(data), chunk_size)
+    )
+    return decoded + decoder.flush()
+
+
+class FakeConnection(object):
+    def add_flags(self, uids, flags):
+        pass
+
+
+class FakeFolder(object):
+    '''
+    Serves partial fetches of a single encoded part.
+    '''
+
+    def __init__(self, encoded_data, decoded_data):
+        self.encoded_data = encoded_data
+        self.decoded_data = decoded_data
+        self.range_fetches = []
+
+    def get_email_part_range(self, uid, part_number, offset, length):
+        self.range_fetches.append((offset, length))
+        return self.encoded_data[offset:offset + length]
+
+    def get_email_parts(self, uids, part_number):
+        return {uid: self.decoded_data for uid in uids}
+
+    def get_email_headers(self, uids):
+        return {uid: {'flags': ()} for uid in uids}
+
+    @contextmanager
+    def get_connection(self):
+        yield FakeConnection()
+
+    def add_cache_flags(self, uids, flag):
+        pass
+
+
+def make_stream(data, encoding, encoded_data):
+    folder = FakeFolder(encoded_data, data)
+    stream = EmailPartStream(folder, 1, '2', {
+        'type': 'application',
+        'subtype': 'octet-stream',
+        'encoding': encoding,
+        'size': len(encoded_data),
+    })
+    stream.open()
+    return stream
+
+
+def read_range(stream, range_header):
+    byte_range = parse_range_header(range_header).range_for_length(stream.size)
+    if byte_range is None:
+        return
+
+    start, stop = byte_range
+    return b''.join(stream.iter_bytes(start, stop))
+
+
+@mock.patch.object(part_stream, 'PART_STREAM_CHUNK_SIZE', CHUNK_SIZE)
+@mock.patch.object(part_stream, 'PART_STREAM_MIN_SIZE', CHUNK_SIZE)
+class TestPartStream(TestCase):
+    def test_base64_decoder_chunk_boundaries(self):
+        encoded = encodebytes(DATA)
+
+        for chunk_size in range(1, 10):
+            assert decode_in_chunks(Base64Decoder(), encoded, chunk_size) == DATA
+
+    def test_base64_decoder_unpadded(self):
+        encoded = encodebytes(b'hello').rstrip(b'=\n')
+
+        assert decode_in_chunks(Base64Decoder(), encoded, 3) == b'hello'
+
+    def test_quoted_printable_decoder_chunk_boundaries(self):
+        # Escapes (=XX) & soft line breaks (=\n) that will be split across chunks
+        encoded = b2a_qp(DATA)
+        assert b'=\n' in encoded
+
+        for chunk_size in range(1, 10):
+            assert decode_in_chunks(QuotedPrintableDecoder(), encoded, chunk_size) == DATA
+
+    def test_base64_stream(self):
+        for line_ending in (b'\n', b'\r\n'):
+            for length in (len(DATA) - 1, len(DATA), len(DATA) + 1):
+                data = (DATA * 2)[:length]
+                encoded = encodebytes(data).replace(b'\n', line_ending)
+
+                stream = make_stream(data, 'base64', encoded)
+
+                assert stream.size == len(data)
+                assert b''.join(stream.iter_bytes()) == data
+
+    def test_base64_stream_ranges(self):
+        encoded = encodebytes(DATA).replace(b'\n', b'\r\n')
+        stream = make_stream(DATA, 'base64', encoded)
+
+        # Ranges starting/ending mid base64 group, line & fetch chunk
+        for start, stop in (
+            (0, 1),
+            (1, 2),
+            (2, 50),
+            (47, 48),
+            (57, 200),
+            (100, len(DATA)),
+            (len(DATA) - 1, len(DATA)),
+        ):
+            assert b''.join(stream.iter_bytes(start, stop)) == DATA[start:stop]
+
+    def test_base64_stream_range_fetches_from_offset(self):
+        encoded = encodebytes(DATA)
+        stream = make_stream(DATA, 'base64', encoded)
+        stream.folder.range_fetches = []
+
+        assert b''.join(stream.iter_bytes(570, 580)) == DATA[570:580]
+        # 570 bytes = 190 groups = 760 characters = 10 lines (+10 line endings)
+        assert stream.folder.range_fetches == [(770, CHUNK_SIZE)]
+
+    def test_range_requests(self):
+        encoded = encodebytes(DATA)
+        stream = make_stream(DATA, 'base64', encoded)
+
+        assert read_range(stream, 'bytes=100-199') == DATA[100:200]
+        assert read_range(stream, 'bytes=1000-') == DATA[1000:]
+        assert read_range(stream, 'bytes=-24') == DATA[-24:]
+        assert read_range(stream, 'bytes=0-100000') == DATA
+        assert read_range(stream, f'bytes={len(DATA)}-') is None
+
+    def test_identity_stream_ranges(self):
+        stream = make_stream(DATA, '8bit', DATA)
+
+        assert stream.size == len(DATA)
+        assert read_range(stream, 'bytes=63-129') == DATA[63:130]
+        assert b''.join(stream.iter_bytes()) == DATA
+
+    def test_quoted_printable_stream(self):
+        encoded = b2a_qp(DATA)
+        stream = make_stream(DATA, 'quoted-printable', encoded)
+
+        # Decoded size is unknown, so no ranges
+        assert stream.size is None
+        assert b''.join(stream.iter_bytes()) == DATA
+
+        with self.assertRaises(ValueError):
+            list(stream.iter_bytes(10))
+
+    def test_irregular_base64_lines(self):
+        encoded = encodebytes(DATA)
+        lines = encoded.split(b'\n')
+        # Join the first two lines, so the first line is twice as long
+        encoded = lines[0] + b'\n'.join(lines[1:])
+
+        stream = make_stream(DATA, 'base64', encoded)
+
+        # Can't map decoded offsets, but can still stream the whole part
+        assert stream.size is None
+        assert b''.join(stream.iter_bytes()) == DATA
+
+    def test_small_part(self):
+        data = DATA[:10]
+        stream = make_stream(data, 'base64', encodebytes(data))
+
+        assert stream.data == data
+        assert stream.size == len(data)
+        assert read_range(stream, 'bytes=2-4') == data[2:5]
+        assert stream.folder.range_fetches == []
@@ -0,0 +1,83 @@
+from unittest import skipUnless, TestCase
+
+from kanmail.server.mail.threads import (
+    get_thread_ids,
+    make_message_references,
+    update_thread_index,
+)
+from kanmail.settings.constants import CACHE_ENABLED
+
+from .fake_imap import reset_folder_cache_db
+
+
+class TestMakeMessageReferences(TestCase):
+    def test_references(self):
+        assert make_message_references({
+            'message_id': b' <c@example.com>',
+            'references': ['<a@example.com>', '<b@example.com>,', '<a@example.com>'],
+            'in_reply_to': '<b@example.com>',
+        }) == ('<c@example.com>', ['<a@example.com>', '<b@example.com>'])
+
+    def test_self_reference(self):
+        assert make_message_references({
+            'message_id': '<a@example.com>',
+            'in_reply_to': '<a@example.com>',
+        }) == ('<a@example.com>', [])
+
+    def test_no_message_id(self):
+        assert make_message_references({'in_reply_to': '<a@example.com>'}) is None
+
+
+@skipUnless(CACHE_ENABLED, 'cache is disabled')
+class TestThreadIndex(TestCase):
+    def setUp(self):
+        reset_folder_cache_db()
+
+    def add_messages(self, *message_references):
+        update_thread_index([
+            make_message_references({'message_id': message_id, 'references': references})
+            for message_id, references in message_references
+        ])
+
+    def test_reply(self):
+        self.add_messages(('<a>', []), ('<b>', ['<a>']))
+
+        assert get_thread_ids(['<a>', '<b>']) == {'<a>': '<a>', '<b>': '<a>'}
+
+    def test_missing_messages(self):
+        # The reply arrives before the message between it & the root
+        self.add_messages(('<a>', []), ('<c>', ['<a>', '<b>']))
+        assert set(get_thread_ids(['<a>', '<b>', '<c>']).values()) == {'<a>'}
+
+        self.add_messages(('<b>', ['<a>']))
+        assert set(get_thread_ids(['<a>', '<b>', '<c>']).values()) == {'<a>'}
+
+    def test_threads_merged_by_later_reply(self):
+        # Two threads, whose shared root we don't have
+        self.add_messages(
+            ('<a>', []),
+            ('<b>', ['<a>']),
+            ('<x>', []),
+            ('<y>', ['<x>']),
+        )
+        assert get_thread_ids(['<b>', '<y>']) == {'<b>': '<a>', '<y>': '<x>'}
+
+        # A later reply referencing both joins them into the first
+        self.add_messages(('<z>', ['<a>', '<b>', '<x>', '<y>']))
+
+        assert get_thread_ids(['<a>', '<b>', '<x>', '<y>', '<z>']) == {
+            message_id: '<a>'
+            for message_id in ('<a>', '<b>', '<x>', '<y>', '<z>')
+        }
+
+        # And later messages in either thread stay in the merged thread
+        self.add_messages(('<y2>', ['<x>', '<y>']))
+        assert get_thread_ids(['<y2>']) == {'<y2>': '<a>'}
+
+    def test_unrelated_threads(self):
+        self.add_messages(('<a>', []), ('<x>', []))
+
+        assert get_thread_ids(['<a>', '<x>', '<missing>']) == {
+            '<a>': '<a>',
+            '<x>': '<x>',
+        }
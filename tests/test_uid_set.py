@@ -0,0 +1,124 @@
+from unittest import TestCase
+
+from kanmail.server.mail.uid_set import UidSet
+
+
+class TestUidSet(TestCase):
+    def test_sorted_unique(self):
+        uid_set = UidSet([5, 1, 3, 3, 1])
+
+        assert list(uid_set) == [1, 3, 5]
+        assert list(reversed(uid_set)) == [5, 3, 1]
+        assert len(uid_set) == 3
+        assert uid_set.max() == 5
+
+    def test_empty(self):
+        uid_set = UidSet()
+
+        assert not uid_set
+        assert len(uid_set) == 0
+        assert uid_set.max() is None
+        assert uid_set.to_sequence_set() == ''
+        assert UidSet.from_sequence_set('') == uid_set
+
+    def test_contains(self):
+        uid_set = UidSet([2, 4, 6])
+
+        assert 4 in uid_set
+        assert 1 not in uid_set
+        assert 5 not in uid_set
+        assert 7 not in uid_set
+
+    def test_equality(self):
+        assert UidSet([1, 2]) == UidSet([2, 1])
+        assert UidSet([1, 2]) == {1, 2}
+        assert UidSet([1, 2]) != {1, 2, 3}
+        assert UidSet([1, 2]) != UidSet([1])
+
+    def test_copy_is_independent(self):
+        uid_set = UidSet([1, 2])
+        copied = uid_set.copy()
+        copied.add(3)
+
+        assert list(uid_set) == [1, 2]
+        assert list(copied) == [1, 2, 3]
+
+    def test_add(self):
+        uid_set = UidSet([2, 4])
+
+        uid_set.add(5)  # append
+        uid_set.add(3)  # insert
+        uid_set.add(4)  # existing
+
+        assert list(uid_set) == [2, 3, 4, 5]
+
+    def test_discard(self):
+        uid_set = UidSet([1, 2, 3])
+
+        uid_set.discard(2)
+        uid_set.discard(10)
+
+        assert list(uid_set) == [1, 3]
+
+    def test_update(self):
+        uid_set = UidSet([1, 5])
+
+        uid_set.update([6, 7])  # append only
+        assert list(uid_set) == [1, 5, 6, 7]
+
+        uid_set.update([3, 5, 8])  # merge
+        assert list(uid_set) == [1, 3, 5, 6, 7, 8]
+
+        uid_set.update([])
+        assert list(uid_set) == [1, 3, 5, 6, 7, 8]
+
+    def test_difference_update(self):
+        uid_set = UidSet(range(1, 101))
+
+        # Few UIDs, deleted in place
+        uid_set.difference_update([1, 50, 1000])
+        assert len(uid_set) == 98
+        assert 50 not in uid_set
+
+        # Many UIDs, rebuilt
+        uid_set.difference_update(UidSet(range(1, 91)))
+        assert list(uid_set) == list(range(91, 101))
+
+    def test_operators(self):
+        a = UidSet([1, 2, 3])
+        b = UidSet([3, 4])
+
+        assert list(a - b) == [1, 2]
+        assert list(a | b) == [1, 2, 3, 4]
+        assert list(b - [4]) == [3]
+        # Operands are unchanged
+        assert list(a) == [1, 2, 3]
+        assert list(b) == [3, 4]
+
+    def test_get_highest(self):
+        uid_set = UidSet([1, 3, 5, 7, 9])
+
+        assert uid_set.get_highest(2) == [9, 7]
+        assert uid_set.get_highest(2, below=7) == [5, 3]
+        assert uid_set.get_highest(10, below=4) == [3, 1]
+        assert uid_set.get_highest(2, below=1) == []
+
+    def test_to_sequence_set(self):
+        uid_set = UidSet([1, 2, 3, 4, 7, 9, 10])
+
+        assert uid_set.to_sequence_set() == '1:4,7,9:10'
+
+    def test_from_sequence_set(self):
+        uid_set = UidSet.from_sequence_set(b'1:4,7,9:10')
+
+        assert list(uid_set) == [1, 2, 3, 4, 7, 9, 10]
+
+    def test_from_unsorted_sequence_set(self):
+        uid_set = UidSet.from_sequence_set('9:7,1,2:3,3')
+
+        assert list(uid_set) == [1, 2, 3, 7, 8, 9]
+
+    def test_sequence_set_round_trip(self):
+        uid_set = UidSet([1, 2, 4, 100, 101, 102, 4294967295])
+
+        assert UidSet.from_sequence_set(uid_set.to_sequence_set()) == uid_set
@@ -0,0 +1,277 @@
+import gc
+
+from concurrent.futures import CancelledError
+from threading import Event, Lock, Thread
+from time import sleep, time
+from unittest import TestCase
+
+from kanmail.server.util import (
+    EXECUTOR_MAX_WORKERS,
+    execute_threaded,
+    KEY_SEMAPHORES,
+    SingleFlight,
+    ThreadedExecutionError,
+)
+
+
+class TestExecuteThreaded(TestCase):
+    def test_results_ordered(self):
+        def task(i):
+            sleep((5 - i) * 0.01)
+            return i
+
+        assert execute_threaded(task, [(i,) for i in range(5)]) == [0, 1, 2, 3, 4]
+
+    def test_empty(self):
+        assert execute_threaded(lambda: None, []) == []
+
+    def test_key_limit(self):
+        lock = Lock()
+        running = {'a': 0, 'b': 0}
+        max_running = {'a': 0, 'b': 0}
+
+        def task(key, i):
+            with lock:
+                running[key] += 1
+                max_running[key] = max(max_running[key], running[key])
+
+            sleep(0.02)
+
+            with lock:
+                running[key] -= 1
+
+            return i
+
+        args_list = [('a' if i % 2 else 'b', i) for i in range(12)]
+        results = execute_threaded(task, args_list, key=lambda key, i: key, limit=2)
+
+        assert results == list(range(12))
+        assert max_running == {'a': 2, 'b': 2}
+
+    def test_key_limit_function(self):
+        lock = Lock()
+        running = {'a': 0, 'b': 0}
+        max_running = {'a': 0, 'b': 0}
+
+        def task(key):
+            with lock:
+                running[key] += 1
+                max_running[key] = max(max_running[key], running[key])
+
+            sleep(0.02)
+
+            with lock:
+                running[key] -= 1
+
+        limits = {'a': 1, 'b': 3}
+        execute_threaded(
+            task, [('b',)] * 6 + [('a',)] * 6,
+            key=lambda key: key, limit=limits.get,
+        )
+
+        assert max_running == limits
+
+    def test_key_semaphores_not_kept(self):
+        class Key(object):
+            pass
+
+        key = Key()
+        execute_threaded(lambda i: i, [(i,) for i in range(4)], key=lambda i: key, limit=2)
+
+        gc.collect()
+        assert all(task_key is not key for task_key, _ in KEY_SEMAPHORES.keys())
+
+    def test_errors_aggregated(self):
+        def task(i):
+            if i % 2:
+                raise ValueError(i)
+            return i
+
+        with self.assertRaises(ThreadedExecutionError) as context:
+            execute_threaded(task, [(i,) for i in range(4)])
+
+        error = context.exception
+        assert error.results == [0, None, 2, None]
+        assert [args for args, _ in error.errors] == [(1,), (3,)]
+        assert all(isinstance(e, ValueError) for _, e in error.errors)
+
+    def test_timeout(self):
+        def task(delay):
+            sleep(delay)
+            return delay
+
+        start = time()
+
+        with self.assertRaises(ThreadedExecutionError) as context:
+            execute_threaded(task, [(0,), (1,)], timeout=0.1)
+
+        assert time() - start < 0.5
+
+        error = context.exception
+        assert error.results == [0, None]
+        assert len(error.errors) == 1
+        args, timeout_error = error.errors[0]
+        assert args == (1,)
+        assert isinstance(timeout_error, TimeoutError)
+
+    def test_cancel_on_error(self):
+        called = []
+
+        def task(i):
+            called.append(i)
+            sleep(0.05)
+            if i == 0:
+                raise ValueError(i)
+            return i
+
+        # Limit to one task at a time so the rest are still pending on failure
+        with self.assertRaises(ThreadedExecutionError) as context:
+            execute_threaded(
+                task, [(i,) for i in range(5)],
+                key=lambda i: 'cancel-on-error', limit=1,
+                cancel_on_error=True,
+            )
+
+        error = context.exception
+        errors = dict(error.errors)
+
+        assert called == [0]
+        assert isinstance(errors[(0,)], ValueError)
+        assert all(
+            isinstance(errors[(i,)], CancelledError)
+            for i in range(1, 5)
+        )
+
+    def test_nested_does_not_deadlock(self):
+        def inner(i, j):
+            sleep(0.001)
+            return i * j
+
+        def outer(i):
+            return sum(execute_threaded(inner, [(i, j) for j in range(3)]))
+
+        # More outer tasks than workers, each waiting on inner tasks
+        count = EXECUTOR_MAX_WORKERS * 2
+        results = execute_threaded(outer, [(i,) for i in range(count)], timeout=10)
+
+        assert results == [i * 3 for i in range(count)]
+
+
+class TestSingleFlight(TestCase):
+    def run_concurrently(self, func, count=5):
+        results = [None] * count
+
+        def target(i):
+            try:
+                results[i] = func()
+            except Exception as e:
+                results[i] = e
+
+        threads = [Thread(target=target, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_shares_in_flight_call(self):
+        flights = SingleFlight()
+        calls = []
+        release = Event()
+
+        def func():
+            calls.append(1)
+            release.wait()
+            return object()
+
+        def call():
+            return flights.do('key', func)
+
+        Thread(target=lambda: (sleep(0.1), release.set())).start()
+        results = self.run_concurrently(call)
+
+        assert len(calls) == 1
+        assert all(result is results[0] for result in results)
+        assert flights.shared == 4
+
+        # Not in flight (and no TTL) so calls again
+        flights.do('key', func)
+        assert len(calls) == 2
+
+    def test_shares_errors(self):
+        flights = SingleFlight()
+        calls = []
+
+        def func():
+            calls.append(1)
+            sleep(0.1)
+            raise ValueError('failed')
+
+        results = self.run_concurrently(lambda: flights.do('key', func))
+
+        assert len(calls) == 1
+        assert all(isinstance(result, ValueError) for result in results)
+
+    def test_different_keys(self):
+        flights = SingleFlight()
+
+        assert flights.do('a', lambda: 1) == 1
+        assert flights.do('b', lambda: 2) == 2
+
+    def test_ttl(self):
+        flights = SingleFlight(ttl=0.1)
+        calls = []
+
+        def func():
+            calls.append(1)
+            return len(calls)
+
+        assert flights.do('key', func) == 1
+        assert flights.do('key', func) == 1
+
+        sleep(0.15)
+        assert flights.do('key', func) == 2
+
+        flights.clear()
+        assert flights.do('key', func) == 3
+
+    def test_errors_not_cached(self):
+        flights = SingleFlight(ttl=10)
+        calls = []
+
+        def func():
+            calls.append(1)
+            raise ValueError('failed')
+
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                flights.do('key', func)
+
+        assert len(calls) == 2
+
+    def test_forget(self):
+        flights = SingleFlight(ttl=10)
+        started = Event()
+        release = Event()
+
+        def slow():
+            started.set()
+            release.wait()
+            return 'old'
+
+        thread = Thread(target=flights.do, args=(('folder', 1), slow))
+        thread.start()
+        started.wait()
+
+        # Calls after forgetting don't share the in-flight call
+        flights.forget(lambda key: key[0] == 'folder')
+        assert flights.do(('folder', 1), lambda: 'new') == 'new'
+
+        release.set()
+        thread.join()
+
+        # Nor is the forgotten call's result kept
+        assert flights.do(('folder', 1), lambda: 'newer') == 'new'
+        flights.forget(lambda key: key[0] == 'folder')
+        assert flights.do(('folder', 1), lambda: 'newer') == 'newer'